@@ -0,0 +1,65 @@
+"""
+Keep generator.db.ActivityFile in step with a data folder and select the
+files to upload from it, so unchanged files are never parsed again just to
+read their start time.
+"""
+
+import os
+
+from generator.db import ActivityFile, update_or_create_activity_file
+
+
+def index_activity_files(session, folder, file_suffix, read_start_time):
+    """
+    Add new or changed files of the folder to the index and drop the rows of
+    deleted files. read_start_time(file_path) is only called for those files
+    and returns a unix timestamp or None.
+    """
+    indexed = {
+        a.file_path: a
+        for a in session.query(ActivityFile).filter_by(file_type=file_suffix)
+    }
+    seen = set()
+    for entry in os.scandir(folder):
+        if not entry.name.endswith(f".{file_suffix}") or not entry.is_file():
+            continue
+        file_path = entry.path
+        seen.add(file_path)
+        stat = entry.stat()
+        activity_file = indexed.get(file_path)
+        if activity_file and (activity_file.size, activity_file.mtime_ns) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            continue
+        update_or_create_activity_file(
+            session, file_path, file_suffix, read_start_time(file_path), stat=stat
+        )
+    for file_path, activity_file in indexed.items():
+        if file_path not in seen:
+            session.delete(activity_file)
+    session.commit()
+
+
+def get_files_to_upload(session, file_suffix, last_time, include_uploaded=False):
+    """
+    return to values one dict for upload
+    and one sorted list for next time upload
+    """
+    query = session.query(ActivityFile).filter(
+        ActivityFile.file_type == file_suffix,
+        ActivityFile.start_time > last_time,
+    )
+    if not include_uploaded:
+        query = query.filter(ActivityFile.uploaded.is_not(True))
+    files_dict = {
+        a.start_time: a.file_path for a in query.order_by(ActivityFile.start_time)
+    }
+    return list(files_dict.keys()), files_dict
+
+
+def mark_uploaded(session, file_path):
+    session.query(ActivityFile).filter_by(file_path=file_path).update(
+        {"uploaded": True}
+    )
+    session.commit()
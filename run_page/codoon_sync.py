@@ -1,18 +1,14 @@
 import argparse
 import base64
+import calendar
 import hashlib
 import hmac
 import json
 import os
 import time
 import urllib.parse
-import xml.etree.ElementTree as ET
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
-from xml.dom import minidom
-import eviltransform
-import gpxpy
-import numpy as np
 import polyline
 import requests
 from config import (
@@ -24,30 +20,25 @@ from config import (
     run_map,
     start_point,
 )
+from coord_transform import gcj2wgs_points
 from generator import Generator
+from response_cache import response_cache
+from sync_journal import FETCHED, PARSED, SKIPPED, WRITTEN, SyncJournal
+from timeline_align import NO_MATCH, nearest_sample_indexes
+from track_writer import (
+    CONNECT_API_AUTHOR,
+    TcxLap,
+    TrackColumns,
+    get_elevation_gain,
+    write_gpx,
+    write_tcx,
+)
 from tzlocal import get_localzone
 from utils import adjust_time_to_utc, adjust_timestamp_to_utc, to_date
 
-# struct body
-FitType = np.dtype(
-    {
-        "names": [
-            "time",
-            "bpm",
-            "step",
-            "lati",
-            "longi",
-            "elevation",
-        ],  # unix timestamp, heart bpm, step, LatitudeDegrees, LongitudeDegrees, elevation
-        "formats": ["i", "S4", "S4", "S32", "S32", "S8"],
-    }
-)
-
 # device info
 user_agent = "CodoonSport(8.9.0 1170;Android 7;Sony XZ1)"
 did = "24-ffffffff-faac-3052-0033-c5870033c587"
-# May be Forerunner 945?
-CONNECT_API_PART_NUMBER = "006-D2449-00"
 
 # fixed params
 base_url = "https://api.codoon.com"
@@ -102,23 +93,13 @@ def download_codoon_gpx(gpx_data, log_id):
     try:
         print(f"downloading codoon {str(log_id)} gpx")
         file_path = os.path.join(GPX_FOLDER, str(log_id) + ".gpx")
-        with open(file_path, "w") as fb:
-            fb.write(gpx_data)
+        write_gpx(file_path, gpx_data, name="gpx from codoon", sport_type="Run")
     except Exception as e:
         print(f"wrong id {log_id} error {str(e)}")
         pass
 
 
-def formated_input(
-    run_data, run_data_label, tcx_label
-):  # load run_data from run_data_label, parse to tcx_label, return xml node
-    fit_data = str(run_data[run_data_label])
-    chile_node = ET.Element(tcx_label)
-    chile_node.text = fit_data
-    return chile_node
-
-
-def tcx_output(fit_array, run_data):
+def tcx_output(fit_list, run_data):
     """
     If you want to make a more detailed tcx file, please refer to oppo_sync.py
     """
@@ -130,134 +111,48 @@ def tcx_output(fit_array, run_data):
     utc = adjust_time_to_utc(to_date(fit_start_time_local), str(get_localzone()))
     fit_start_time = utc.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-    # Root node
-    training_center_database = ET.Element(
-        "TrainingCenterDatabase",
-        {
-            "xmlns": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",
-            "xmlns:ns5": "http://www.garmin.com/xmlschemas/ActivityGoals/v1",
-            "xmlns:ns3": "http://www.garmin.com/xmlschemas/ActivityExtension/v2",
-            "xmlns:ns2": "http://www.garmin.com/xmlschemas/UserProfile/v2",
-            "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-            "xmlns:ns4": "http://www.garmin.com/xmlschemas/ProfileExtension/v1",
-            "xsi:schemaLocation": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd",
-        },
-    )
-    # xml tree
-    ET.ElementTree(training_center_database)
-    # Activities
-    activities = ET.Element("Activities")
-    training_center_database.append(activities)
-    # sport type
-    sports_type = TCX_TYPE_DICT.get(run_data["sports_type"])
-    # activity
-    activity = ET.Element("Activity", {"Sport": sports_type})
-    activities.append(activity)
-    #   Id
-    activity_id = ET.Element("Id")
-    activity_id.text = fit_start_time  # Codoon use start_time as ID
-    activity.append(activity_id)
-    #   Creator
-    activity_creator = ET.Element("Creator", {"xsi:type": "Device_t"})
-    activity.append(activity_creator)
-    #       Name
-    activity_creator_name = ET.Element("Name")
-    activity_creator_name.text = "Codoon"
-    activity_creator.append(activity_creator_name)
-    activity_creator_product = ET.Element("ProductID")
-    activity_creator_product.text = "3441"
-    activity_creator.append(activity_creator_product)
-    #   Lap
-    activity_lap = ET.Element("Lap", {"StartTime": fit_start_time})
-    activity.append(activity_lap)
-    #       TotalTimeSeconds
-    activity_lap.append(formated_input(run_data, "total_time", "TotalTimeSeconds"))
-    #       DistanceMeters
-    activity_lap.append(formated_input(run_data, "total_length", "DistanceMeters"))
-    #       Calories
-    if "total_calories" in run_data:
-        activity_lap.append(formated_input(run_data, "total_calories", "Calories"))
-    #       AverageCadence
-    if "average_step_cadence" in run_data:
-        activity_lap.append(
-            formated_input(run_data, "average_step_cadence", "AverageCadence")
-        )
-    #       MaximumCadence
-    if "max_step_cadence" in run_data:
-        activity_lap.append(
-            formated_input(run_data, "max_step_cadence", "MaximumCadence")
-        )
-
-    # Track
-    track = ET.Element("Track")
-    activity_lap.append(track)
-    for i in fit_array:
-        tp = ET.Element("Trackpoint")
-        track.append(tp)
-        # Time
-        time_stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.localtime(i["time"]))
-        time_label = ET.Element("Time")
-        time_label.text = time_stamp
-        tp.append(time_label)
-        # HeartRateBpm
-        # None was converted to bytes by np.dtype, becoming a string "None" after decode...-_-
-        # as well as LatitudeDegrees and LongitudeDegrees below
-        if not bytes.decode(i["bpm"]) == "None":
-            bpm = ET.Element("HeartRateBpm")
-            bpm_value = ET.Element("Value")
-            bpm.append(bpm_value)
-            bpm_value.text = bytes.decode(i["bpm"])
-            tp.append(bpm)
-        # Cadence
+    # unix_time was made by time.mktime from an utc time struct,
+    # so time.localtime gives back the utc wall clock of the point
+    track = TrackColumns(
+        time=[calendar.timegm(time.localtime(row[0])) for row in fit_list],
+        hr=[row[1] for row in fit_list],
         # The unit is step-per-minute in Garmin
         # but is stride-per-minute in Strava, Coros, and RQrun
-        if not bytes.decode(i["step"]) == "None":
-            step = ET.Element("Cadence")
-            step.text = bytes.decode(i["step"])
-            tp.append(step)
-        # Position
-        if not bytes.decode(i["lati"]) == "None":
-            position = ET.Element("Position")
-            tp.append(position)
-            #   LatitudeDegrees
-            lati = ET.Element("LatitudeDegrees")
-            lati.text = bytes.decode(i["lati"])
-            position.append(lati)
-            #   LongitudeDegrees
-            longi = ET.Element("LongitudeDegrees")
-            longi.text = bytes.decode(i["longi"])
-            position.append(longi)
-            #  AltitudeMeters
-            altitude_meters = ET.Element("AltitudeMeters")
-            altitude_meters.text = bytes.decode(i["elevation"])
-            tp.append(altitude_meters)
-    # Author
-    author = ET.Element("Author", {"xsi:type": "Application_t"})
-    training_center_database.append(author)
-    author_name = ET.Element("Name")
-    author_name.text = "Connect Api"
-    author.append(author_name)
-    author_lang = ET.Element("LangID")
-    author_lang.text = "en"
-    author.append(author_lang)
-    author_part = ET.Element("PartNumber")
-    author_part.text = CONNECT_API_PART_NUMBER
-    author.append(author_part)
+        cad=[row[2] for row in fit_list],
+        lat=[row[3] for row in fit_list],
+        lon=[row[4] for row in fit_list],
+        elevation=[row[5] if row[3] is not None else None for row in fit_list],
+    )
+    summary = [
+        ("TotalTimeSeconds", run_data["total_time"]),
+        ("DistanceMeters", run_data["total_length"]),
+    ]
+    for run_data_label, tcx_label in (
+        ("total_calories", "Calories"),
+        ("average_step_cadence", "AverageCadence"),
+        ("max_step_cadence", "MaximumCadence"),
+    ):
+        if run_data_label in run_data:
+            summary.append((tcx_label, run_data[run_data_label]))
+    lap = TcxLap(fit_start_time, summary, 0, len(fit_list))
     # write to TCX file
     try:
-        xml_str = minidom.parseString(
-            ET.tostring(training_center_database)
-        ).toprettyxml()
-        with open(TCX_FOLDER + "/" + fit_id + ".tcx", "w") as f:
-            f.write(str(xml_str))
+        write_tcx(
+            TCX_FOLDER + "/" + fit_id + ".tcx",
+            track,
+            TCX_TYPE_DICT.get(run_data["sports_type"]),
+            fit_start_time,  # Codoon use start_time as ID
+            laps=[lap],
+            creator=[("Name", "Codoon"), ("ProductID", "3441")],
+            author=CONNECT_API_AUTHOR,
+        )
     except Exception as e:
         print(f"empty database error {str(e)}")
         pass
 
 
 def tcx_job(run_data):
-    # fit struct array
-    fit_array = None
+    # track point rows
     fit_list = []
     fit_hrs = {}
     fit_steps = {}
@@ -302,6 +197,7 @@ def tcx_job(run_data):
 
     # get single track point
     if own_points:
+        point_rows = []
         for point in own_points:
             time_stamp = point.get("time_stamp")
             latitude = point.get("latitude")
@@ -320,12 +216,18 @@ def tcx_job(run_data):
                 print(e, time_stamp)
                 continue
 
-            # get heart rate at unix_time
-            hr = fit_hrs.get(unix_time, None)
-
-            # get steps per minute at unix_time
-            step = fit_steps.get(unix_time, None)
-
+            point_rows.append((unix_time, latitude, longitude, elevation))
+
+        # get heart rate and steps per minute at every point's unix_time
+        point_times = [row[0] for row in point_rows]
+        hr_times, hr_values = list(fit_hrs.keys()), list(fit_hrs.values())
+        step_times, step_values = list(fit_steps.keys()), list(fit_steps.values())
+        hr_indexes = nearest_sample_indexes(hr_times, point_times)
+        step_indexes = nearest_sample_indexes(step_times, point_times)
+        for row, hr_index, step_index in zip(point_rows, hr_indexes, step_indexes):
+            unix_time, latitude, longitude, elevation = row
+            hr = hr_values[hr_index] if hr_index != NO_MATCH else None
+            step = step_values[step_index] if step_index != NO_MATCH else None
             fit_list.append((unix_time, hr, step, latitude, longitude, elevation))
     elif fit_hrs:
         # not trackpoints but heart rates
@@ -343,12 +245,10 @@ def tcx_job(run_data):
             fit_list.append((unix_time, None, step, None, None, None))
 
     if fit_list:
-        # track points
-        fit_array = np.array(fit_list, dtype=FitType)
-        # order array
-        fit_array = np.sort(fit_array, order="time")
+        # order track points by time
+        fit_list.sort(key=lambda row: row[0])
         # write to TCX file
-        tcx_output(fit_array, run_data)
+        tcx_output(fit_list, run_data)
     else:
         print("No data in " + str(run_data["id"]))
 
@@ -501,49 +401,41 @@ class Codoon:
             points = []
         return points
 
-    def parse_points_to_gpx(self, run_points_data):
+    @staticmethod
+    def parse_points_to_gpx(run_points_data):
         # TODO for now kind of same as `keep` maybe refactor later
-        points_dict_list = []
-        for point in run_points_data[:-1]:
-            points_dict = {
-                "latitude": point["latitude"],
-                "longitude": point["longitude"],
-                "elevation": point["elevation"],
-                "time": adjust_time_to_utc(
-                    to_date(point["time_stamp"]), BASE_TIMEZONE
-                ).replace(tzinfo=timezone.utc),
-            }
-            points_dict_list.append(points_dict)
-        gpx = gpxpy.gpx.GPX()
-        gpx.nsmap["gpxtpx"] = "http://www.garmin.com/xmlschemas/TrackPointExtension/v1"
-        gpx_track = gpxpy.gpx.GPXTrack()
-        gpx_track.name = "gpx from codoon"
-        gpx_track.type = "Run"
-        gpx.tracks.append(gpx_track)
-
-        # Create first segment in our GPX track:
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
-        for p in points_dict_list:
-            point = gpxpy.gpx.GPXTrackPoint(**p)
-            gpx_segment.points.append(point)
-        return gpx
+        points = run_points_data[:-1]
+        return TrackColumns(
+            time=[
+                adjust_time_to_utc(to_date(p["time_stamp"]), BASE_TIMEZONE)
+                .replace(tzinfo=timezone.utc)
+                .timestamp()
+                for p in points
+            ],
+            lat=[p["latitude"] for p in points],
+            lon=[p["longitude"] for p in points],
+            elevation=[p["elevation"] for p in points],
+        )
 
     def get_single_run_record(self, route_id):
-        print(f"Get single run for codoon id {route_id}")
-        payload = {
-            "route_id": route_id,
-        }
-        r = self.session.post(
-            f"{base_url}/api/get_single_log",
-            data=payload,
-            auth=self.auth.reload(payload),
+        def fetch():
+            print(f"Get single run for codoon id {route_id}")
+            payload = {
+                "route_id": route_id,
+            }
+            r = self.session.post(
+                f"{base_url}/api/get_single_log",
+                data=payload,
+                auth=self.auth.reload(payload),
+            )
+            if not r.ok:
+                print(r)
+                raise Exception("get runs records error")
+            return r.json()
+
+        return response_cache.get_or_fetch(
+            "codoon_single_log", route_id, fetch, lambda data: bool(data.get("data"))
         )
-        if not r.ok:
-            print(r)
-            raise Exception("get runs records error")
-        data = r.json()
-        return data
 
     @staticmethod
     def _gt(dt_str):
@@ -570,9 +462,7 @@ class Codoon:
             trans_end_date = time.strptime(TRANS_END_DATE, "%Y-%m-%d")
             start_date = time.strptime(start_time, "%Y-%m-%dT%H:%M:%S")
             if trans_end_date > start_date:
-                latlng_data = [
-                    list(eviltransform.gcj2wgs(p[0], p[1])) for p in latlng_data
-                ]
+                latlng_data = gcj2wgs_points(latlng_data)
             if run_points_data:
                 for i, p in enumerate(run_points_data):
                     p["latitude"] = latlng_data[i][0]
@@ -581,11 +471,11 @@ class Codoon:
         elevation_gain = None
         if run_points_data:
             gpx_data = self.parse_points_to_gpx(run_points_data)
-            elevation_gain = gpx_data.get_uphill_downhill().uphill
+            elevation_gain = get_elevation_gain(gpx_data)
             if with_gpx:
                 # pass the track no points
                 if str(log_id) not in old_gpx_ids:
-                    download_codoon_gpx(gpx_data.to_xml(), str(log_id))
+                    download_codoon_gpx(gpx_data, str(log_id))
         heart_rate_dict = run_data.get("heart_rate")
         heart_rate = None
         if heart_rate_dict:
@@ -629,20 +519,38 @@ class Codoon:
         }
         return namedtuple("x", d.keys())(*d.values())
 
-    def get_old_tracks(self, old_ids, with_gpx=False, with_tcx=False):
+    def get_old_tracks(self, old_ids, with_gpx=False, with_tcx=False, journal=None):
+        """
+        With a journal the tracks are committed through it at every checkpoint,
+        and the records it has fetched already are not fetched again, otherwise
+        they are returned.
+        """
         run_records = self.get_runs_records()
 
         old_gpx_ids = os.listdir(GPX_FOLDER)
         old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
         new_run_routes = [i for i in run_records if str(i["log_id"]) not in old_ids]
+        if journal:
+            journal.list(i["log_id"] for i in new_run_routes)
         tracks = []
         for i in new_run_routes:
-            run_data = self.get_single_run_record(i["route_id"])
+            run_data = journal.fetched(i["log_id"]) if journal else None
+            if run_data is None:
+                run_data = self.get_single_run_record(i["route_id"])
+                if journal:
+                    journal.mark(i["log_id"], FETCHED, run_data)
             run_data["data"]["id"] = i["log_id"]
             track = self.parse_raw_data_to_namedtuple(
                 run_data, old_gpx_ids, with_gpx, with_tcx
             )
-            if track:
+            if not track:
+                if journal:
+                    journal.mark(i["log_id"], SKIPPED)
+            elif journal:
+                journal.add_track(
+                    i["log_id"], track, WRITTEN if with_gpx or with_tcx else PARSED
+                )
+            else:
                 tracks.append(track)
         return tracks
 
@@ -684,9 +592,9 @@ if __name__ == "__main__":
 
     generator = Generator(SQL_FILE)
     old_tracks_ids = generator.get_old_tracks_ids()
-    tracks = j.get_old_tracks(old_tracks_ids, options.with_gpx, options.with_tcx)
+    with SyncJournal("codoon", generator.sync_from_app) as journal:
+        j.get_old_tracks(old_tracks_ids, options.with_gpx, options.with_tcx, journal)
 
-    generator.sync_from_app(tracks)
     activities_list = generator.load()
     with open(JSON_FILE, "w") as f:
         json.dump(activities_list, f, indent=0)
@@ -19,6 +19,17 @@ FOLDER_DICT = {
 SQL_FILE = os.path.join(parent, "run_page", "data.db")
 JSON_FILE = os.path.join(parent, "src", "static", "activities.json")
 SYNCED_FILE = os.path.join(parent, "imported.json")
+STRAVA_UPLOAD_QUEUE_FILE = os.path.join(parent, "strava_upload_queue.json")
+# outside the repo, the data sync workflow commits everything in it
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR") or os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "running_page",
+    "responses",
+)
+SYNC_JOURNAL_DIR = os.path.join(parent, "sync_journal")
+# committed with the data like imported.json, a CI run must see it
+GARMIN_GLOBAL_PENDING_FILE = os.path.join(parent, "garmin_global_pending.json")
+NIKE_CONVERTED_FILE = os.path.join(parent, "nike_converted.json")
 
 
 BASE_TIMEZONE = "Asia/Shanghai"
@@ -1,6 +1,7 @@
 import argparse
 import asyncio
 import hashlib
+import json
 import os
 import time
 
@@ -8,7 +9,9 @@ import aiofiles
 import httpx
 
 from config import JSON_FILE, SQL_FILE, FOLDER_DICT
-from utils import make_activities_file
+from generator import Generator
+from generator.db import get_sync_cursor, save_sync_cursor
+from synced_data_file_logger import load_synced_file_list
 
 COROS_URL_DICT = {
     "LOGIN_URL": "https://teamcnapi.coros.com/account/login",
@@ -71,7 +74,8 @@ class Coros:
     async def init(self):
         await self.login()
 
-    async def fetch_activity_ids_types(self, only_run):
+    async def fetch_activity_ids_types(self, only_run, last_label_id=None):
+        """Newest first, the listing stops at last_label_id when it is given."""
         page_number = 1
         all_activities_ids_types = []
 
@@ -88,6 +92,8 @@ class Coros:
                 sport_type = activity["sportType"]
                 if label_id is None:
                     continue
+                if last_label_id and label_id == last_label_id:
+                    return all_activities_ids_types
                 all_activities_ids_types.append([label_id, sport_type])
 
             page_number += 1
@@ -142,22 +148,57 @@ def get_downloaded_ids(folder):
     return [i.split(".")[0] for i in os.listdir(folder) if not i.startswith(".")]
 
 
+def get_coros_sync_source(file_type, only_run):
+    # a run only listing says nothing about the other sports
+    return f"coros_{file_type}_run" if only_run else f"coros_{file_type}"
+
+
 async def download_and_generate(account, password, only_run, file_type):
+    generator = Generator(SQL_FILE)
+    source = get_coros_sync_source(file_type, only_run)
+    file_paths, newest_label_id = await download_new_activities(
+        account,
+        password,
+        only_run,
+        file_type,
+        get_sync_cursor(generator.session, source),
+    )
+    generator.sync_from_files(file_paths)
+    if newest_label_id:
+        save_sync_cursor(generator.session, source, newest_label_id)
+        generator.session.commit()
+    activities_list = generator.load()
+    with open(JSON_FILE, "w") as f:
+        json.dump(activities_list, f)
+
+
+async def download_new_activities(
+    account, password, only_run, file_type, last_label_id=None
+):
+    """
+    List the activities newer than last_label_id and download the missing ones.
+    Return the files of those activities that are not imported yet, and the
+    newest label id, None when a download failed so the next run lists again.
+    """
     folder = FOLDER_DICT[file_type]
-    downloaded_ids = get_downloaded_ids(folder)
+    downloaded_files = {
+        i.split(".")[0]: i for i in os.listdir(folder) if not i.startswith(".")
+    }
     coros = Coros(account, password)
     await coros.init()
-    activity_infos = await coros.fetch_activity_ids_types(only_run=only_run)
+    activity_infos = await coros.fetch_activity_ids_types(
+        only_run=only_run, last_label_id=last_label_id
+    )
     activity_ids = [i[0] for i in activity_infos]
     activity_types = [i[1] for i in activity_infos]
     activity_id_type_dict = dict(zip(activity_ids, activity_types))
     print("activity_ids: ", len(activity_ids))
-    print("downloaded_ids: ", len(downloaded_ids))
-    to_generate_coros_ids = list(set(activity_ids) - set(downloaded_ids))
+    print("downloaded_ids: ", len(downloaded_files))
+    to_generate_coros_ids = list(set(activity_ids) - set(downloaded_files))
     print("to_generate_activity_ids: ", len(to_generate_coros_ids))
 
     start_time = time.time()
-    await gather_with_concurrency(
+    results = await gather_with_concurrency(
         10,
         [
             coros.download_activity(
@@ -168,7 +209,26 @@ async def download_and_generate(account, password, only_run, file_type):
     )
     print(f"Download finished. Elapsed {time.time()-start_time} seconds")
     await coros.req.aclose()
-    make_activities_file(SQL_FILE, folder, JSON_FILE, file_type)
+
+    is_all_downloaded = True
+    for label_id, (downloaded_id, fname) in zip(to_generate_coros_ids, results):
+        if downloaded_id is None:
+            # gpx does not support every sport, those are never downloaded
+            if not (activity_id_type_dict[label_id] == 101 and file_type == "gpx"):
+                is_all_downloaded = False
+            continue
+        downloaded_files[label_id] = fname
+    # files of a run that stopped before the import are picked up here too
+    synced_files = set(load_synced_file_list())
+    file_paths = [
+        os.path.join(folder, downloaded_files[label_id])
+        for label_id in activity_ids
+        if label_id in downloaded_files
+        and downloaded_files[label_id] not in synced_files
+    ]
+    if not activity_ids:
+        return file_paths, last_label_id
+    return file_paths, activity_ids[0] if is_all_downloaded else None
 
 
 async def gather_with_concurrency(n, tasks):
@@ -0,0 +1,69 @@
+"""
+Drop duplicated activities: the same run saved twice by an app, or synced from
+two sources (e.g. Garmin and Strava).
+
+Records are sorted by start time once and each one is compared with the record
+kept for the current cluster only: within `threshold` seconds of it, the better
+of the two is kept and the other dropped, otherwise a new cluster starts. That
+is O(n log n), no record is compared with all the others, and like a pairwise
+check two records more than `threshold` apart never drop each other through a
+third one between them.
+"""
+
+import datetime
+
+import arrow
+
+
+def _seconds(t):
+    if isinstance(t, datetime.datetime):
+        return t.timestamp()
+    return float(t)
+
+
+def dedupe_by_start_time(records, start_time, priority, threshold=10):
+    """
+    Return (kept, dropped), both in start time order.
+
+    start_time(record) is a datetime or a timestamp in seconds, the record with
+    the highest priority(record) of a cluster is kept, the earliest one wins
+    a tie.
+    """
+    if not records:
+        return [], []
+    times = [_seconds(start_time(r)) for r in records]
+    order = sorted(range(len(records)), key=times.__getitem__)
+    kept, dropped = [], []
+    best = order[0]
+    for i in order[1:]:
+        if times[i] - times[best] > threshold:
+            kept.append(best)
+            best = i
+        elif priority(records[i]) > priority(records[best]):
+            dropped.append(best)
+            best = i
+        else:
+            dropped.append(i)
+    kept.append(best)
+    dropped.sort(key=times.__getitem__)
+    return [records[i] for i in kept], [records[i] for i in dropped]
+
+
+def dedupe_activities(activities, threshold=60):
+    """
+    Dedupe the activity dicts of Generator.load() across sources, the one
+    with a track and then the longest one is kept.
+    """
+
+    def start_time(activity):
+        return arrow.get(activity["start_date"]).timestamp()
+
+    def priority(activity):
+        return bool(activity.get("summary_polyline")), activity["distance"]
+
+    kept, dropped = dedupe_by_start_time(activities, start_time, priority, threshold)
+    if dropped:
+        print(f"{len(dropped)} duplicated activities are not exported")
+    # keep the order of the input, load() sorts by local start time
+    kept_ids = {id(a) for a in kept}
+    return [a for a in activities if id(a) in kept_ids]
@@ -3,6 +3,7 @@ need to download the files from endomondo
 and store it in Workouts dir in running_page
 """
 
+import concurrent.futures
 import json
 import os
 from collections import namedtuple
@@ -18,6 +19,9 @@ from utils import adjust_time
 start_point = namedtuple("start_point", "lat lon")
 run_map = namedtuple("polyline", "summary_polyline")
 
+# tracks committed per db transaction while the files are parsed
+ENDOMONDO_BATCH_SIZE = 200
+
 
 def _make_heart_rate(en_dict):
     """
@@ -32,7 +36,8 @@ def _make_endomondo_id(file_name):
     return endomondo_id
 
 
-def parse_run_endomondo_to_nametuple(en_dict):
+def parse_run_endomondo_to_dict(en_dict):
+    """Plain values only, the result is sent back from the worker processes."""
     points = en_dict.get("points", [])
     location_points = []
     for p in points:
@@ -42,7 +47,7 @@ def parse_run_endomondo_to_nametuple(en_dict):
                 lat, lon = attr.get("location")[0]
                 location_points.append([lat.get("latitude"), lon.get("longitude")])
     polyline_str = polyline.encode(location_points) if location_points else ""
-    start_latlng = start_point(*location_points[0]) if location_points else None
+    start_latlng = tuple(location_points[0]) if location_points else None
     start_date = en_dict.get("start_time")
     start_date = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S.%f")
     end_date = en_dict.get("end_time")
@@ -61,7 +66,7 @@ def parse_run_endomondo_to_nametuple(en_dict):
         "end_local": datetime.strftime(end_date_local, "%Y-%m-%d %H:%M:%S"),
         "length": en_dict.get("distance_km", 0) * 1000,
         "average_heartrate": int(heart_rate) if heart_rate else None,
-        "map": run_map(polyline_str),
+        "map": polyline_str,
         "start_latlng": start_latlng,
         "distance": en_dict.get("distance_km", 0) * 1000,
         "moving_time": timedelta(seconds=en_dict.get("duration_s", 0)),
@@ -72,25 +77,41 @@ def parse_run_endomondo_to_nametuple(en_dict):
         "elevation_gain": None,
         "location_country": "",
     }
+    return d
+
+
+def endomondo_dict_to_nametuple(d):
+    d = dict(d)
+    d["map"] = run_map(d["map"])
+    if d["start_latlng"]:
+        d["start_latlng"] = start_point(*d["start_latlng"])
     return namedtuple("x", d.keys())(*d.values())
 
 
+def parse_run_endomondo_to_nametuple(en_dict):
+    return endomondo_dict_to_nametuple(parse_run_endomondo_to_dict(en_dict))
+
+
 def parse_one_endomondo_json(json_file_name):
     with open(json_file_name) as f:
-        content = json.loads(f.read())
+        content = json.load(f)
     d = {}
     # use file name as id
     endomondo_id = _make_endomondo_id(json_file_name)
-    print(endomondo_id)
     if not endomondo_id:
         raise Exception("No endomondo id generated in {}".format(json_file_name))
     d["id"] = endomondo_id
     # endomondo list -> dict
     for c in content:
-        d.update(**c)
+        d.update(c)
     return d
 
 
+def parse_endomondo_file(json_file_name):
+    """Run in a worker process, the document is dropped there after parsing."""
+    return parse_run_endomondo_to_dict(parse_one_endomondo_json(json_file_name))
+
+
 def get_all_en_endomondo_json_file(file_dir=ENDOMONDO_FILE_DIR):
     dirs = os.listdir(file_dir)
     json_files = [os.path.join(file_dir, i) for i in dirs if i.endswith(".json")]
@@ -99,18 +120,28 @@ def get_all_en_endomondo_json_file(file_dir=ENDOMONDO_FILE_DIR):
 
 def run_enomondo_sync():
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
+    old_tracks_ids = set(generator.get_old_tracks_ids())
     json_files_list = get_all_en_endomondo_json_file()
     if not json_files_list:
         raise Exception("No json files found in {}".format(ENDOMONDO_FILE_DIR))
+    json_files_list = [
+        i for i in json_files_list if _make_endomondo_id(i) not in old_tracks_ids
+    ]
+    print(f"{len(json_files_list)} new endomondo files to import")
     tracks = []
-    for i in json_files_list:
-        if _make_endomondo_id(i) in old_tracks_ids:
-            continue
-        en_dict = parse_one_endomondo_json(i)
-        track = parse_run_endomondo_to_nametuple(en_dict)
-        tracks.append(track)
-    generator.sync_from_app(tracks)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        # only the small activity dicts come back, in file order
+        for d in executor.map(
+            parse_endomondo_file,
+            json_files_list,
+            chunksize=max(1, len(json_files_list) // (8 * (os.cpu_count() or 1))),
+        ):
+            tracks.append(endomondo_dict_to_nametuple(d))
+            if len(tracks) >= ENDOMONDO_BATCH_SIZE:
+                generator.sync_from_app(tracks)
+                tracks = []
+    if tracks:
+        generator.sync_from_app(tracks)
     activities_list = generator.load()
     with open(JSON_FILE, "w") as f:
         json.dump(activities_list, f)
@@ -0,0 +1,58 @@
+"""
+Streaming downloads of activity files for the sync scripts.
+
+Files are written to <file_path>.part and renamed when complete, so an existing
+file is always a whole download and is skipped, and a .part left by an
+interrupted run is continued with a Range request.
+"""
+
+import os
+
+import requests
+
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+
+def make_download_session(workers=DOWNLOAD_WORKERS):
+    """A session whose connection pool is shared by all download threads."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=workers, pool_maxsize=workers
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def is_downloaded(file_path, size=None):
+    try:
+        file_size = os.path.getsize(file_path)
+    except OSError:
+        return False
+    return size is None or file_size == size
+
+
+def download_to_file(session, url, file_path, size=None, headers=None):
+    """Return True when the file was downloaded, False when it was there already."""
+    if is_downloaded(file_path, size):
+        return False
+    part_path = f"{file_path}.part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = dict(headers or {})
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    with session.get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as rsp:
+        # 416: the part already holds the whole file
+        if not (offset and rsp.status_code == 416):
+            rsp.raise_for_status()
+            # a server that ignores Range sends the whole file again
+            mode = "ab" if rsp.status_code == 206 else "wb"
+            with open(part_path, mode) as f:
+                for chunk in rsp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+    os.replace(part_path, file_path)
+    return True
@@ -70,18 +70,55 @@ def do_process_garmin_data(file_content, use_fake_garmin_device):
     return modified_file.to_bytes()
 
 
-def find_valid_heart_rate(messages, current_index):
-    """Find the nearest valid heart rate value."""
+def is_valid_heart_rate(heart_rate):
+    return heart_rate is not None and heart_rate != 255
 
-    for msg in messages[current_index + 1 :]:
-        if msg.heart_rate is not None and msg.heart_rate != 255:
-            return msg.heart_rate
 
-    for msg in reversed(messages[:current_index]):
-        if msg.heart_rate is not None and msg.heart_rate != 255:
-            return msg.heart_rate
+def fill_invalid_heart_rates(heart_rates):
+    """
+    Replace None/255 values with the next valid value, or the previous one
+    when there is no valid value after it. Two linear passes.
+    """
+    filled = list(heart_rates)
+    next_valid = None
+    for i in range(len(filled) - 1, -1, -1):
+        if is_valid_heart_rate(heart_rates[i]):
+            next_valid = heart_rates[i]
+        elif next_valid is not None:
+            filled[i] = next_valid
+
+    previous_valid = None
+    for i, heart_rate in enumerate(heart_rates):
+        if is_valid_heart_rate(heart_rate):
+            previous_valid = heart_rate
+        elif not is_valid_heart_rate(filled[i]) and previous_valid is not None:
+            filled[i] = previous_valid
+    return filled
+
+
+def get_processed_heart_rate_message(record_messages):
+    """Process heart rate data, replacing None/255 values with nearby valid values."""
+    heart_rates = [message.heart_rate for message in record_messages]
+    filled = fill_invalid_heart_rates(heart_rates)
+    processed_messages = []
+    for message, heart_rate, new_heart_rate in zip(
+        record_messages, heart_rates, filled
+    ):
+        if new_heart_rate != heart_rate:
+            message = patch_heart_rate(message, new_heart_rate)
+        processed_messages.append(message)
+
+    print("process heart rate data success")
+    return processed_messages
+
 
-    return None
+def patch_heart_rate(message, heart_rate):
+    """Set the heart rate on the decoded message, copy it only when its
+    definition has no heart rate field to write into."""
+    if message.get_field_by_name("heart_rate").is_valid():
+        message.heart_rate = heart_rate
+        return message
+    return create_new_record_message(message, heart_rate)
 
 
 def create_new_record_message(old_message, heart_rate):
@@ -100,26 +137,6 @@ def create_new_record_message(old_message, heart_rate):
     return new_message
 
 
-def get_processed_heart_rate_message(record_messages):
-    """Process heart rate data, replacing None/255 values with nearby valid values."""
-    processed_messages = []
-
-    for i, message in enumerate(record_messages):
-        if message.heart_rate is None or message.heart_rate == 255:
-            valid_heart_rate = find_valid_heart_rate(record_messages, i)
-            if valid_heart_rate is not None:
-                processed_messages.append(
-                    create_new_record_message(message, valid_heart_rate)
-                )
-            else:
-                processed_messages.append(message)
-        else:
-            processed_messages.append(message)
-
-    print("process heart rate data success")
-    return processed_messages
-
-
 def get_device_info_message():
     """
     add customized device info to fit file,
@@ -20,7 +20,7 @@ import garth
 import httpx
 from config import FOLDER_DICT, JSON_FILE, SQL_FILE
 from garmin_device_adaptor import process_garmin_data
-from utils import make_activities_file
+from utils import add_unsynced_files, import_activity_files
 
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -113,6 +113,7 @@ class Garmin:
         Fetch activity summary
         """
         url = f"{self.modern_url}/activity-service/activity/{activity_id}"
+        # not cached, the activity name can be edited
         return await self.fetch_data(url)
 
     async def download_activity(self, activity_id, file_type="gpx"):
@@ -132,31 +133,36 @@ class Garmin:
             use_fake_garmin_device,
         )
         for data in datas:
-            with open(data.filename, "wb") as f:
-                for chunk in data.content:
-                    f.write(chunk)
-            f = open(data.filename, "rb")
-            file_body = process_garmin_data(f, use_fake_garmin_device)
-            files = {"file": (data.filename, file_body)}
-
-            try:
-                res = await self.req.post(
-                    self.upload_url, files=files, headers=self.headers
-                )
-                os.remove(data.filename)
-                f.close()
-            except Exception as e:
-                print(str(e))
-                # just pass for now
-                continue
-            try:
-                resp = res.json()["detailedImportResult"]
-                print("garmin upload success: ", resp)
-            except Exception as e:
-                print("garmin upload failed: ", e)
+            await self.upload_activity_original_from_strava(
+                data.filename, b"".join(data.content), use_fake_garmin_device
+            )
         await self.req.aclose()
 
+    async def upload_activity_original_from_strava(
+        self, file_name, content, use_fake_garmin_device=False
+    ):
+        # keep the strava original in memory, no temp file round trip
+        file_body = process_garmin_data(BytesIO(content), use_fake_garmin_device)
+        files = {"file": (file_name, file_body)}
+
+        try:
+            res = await self.req.post(
+                self.upload_url, files=files, headers=self.headers
+            )
+        except Exception as e:
+            print(str(e))
+            # just pass for now
+            return False
+        try:
+            resp = res.json()["detailedImportResult"]
+            print("garmin upload success: ", resp)
+            return True
+        except Exception as e:
+            print("garmin upload failed: ", e)
+            return False
+
     async def upload_activity_from_file(self, file):
+        """Return True when garmin took the file, a duplicate counts too."""
         print("Uploading " + str(file))
         f = open(file, "rb")
 
@@ -266,6 +272,24 @@ def add_summary_info(file_data, summary_infos, fields=None):
     return file_data
 
 
+def get_fit_zip_members(zip_data, activity_id, folder):
+    """
+    Unpack the zip garmin returns for fit downloads in memory,
+    return (file_path, content) for the .fit and .gpx members.
+    """
+    outputs = []
+    with zipfile.ZipFile(BytesIO(zip_data)) as zip_file:
+        for file_info in zip_file.infolist():
+            if file_info.filename.endswith(".fit"):
+                file_path = os.path.join(folder, f"{activity_id}.fit")
+            elif file_info.filename.endswith(".gpx"):
+                file_path = os.path.join(FOLDER_DICT["gpx"], f"{activity_id}.gpx")
+            else:
+                continue
+            outputs.append((file_path, zip_file.read(file_info)))
+    return outputs
+
+
 async def download_garmin_data(
     client, activity_id, file_type="gpx", summary_infos=None
 ):
@@ -274,35 +298,38 @@ async def download_garmin_data(
         file_data = await client.download_activity(activity_id, file_type=file_type)
         if summary_infos is not None and file_type == "gpx":
             file_data = add_summary_info(file_data, summary_infos.get(activity_id))
-        file_path = os.path.join(folder, f"{activity_id}.{file_type}")
-        need_unzip = False
         if file_type == "fit":
-            file_path = os.path.join(folder, f"{activity_id}.zip")
-            need_unzip = True
-        async with aiofiles.open(file_path, "wb") as fb:
-            await fb.write(file_data)
-        if need_unzip:
-            zip_file = zipfile.ZipFile(file_path, "r")
-            for file_info in zip_file.infolist():
-                zip_file.extract(file_info, folder)
-                if file_info.filename.endswith(".fit"):
-                    os.rename(
-                        os.path.join(folder, f"{activity_id}_ACTIVITY.fit"),
-                        os.path.join(folder, f"{activity_id}.fit"),
-                    )
-                elif file_info.filename.endswith(".gpx"):
-                    os.rename(
-                        os.path.join(folder, f"{activity_id}_ACTIVITY.gpx"),
-                        os.path.join(FOLDER_DICT["gpx"], f"{activity_id}.gpx"),
-                    )
-                else:
-                    os.remove(os.path.join(folder, file_info.filename))
-            os.remove(file_path)
+            outputs = get_fit_zip_members(file_data, activity_id, folder)
+        else:
+            outputs = [(os.path.join(folder, f"{activity_id}.{file_type}"), file_data)]
+        for file_path, content in outputs:
+            async with aiofiles.open(file_path, "wb") as fb:
+                await fb.write(content)
     except Exception as e:
         print(f"Failed to download activity {activity_id}: {str(e)}")
         traceback.print_exc()
 
 
+def get_activity_file_paths(activity_ids, file_type="gpx"):
+    """
+    The files download_garmin_data saved for the activities, with the files
+    of an earlier run that were downloaded but not imported.
+    """
+    folders = [(FOLDER_DICT.get(file_type, "gpx"), file_type)]
+    # fit may contain gpx(maybe upload by user)
+    if file_type == "fit":
+        folders.append((FOLDER_DICT["gpx"], "gpx"))
+    file_paths = []
+    for activity_id in activity_ids:
+        for folder, file_suffix in folders:
+            file_path = os.path.join(folder, f"{activity_id}.{file_suffix}")
+            if os.path.exists(file_path):
+                file_paths.append(file_path)
+    return add_unsynced_files(
+        file_paths, {file_suffix: folder for folder, file_suffix in folders}
+    )
+
+
 async def get_activity_id_list(client, start=0):
     activities = await client.get_activities(start, 100)
     if len(activities) > 0:
@@ -456,15 +483,9 @@ if __name__ == "__main__":
     )
     loop.run_until_complete(future)
     new_ids, id2title = future.result()
-    # fit may contain gpx(maybe upload by user)
-    if file_type == "fit":
-        make_activities_file(
-            SQL_FILE,
-            FOLDER_DICT["gpx"],
-            JSON_FILE,
-            file_suffix="gpx",
-            activity_title_dict=id2title,
-        )
-    make_activities_file(
-        SQL_FILE, folder, JSON_FILE, file_suffix=file_type, activity_title_dict=id2title
+    import_activity_files(
+        SQL_FILE,
+        get_activity_file_paths(new_ids, file_type),
+        JSON_FILE,
+        activity_title_dict=id2title,
     )
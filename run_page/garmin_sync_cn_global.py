@@ -5,14 +5,139 @@ Copy most code from https://github.com/cyberjunky/python-garminconnect
 
 import argparse
 import asyncio
+import json
 import os
 import sys
 
 
-from config import FIT_FOLDER, GPX_FOLDER, JSON_FILE, SQL_FILE
+from config import (
+    FIT_FOLDER,
+    GARMIN_GLOBAL_PENDING_FILE,
+    GPX_FOLDER,
+    JSON_FILE,
+    SQL_FILE,
+)
+from generator import Generator
 from garmin_sync import Garmin, get_downloaded_ids
-from garmin_sync import download_new_activities
-from utils import make_activities_file
+from garmin_sync import (
+    download_garmin_data,
+    gather_with_concurrency,
+    get_activity_id_list,
+)
+from gpxtrackposter.track_loader import TrackLoader
+from utils import add_unsynced_files
+
+
+class PendingUploads:
+    """
+    Ids of the activities to upload to Garmin Global, an id is added before
+    its download and removed once Garmin Global took the file, every change
+    is saved, so a failed or interrupted upload is retried by the next run.
+    """
+
+    def __init__(self, file_path=GARMIN_GLOBAL_PENDING_FILE):
+        self.file_path = file_path
+        self.ids = set()
+        if os.path.exists(file_path):
+            with open(file_path) as f:
+                self.ids = set(json.load(f))
+
+    def _save(self):
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(sorted(self.ids), f, indent=0)
+        os.replace(tmp_path, self.file_path)
+
+    def add(self, activity_id):
+        self.ids.add(activity_id)
+        self._save()
+
+    def remove(self, activity_id):
+        self.ids.discard(activity_id)
+        self._save()
+
+
+def get_activity_file(activity_id):
+    # activities manually imported with a gpx have no fit
+    for folder, file_suffix in ((FIT_FOLDER, "fit"), (GPX_FOLDER, "gpx")):
+        file_path = os.path.join(folder, f"{activity_id}.{file_suffix}")
+        if os.path.exists(file_path):
+            return folder, file_suffix, file_path
+    return None
+
+
+async def mirror_new_activities(
+    secret_string_cn,
+    secret_string_global,
+    downloaded_ids,
+    pending_uploads,
+    is_only_running,
+    generator,
+):
+    """
+    Every new activity of Garmin CN goes download -> upload to Garmin Global
+    -> parse -> db on its own, only the new files are parsed. The pending
+    uploads of earlier runs are uploaded again.
+    """
+    garmin_cn_client = Garmin(secret_string_cn, "CN", is_only_running)
+    # FIXME is com ok here?
+    garmin_global_client = Garmin(secret_string_global, "COM", is_only_running)
+    loader = TrackLoader()
+    # the session is not shared between threads, one write at a time
+    db_lock = asyncio.Lock()
+
+    activity_ids = await get_activity_id_list(garmin_cn_client)
+    new_ids = list(set(activity_ids) - set(downloaded_ids))
+    retry_ids = list(pending_uploads.ids - set(new_ids))
+    print(f"{len(new_ids)} new activities to be mirrored")
+    if retry_ids:
+        print(f"{len(retry_ids)} failed uploads to Garmin Global to retry")
+
+    async def upload(activity_id, file_path):
+        if await garmin_global_client.upload_activity_from_file(file_path):
+            pending_uploads.remove(activity_id)
+
+    async def retry(activity_id):
+        activity_file = get_activity_file(activity_id)
+        if activity_file is None:
+            # the download failed too, mirror it again
+            pending_uploads.remove(activity_id)
+            return
+        await upload(activity_id, activity_file[2])
+
+    async def mirror(activity_id):
+        try:
+            activity_summary = await garmin_cn_client.get_activity_summary(activity_id)
+            activity_title = activity_summary.get("activityName", "")
+        except Exception as e:
+            print(f"Failed to get activity summary {activity_id}: {str(e)}")
+            return
+        pending_uploads.add(activity_id)
+        await download_garmin_data(garmin_cn_client, activity_id, file_type="fit")
+        activity_file = get_activity_file(activity_id)
+        if activity_file is None:
+            return
+        folder, file_suffix, file_path = activity_file
+        await upload(activity_id, file_path)
+        track = await asyncio.to_thread(
+            loader.load_track_file,
+            file_path,
+            file_suffix,
+            {activity_id: activity_title},
+        )
+        if track is None:
+            return
+        async with db_lock:
+            await asyncio.to_thread(
+                generator.write_tracks, [track], folder, file_suffix
+            )
+
+    await gather_with_concurrency(
+        10, [mirror(i) for i in new_ids] + [retry(i) for i in retry_ids]
+    )
+    await garmin_cn_client.req.aclose()
+    await garmin_global_client.req.aclose()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -32,13 +157,11 @@ if __name__ == "__main__":
     options = parser.parse_args()
     secret_string_cn = options.cn_secret_string
     secret_string_global = options.global_secret_string
-    auth_domain = "CN"
     is_only_running = options.only_run
     if secret_string_cn is None or secret_string_global is None:
         print("Missing argument nor valid configuration file")
         sys.exit(1)
 
-    # Step 1:
     # Sync all activities from Garmin CN to Garmin Global in FIT format
     # If the activity is manually imported with a GPX, the GPX file will be synced
 
@@ -47,52 +170,27 @@ if __name__ == "__main__":
     downloaded_gpx = get_downloaded_ids(GPX_FOLDER)
     downloaded_activity = list(set(downloaded_fit + downloaded_gpx))
 
-    folder = FIT_FOLDER
-    # make gpx or tcx dir
-    if not os.path.exists(folder):
-        os.mkdir(folder)
+    for folder in (FIT_FOLDER, GPX_FOLDER):
+        if not os.path.exists(folder):
+            os.mkdir(folder)
 
-    loop = asyncio.get_event_loop()
-    future = asyncio.ensure_future(
-        download_new_activities(
+    generator = Generator(SQL_FILE)
+    asyncio.run(
+        mirror_new_activities(
             secret_string_cn,
-            auth_domain,
+            secret_string_global,
             downloaded_activity,
+            PendingUploads(),
             is_only_running,
-            folder,
-            "fit",
+            generator,
         )
     )
-    loop.run_until_complete(future)
-    new_ids, id2title = future.result()
-
-    to_upload_files = []
-    for i in new_ids:
-        if os.path.exists(os.path.join(FIT_FOLDER, f"{i}.fit")):
-            # upload fit files
-            to_upload_files.append(os.path.join(FIT_FOLDER, f"{i}.fit"))
-        elif os.path.exists(os.path.join(GPX_FOLDER, f"{i}.gpx")):
-            # upload gpx files which are manually uploaded to garmin connect
-            to_upload_files.append(os.path.join(GPX_FOLDER, f"{i}.gpx"))
-
-    print("Files to sync:" + " ".join(to_upload_files))
-    # FIXME is com ok here?
-    garmin_global_client = Garmin(
-        secret_string_global,
-        "COM",
-        is_only_running,
-    )
-    loop = asyncio.get_event_loop()
-    future = asyncio.ensure_future(
-        garmin_global_client.upload_activities_files(to_upload_files)
-    )
-    loop.run_until_complete(future)
 
-    # Step 2:
-    # Generate track from fit/gpx file
-    make_activities_file(
-        SQL_FILE, GPX_FOLDER, JSON_FILE, file_suffix="gpx", activity_title_dict=id2title
-    )
-    make_activities_file(
-        SQL_FILE, FIT_FOLDER, JSON_FILE, file_suffix="fit", activity_title_dict=id2title
+    # files of a run that stopped between the download and the import
+    generator.sync_from_files(
+        add_unsynced_files([], {"fit": FIT_FOLDER, "gpx": GPX_FOLDER})
     )
+
+    activities_list = generator.load()
+    with open(JSON_FILE, "w") as f:
+        json.dump(activities_list, f)
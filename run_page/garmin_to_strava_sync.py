@@ -7,12 +7,12 @@ import argparse
 import asyncio
 import os
 import sys
-import time
 
 from config import FOLDER_DICT
 from garmin_sync import download_new_activities, get_downloaded_ids
 from strava_sync import run_strava_sync
-from utils import make_strava_client, upload_file_to_strava
+from strava_upload_queue import StravaUploadQueue
+from utils import make_strava_client
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -67,15 +67,10 @@ if __name__ == "__main__":
     loop.run_until_complete(future)
     new_ids, id2title = future.result()
     print(f"To upload to strava {len(new_ids)} files")
-    index = 1
+    upload_queue = StravaUploadQueue(strava_client)
     for i in new_ids:
-        f = os.path.join(folder, f"{i}.{file_type}")
-        upload_file_to_strava(strava_client, f, file_type)
-        if index % 10 == 0:
-            print("For the rate limit will sleep 10s")
-            time.sleep(10)
-        index += 1
-        time.sleep(1)
+        upload_queue.add(os.path.join(folder, f"{i}.{file_type}"), file_type)
+    upload_queue.run()
 
     # Run the strava sync
     run_strava_sync(
@@ -7,14 +7,25 @@ import stravalib
 from gpxtrackposter import track_loader
 from sqlalchemy import func
 
+from dedupe import dedupe_activities
 from polyline_processor import filter_out
 
-from .db import Activity, init_db, update_or_create_activity
+from .db import (
+    Activity,
+    get_activity_fingerprint,
+    get_sync_cursor,
+    init_db,
+    save_sync_cursor,
+    update_or_create_activity,
+    update_or_create_activity_file,
+)
 
 from synced_data_file_logger import save_synced_data_file_list
 
-
 IGNORE_BEFORE_SAVING = os.getenv("IGNORE_BEFORE_SAVING", False)
+# activities started this many days before the cursor are listed again to catch edits
+STRAVA_SYNC_LOOKBACK_DAYS = int(os.getenv("STRAVA_SYNC_LOOKBACK_DAYS", 7))
+STRAVA_SYNC_SOURCE = "strava"
 
 
 class Generator:
@@ -26,6 +37,7 @@ class Generator:
         self.client_secret = ""
         self.refresh_token = ""
         self.only_run = False
+        self.sync_lookback_days = STRAVA_SYNC_LOOKBACK_DAYS
 
     def set_strava_config(self, client_id, client_secret, refresh_token):
         self.client_id = client_id
@@ -53,17 +65,25 @@ class Generator:
         self.check_access()
 
         print("Start syncing")
+        filters = self.get_strava_filters(force)
+        self.write_strava_activities(self.iter_strava_activities(filters))
+
+    def get_strava_filters(self, force):
         if force:
-            filters = {"before": datetime.datetime.now(datetime.timezone.utc)}
-        else:
-            last_activity = self.session.query(func.max(Activity.start_date)).scalar()
-            if last_activity:
-                last_activity_date = arrow.get(last_activity)
-                last_activity_date = last_activity_date.shift(days=-7)
-                filters = {"after": last_activity_date.datetime}
-            else:
-                filters = {"before": datetime.datetime.now(datetime.timezone.utc)}
+            return {"before": datetime.datetime.now(datetime.timezone.utc)}
+        # databases synced before the cursor existed start from the newest activity
+        last_start_date = (
+            get_sync_cursor(self.session, STRAVA_SYNC_SOURCE)
+            or self.session.query(func.max(Activity.start_date)).scalar()
+        )
+        if last_start_date:
+            last_activity_date = arrow.get(last_start_date)
+            last_activity_date = last_activity_date.shift(days=-self.sync_lookback_days)
+            return {"after": last_activity_date.datetime}
+        return {"before": datetime.datetime.now(datetime.timezone.utc)}
 
+    def iter_strava_activities(self, filters):
+        """List strava activities, only network access, no db access."""
         for activity in self.client.get_activities(**filters):
             if self.only_run and activity.type != "Run":
                 continue
@@ -75,25 +95,97 @@ class Generator:
             #  strava use total_elevation_gain as elevation_gain
             activity.elevation_gain = activity.total_elevation_gain
             activity.subtype = activity.type
-            created = update_or_create_activity(self.session, activity)
+            yield activity
+
+    def write_strava_activities(self, activities):
+        fingerprints = dict(self.session.query(Activity.run_id, Activity.fingerprint))
+        newest_start_date = None
+        for activity in activities:
+            if newest_start_date is None or activity.start_date > newest_start_date:
+                newest_start_date = activity.start_date
+            fingerprint = get_activity_fingerprint(activity)
+            if fingerprints.get(int(activity.id)) == fingerprint:
+                # unchanged since the last sync, no db write
+                continue
+            created = update_or_create_activity(self.session, activity, fingerprint)
             if created:
                 sys.stdout.write("+")
             else:
                 sys.stdout.write(".")
             sys.stdout.flush()
+        if newest_start_date is not None:
+            last_start_date = get_sync_cursor(self.session, STRAVA_SYNC_SOURCE)
+            if not last_start_date or arrow.get(newest_start_date) > arrow.get(
+                last_start_date
+            ):
+                save_sync_cursor(self.session, STRAVA_SYNC_SOURCE, newest_start_date)
         self.session.commit()
 
-    def sync_from_data_dir(self, data_dir, file_suffix="gpx", activity_title_dict={}):
+    @staticmethod
+    def load_data_dir_tracks(data_dir, file_suffix="gpx", activity_title_dict={}):
+        """Parse the new files of data_dir, no db access."""
         loader = track_loader.TrackLoader()
         tracks = loader.load_tracks(
             data_dir, file_suffix=file_suffix, activity_title_dict=activity_title_dict
         )
         print(f"load {len(tracks)} tracks")
+        return tracks
+
+    @staticmethod
+    def load_file_tracks(
+        file_names, file_suffix="gpx", activity_title_dict={}, activity_metadata_dict={}
+    ):
+        """
+        Parse exactly the given files, no db access.
+        file_suffix None loads gpx, tcx and fit files by their own suffix.
+        """
+        loader = track_loader.TrackLoader()
+        tracks = loader.load_track_files(
+            file_names,
+            file_suffix=file_suffix,
+            activity_title_dict=activity_title_dict,
+            activity_metadata_dict=activity_metadata_dict,
+        )
+        print(f"load {len(tracks)} tracks")
+        return tracks
+
+    def sync_from_files(
+        self, file_paths, activity_title_dict={}, activity_metadata_dict={}
+    ):
+        """
+        Import exactly the given gpx/tcx/fit files, e.g. what a downloader
+        just fetched, so the cost follows the new files, not the folders.
+        """
+        file_paths = list(file_paths)
+        tracks = self.load_file_tracks(
+            file_paths, None, activity_title_dict, activity_metadata_dict
+        )
+        self.write_tracks(tracks, file_paths=file_paths)
+
+    def sync_from_data_dir(self, data_dir, file_suffix="gpx", activity_title_dict={}):
+        tracks = self.load_data_dir_tracks(data_dir, file_suffix, activity_title_dict)
+        self.write_tracks(tracks, data_dir, file_suffix)
+
+    def sync_from_data_dirs(self, data_dirs, activity_title_dict={}):
+        """
+        Import the new files of several folders, {file_suffix: data_dir},
+        in one pass: one load, one write, a run saved as fit and gpx once.
+        """
+        file_paths = track_loader.TrackLoader.list_data_dirs_files(data_dirs)
+        print(f"{len(file_paths)} new files in {', '.join(data_dirs.values())}")
+        self.sync_from_files(file_paths, activity_title_dict)
+
+    def write_tracks(self, tracks, data_dir=None, file_suffix="gpx", file_paths=None):
+        """
+        The files of the tracks are data_dir/<file name>, or when they come
+        from several folders, looked up by file name in file_paths.
+        """
         if not tracks:
             print("No tracks found.")
             return
 
         synced_files = []
+        paths_by_name = {os.path.basename(p): p for p in file_paths or []}
 
         for t in tracks:
             created = update_or_create_activity(
@@ -105,6 +197,21 @@ class Generator:
                 sys.stdout.write(".")
             synced_files.extend(t.file_names)
             sys.stdout.flush()
+            for file_name in t.file_names:
+                if file_name in paths_by_name:
+                    file_path = paths_by_name[file_name]
+                    file_type = track_loader.get_file_type(file_name)
+                else:
+                    file_path = os.path.join(data_dir, file_name)
+                    file_type = file_suffix
+                if os.path.isfile(file_path):
+                    update_or_create_activity_file(
+                        self.session,
+                        file_path,
+                        file_type,
+                        int(t.start_time.timestamp()),
+                        run_id=t.run_id,
+                    )
 
         save_synced_data_file_list(synced_files)
 
@@ -128,7 +235,11 @@ class Generator:
 
         self.session.commit()
 
-    def load(self):
+    def load(self, dedupe_seconds=0):
+        """
+        dedupe_seconds drops the same activity synced from several sources,
+        see dedupe_activities, before the streaks are counted.
+        """
         # if sub_type is not in the db, just add an empty string to it
         query = self.session.query(Activity).filter(Activity.distance > 0.1)
         if self.only_run:
@@ -136,13 +247,19 @@ class Generator:
 
         activities = query.order_by(Activity.start_date_local)
         activity_list = []
+        for activity in activities:
+            if not IGNORE_BEFORE_SAVING:
+                activity.summary_polyline = filter_out(activity.summary_polyline)  # type: ignore
+            activity_list.append(activity.to_dict())
+        if dedupe_seconds:
+            activity_list = dedupe_activities(activity_list, dedupe_seconds)
 
         streak = 0
         last_date = None
-        for activity in activities:
+        for activity in activity_list:
             # Determine running streak.
             date = datetime.datetime.strptime(
-                activity.start_date_local, "%Y-%m-%d %H:%M:%S"  # type: ignore
+                activity["start_date_local"], "%Y-%m-%d %H:%M:%S"
             ).date()
             if last_date is None:
                 streak = 1
@@ -153,11 +270,8 @@ class Generator:
             else:
                 assert date > last_date
                 streak = 1
-            activity.streak = streak  # type: ignore
+            activity["streak"] = streak
             last_date = date
-            if not IGNORE_BEFORE_SAVING:
-                activity.summary_polyline = filter_out(activity.summary_polyline)  # type: ignore
-            activity_list.append(activity.to_dict())
 
         return activity_list
 
@@ -1,9 +1,12 @@
 import datetime
+import hashlib
+import os
 import random
 import string
 
 from geopy.geocoders import options, Nominatim
 from sqlalchemy import (
+    Boolean,
     Column,
     Float,
     Integer,
@@ -64,6 +67,8 @@ class Activity(Base):
     average_heartrate = Column(Float)
     average_speed = Column(Float)
     elevation_gain = Column(Float)
+    # hash of the source fields, unchanged activities are skipped on sync
+    fingerprint = Column(String)
     streak = None
 
     def to_dict(self):
@@ -81,7 +86,88 @@ class Activity(Base):
         return out
 
 
-def update_or_create_activity(session, run_activity):
+class SyncCursor(Base):
+    """The newest start date each source has synced, the next sync starts from it."""
+
+    __tablename__ = "sync_cursors"
+
+    source = Column(String, primary_key=True)
+    last_start_date = Column(String)
+
+
+def get_sync_cursor(session, source):
+    cursor = session.query(SyncCursor).filter_by(source=source).first()
+    return cursor.last_start_date if cursor else None
+
+
+def save_sync_cursor(session, source, last_start_date):
+    cursor = session.query(SyncCursor).filter_by(source=source).first()
+    if not cursor:
+        cursor = SyncCursor(source=source)
+        session.add(cursor)
+    cursor.last_start_date = str(last_start_date)
+
+
+def get_activity_fingerprint(run_activity):
+    """Cheap hash of the fields update_or_create_activity writes."""
+    summary_polyline = run_activity.map and run_activity.map.summary_polyline or ""
+    values = (
+        run_activity.name,
+        float(run_activity.distance or 0),
+        str(run_activity.moving_time),
+        str(run_activity.elapsed_time),
+        run_activity.type,
+        run_activity.subtype,
+        run_activity.average_heartrate,
+        float(run_activity.average_speed or 0),
+        getattr(run_activity, "elevation_gain", None),
+        summary_polyline,
+    )
+    return hashlib.md5(repr(values).encode("utf-8")).hexdigest()
+
+
+class ActivityFile(Base):
+    """
+    Index of the activity files in the data folders,
+    so the start time of a file is read only once.
+    """
+
+    __tablename__ = "activity_files"
+
+    file_path = Column(String, primary_key=True)
+    file_type = Column(String, index=True)
+    size = Column(Integer)
+    mtime_ns = Column(Integer)
+    # unix timestamp in seconds, None if the file has no start time
+    start_time = Column(Integer, index=True)
+    run_id = Column(Integer)
+    uploaded = Column(Boolean, default=False)
+
+
+def update_or_create_activity_file(
+    session, file_path, file_type, start_time, run_id=None, stat=None
+):
+    stat = stat or os.stat(file_path)
+    activity_file = session.query(ActivityFile).filter_by(file_path=file_path).first()
+    if not activity_file:
+        activity_file = ActivityFile(file_path=file_path, uploaded=False)
+        session.add(activity_file)
+    elif (activity_file.size, activity_file.mtime_ns) != (
+        stat.st_size,
+        stat.st_mtime_ns,
+    ):
+        # the file changed, it is a new upload candidate
+        activity_file.uploaded = False
+    activity_file.file_type = file_type
+    activity_file.size = stat.st_size
+    activity_file.mtime_ns = stat.st_mtime_ns
+    activity_file.start_time = start_time
+    if run_id is not None:
+        activity_file.run_id = run_id
+    return activity_file
+
+
+def update_or_create_activity(session, run_activity, fingerprint=None):
     created = False
     try:
         activity = (
@@ -158,6 +244,8 @@ def update_or_create_activity(session, run_activity):
             activity.summary_polyline = (
                 run_activity.map and run_activity.map.summary_polyline or ""
             )
+        if fingerprint is not None:
+            activity.fingerprint = fingerprint
     except Exception as e:
         print(f"something wrong with {run_activity.id}")
         print(str(e))
@@ -1,39 +1,34 @@
 import argparse
 import os
-import time
 
 import gpxpy as mod_gpxpy
-from config import GPX_FOLDER
+from activity_file_index import get_files_to_upload, index_activity_files, mark_uploaded
+from config import GPX_FOLDER, SQL_FILE
+from generator.db import init_db
 from strava_sync import run_strava_sync
-from stravalib.exc import ActivityUploadFailed, RateLimitTimeout
-from utils import get_strava_last_time, make_strava_client, upload_file_to_strava
+from strava_upload_queue import StravaUploadQueue
+from utils import get_strava_last_time, make_strava_client
 
 
-def get_to_generate_files(last_time):
+def read_gpx_start_time(file_path):
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as r:
+        try:
+            gpx = mod_gpxpy.parse(r)
+        except Exception as e:
+            print(f"Something is wring with {file_path} err: {str(e)}")
+            return None
+    # if gpx file has no start time we ignore it.
+    start_time = gpx.get_time_bounds()[0]
+    return int(start_time.timestamp()) if start_time else None
+
+
+def get_to_generate_files(session, last_time, include_uploaded=False):
     """
     return to values one dict for upload
     and one sorted list for next time upload
     """
-    file_names = os.listdir(GPX_FOLDER)
-    gpx_files = []
-    for f in file_names:
-        if f.endswith(".gpx"):
-            file_path = os.path.join(GPX_FOLDER, f)
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as r:
-                try:
-                    gpx = mod_gpxpy.parse(r)
-                except Exception as e:
-                    print(f"Something is wring with {file_path} err: {str(e)}")
-                    continue
-                # if gpx file has no start time we ignore it.
-                if gpx.get_time_bounds()[0]:
-                    gpx_files.append((gpx, file_path))
-    gpx_files_dict = {
-        int(i[0].get_time_bounds()[0].timestamp()): i[1]
-        for i in gpx_files
-        if int(i[0].get_time_bounds()[0].timestamp()) > last_time
-    }
-    return sorted(list(gpx_files_dict.keys())), gpx_files_dict
+    index_activity_files(session, GPX_FOLDER, "gpx", read_gpx_start_time)
+    return get_files_to_upload(session, "gpx", last_time, include_uploaded)
 
 
 if __name__ == "__main__":
@@ -50,34 +45,25 @@ if __name__ == "__main__":
         help="if upload to strava all without check last time",
     )
     options = parser.parse_args()
-    # upload new tcx to strava
-    print("Need to load all gpx files maybe take some time")
+    # upload new gpx to strava
+    # only new or changed files are parsed to read their start time
+    session = init_db(SQL_FILE)
     last_time = 0
     client = make_strava_client(
         options.client_id, options.client_secret, options.strava_refresh_token
     )
     if not options.all:
         last_time = get_strava_last_time(client, is_milliseconds=False)
-    to_upload_time_list, to_upload_dict = get_to_generate_files(last_time)
-    index = 1
-    print(f"{len(to_upload_time_list)} gpx files is going to upload")
+    to_upload_time_list, to_upload_dict = get_to_generate_files(
+        session, last_time, include_uploaded=options.all
+    )
+    upload_queue = StravaUploadQueue(client)
     for i in to_upload_time_list:
-        gpx_file = to_upload_dict.get(i)
-        try:
-            upload_file_to_strava(client, gpx_file, "gpx")
-        except RateLimitTimeout as e:
-            timeout = e.timeout
-            print(f"Strava API Rate Limit Timeout. Retry in {timeout} seconds\n")
-            time.sleep(timeout)
-            # try previous again
-            upload_file_to_strava(client, gpx_file, "gpx")
-
-        except ActivityUploadFailed as e:
-            print(f"Upload faild error {str(e)}")
-        # spider rule
-        time.sleep(1)
+        upload_queue.add(to_upload_dict.get(i), "gpx")
+    print(f"{len(upload_queue.entries)} gpx files is going to upload")
+    for gpx_file in upload_queue.run():
+        mark_uploaded(session, gpx_file)
 
-    time.sleep(10)
     run_strava_sync(
         options.client_id, options.client_secret, options.strava_refresh_token
     )
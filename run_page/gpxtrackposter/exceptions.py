@@ -20,3 +20,9 @@ class ParameterError(PosterError):
     "Something's wrong with user supplied parameters"
 
     pass
+
+
+class FitReadError(PosterError):
+    "The fast FIT reader can not read this file, the FIT SDK will"
+
+    pass
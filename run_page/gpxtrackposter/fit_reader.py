@@ -0,0 +1,196 @@
+"""
+Fast FIT reader for Track.load_fit.
+
+A track only needs the first session, the device of file_id and the
+positions of the records, garmin_fit_sdk decodes every message into dicts.
+Here the messages are walked by the sizes of their definitions: the wanted
+session and file_id fields are unpacked, the offsets of the record positions
+are collected and read with numpy at the end, everything else is skipped.
+
+The result looks like the sdk's (scaled values, enums as strings, invalid
+values left out) with the positions as an int32 (n, 2) array of semicircles
+under "record_positions". Anything unexpected raises FitReadError so the
+caller can fall back to the sdk, which also checks the CRC.
+"""
+
+import struct
+
+import numpy as np
+from garmin_fit_sdk.fit import BASE_TYPE_DEFINITIONS, BASE_TYPE_MASK
+from garmin_fit_sdk.fit import NUMERIC_FIELD_TYPES
+from garmin_fit_sdk.profile import Profile
+
+from .exceptions import FitReadError
+
+FILE_ID_MESG_NUM = 0
+SESSION_MESG_NUM = 18
+RECORD_MESG_NUM = 20
+POSITION_LAT_FIELD_NUM = 0
+POSITION_LONG_FIELD_NUM = 1
+SINT32 = 0x05
+SINT32_INVALID = 0x7FFFFFFF
+
+COMPRESSED_HEADER_MASK = 0x80
+MESG_DEFINITION_MASK = 0x40
+DEV_DATA_MASK = 0x20
+LOCAL_MESG_NUM_MASK = 0x0F
+
+# the fields Track._load_fit_data reads
+DECODED_FIELDS = {
+    FILE_ID_MESG_NUM: (1, 2),  # manufacturer, product
+    SESSION_MESG_NUM: (2, 5, 6, 7, 8, 9, 14, 16, 22, 59, 124),
+}
+MESSAGES_KEYS = {FILE_ID_MESG_NUM: "file_id_mesgs", SESSION_MESG_NUM: "session_mesgs"}
+
+
+def _field_value(field_profile, raw_value):
+    """Same conversions as the sdk: enum names, then scale and offset."""
+    value = Profile["types"].get(field_profile["type"], {}).get(raw_value, raw_value)
+    if field_profile["type"] in NUMERIC_FIELD_TYPES:
+        scale = field_profile["scale"][0] if field_profile["scale"] else 1
+        offset = field_profile["offset"][0] if field_profile["offset"] else 0
+        value = (raw_value / scale if scale != 1 else raw_value) - offset
+    return value
+
+
+def _decode_message(data, pos, definition):
+    global_mesg_num, _, endian, fields = definition
+    profile_fields = Profile["messages"][global_mesg_num]["fields"]
+    raw_values, message = {}, {}
+    for field_num, offset, size, base_type in fields:
+        base_type_definition = BASE_TYPE_DEFINITIONS[base_type]
+        if size != base_type_definition["size"]:
+            continue
+        raw_value = struct.unpack_from(
+            endian + base_type_definition["type_code"], data, pos + offset
+        )[0]
+        if raw_value == base_type_definition["invalid"]:
+            continue
+        field_profile = profile_fields[field_num]
+        raw_values[field_num] = raw_value
+        message[field_profile["name"]] = _field_value(field_profile, raw_value)
+    # e.g. garmin_product, named after the manufacturer
+    for field_num, raw_value in raw_values.items():
+        for sub_field in profile_fields[field_num]["sub_fields"]:
+            if any(
+                raw_values.get(m["num"]) == m["raw_value"] for m in sub_field["map"]
+            ):
+                message[sub_field["name"]] = _field_value(sub_field, raw_value)
+    # the sdk expands avg_speed into enhanced_avg_speed
+    if "avg_speed" in message and "enhanced_avg_speed" not in message:
+        message["enhanced_avg_speed"] = message["avg_speed"]
+    return message
+
+
+def _read_definition(data, pos, header):
+    """pos is the record header, return (definition, position after it)."""
+    big_endian = data[pos + 2] == 1
+    global_mesg_num = int.from_bytes(
+        data[pos + 3 : pos + 5], "big" if big_endian else "little"
+    )
+    num_fields = data[pos + 5]
+    pos += 6
+    wanted = DECODED_FIELDS.get(global_mesg_num, ())
+    fields = []
+    size = 0
+    for _ in range(num_fields):
+        field_num, field_size = data[pos], data[pos + 1]
+        base_type = data[pos + 2] & BASE_TYPE_MASK
+        if base_type not in BASE_TYPE_DEFINITIONS:
+            raise FitReadError("Invalid field definition base type")
+        if global_mesg_num == RECORD_MESG_NUM or field_num in wanted:
+            fields.append((field_num, size, field_size, base_type))
+        size += field_size
+        pos += 3
+    if header & DEV_DATA_MASK:
+        num_dev_fields = data[pos]
+        pos += 1
+        size += sum(data[pos + 3 * i + 1] for i in range(num_dev_fields))
+        pos += 3 * num_dev_fields
+    return (global_mesg_num, size, ">" if big_endian else "<", fields), pos
+
+
+def _record_position_offsets(definition):
+    """Offsets of position_lat and position_long in a record, or None."""
+    offsets = {}
+    for field_num, offset, size, base_type in definition[3]:
+        if field_num in (POSITION_LAT_FIELD_NUM, POSITION_LONG_FIELD_NUM):
+            if size != 4 or base_type != SINT32:
+                raise FitReadError("Unexpected record position field")
+            offsets[field_num] = offset
+    if len(offsets) != 2:
+        return None
+    return offsets[POSITION_LAT_FIELD_NUM], offsets[POSITION_LONG_FIELD_NUM]
+
+
+def _read_positions(data, lat_offsets, lng_offsets, big_endian):
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    byte_index = np.arange(4)
+    columns = []
+    for offsets in (lat_offsets, lng_offsets):
+        raw = buffer[np.asarray(offsets, dtype=np.int64)[:, None] + byte_index]
+        big_endian_rows = np.asarray(big_endian, dtype=bool)
+        raw[big_endian_rows] = raw[big_endian_rows, ::-1]
+        columns.append(raw.view("<i4").ravel())
+    positions = np.column_stack(columns)
+    valid = (positions != SINT32_INVALID).all(axis=1)
+    return positions[valid]
+
+
+def read_fit(data):
+    messages = {}
+    lat_offsets, lng_offsets, big_endian = [], [], []
+    pos = 0
+    try:
+        # a file may hold several chained fit files
+        while pos < len(data):
+            header_size = data[pos]
+            if header_size < 12 or data[pos + 8 : pos + 12] != b".FIT":
+                raise FitReadError("The file is not a fit file.")
+            end = pos + header_size + int.from_bytes(data[pos + 4 : pos + 8], "little")
+            if end + 2 > len(data):
+                raise FitReadError("The file is truncated.")
+            pos += header_size
+            definitions = {}
+            while pos < end:
+                header = data[pos]
+                if header & COMPRESSED_HEADER_MASK:
+                    # not supported by the sdk either
+                    raise FitReadError("Compressed timestamp message")
+                if header & MESG_DEFINITION_MASK:
+                    definition, pos = _read_definition(data, pos, header)
+                    if definition[0] == RECORD_MESG_NUM:
+                        definition += (_record_position_offsets(definition),)
+                    definitions[header & LOCAL_MESG_NUM_MASK] = definition
+                    continue
+                definition = definitions[header & LOCAL_MESG_NUM_MASK]
+                pos += 1
+                global_mesg_num = definition[0]
+                if global_mesg_num == RECORD_MESG_NUM:
+                    if definition[4] is not None:
+                        lat_offsets.append(pos + definition[4][0])
+                        lng_offsets.append(pos + definition[4][1])
+                        big_endian.append(definition[2] == ">")
+                elif global_mesg_num in MESSAGES_KEYS:
+                    messages.setdefault(MESSAGES_KEYS[global_mesg_num], []).append(
+                        _decode_message(data, pos, definition)
+                    )
+                pos += definition[1]
+            if pos != end:
+                raise FitReadError("A message overruns the data size.")
+            # skip the crc
+            pos = end + 2
+    except (IndexError, KeyError, struct.error) as e:
+        raise FitReadError(f"Broken fit file: {e!r}")
+    if lat_offsets:
+        messages["record_positions"] = _read_positions(
+            data, lat_offsets, lng_offsets, big_endian
+        )
+    else:
+        messages["record_positions"] = np.empty((0, 2), dtype=np.int32)
+    return messages
+
+
+def read_fit_file(file_name):
+    with open(file_name, "rb") as f:
+        return read_fit(f.read())
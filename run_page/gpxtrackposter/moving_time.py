@@ -0,0 +1,112 @@
+"""
+Moving time of a list of trackpoints.
+
+The point times are converted once to an int64 array of epoch milliseconds and
+every gap between two points is classified at once with numpy: a gap longer
+than `seconds_threshold`, or slower than `min_speed` when distances are given,
+is a pause, everything else is moving.
+"""
+
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+PAUSE_SECONDS_THRESHOLD = int(os.getenv("PAUSE_SECONDS_THRESHOLD", 10))
+# m/s, 0 means a gap is never a pause because of its speed
+PAUSE_MIN_SPEED = float(os.getenv("PAUSE_MIN_SPEED", 0))
+
+EARTH_RADIUS = 6371008.8
+
+# seconds, pauses is a list of (start, end) epoch seconds
+MovingTime = namedtuple("MovingTime", "moving_time elapsed_time pauses")
+
+
+def epoch_ms(times):
+    """datetimes -> int64 epoch milliseconds"""
+    return np.fromiter(
+        (round(t.timestamp() * 1000) for t in times), dtype=np.int64, count=len(times)
+    )
+
+
+def cumulative_distances(lats, lngs):
+    """Haversine distance in meters from the first point, for every point."""
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs = np.radians(np.asarray(lngs, dtype=np.float64))
+    a = (
+        np.sin(np.diff(lats) / 2) ** 2
+        + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(np.diff(lngs) / 2) ** 2
+    )
+    steps = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+
+def calc_moving_time(
+    times,
+    seconds_threshold=PAUSE_SECONDS_THRESHOLD,
+    distances=None,
+    min_speed=PAUSE_MIN_SPEED,
+):
+    """
+    times: epoch milliseconds in track order, distances: cumulative meters
+    per point, only needed for min_speed.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) < 2:
+        return MovingTime(0, 0, [])
+    gaps = np.diff(times)
+    moving = gaps <= seconds_threshold * 1000
+    if min_speed and distances is not None:
+        steps = np.diff(np.asarray(distances, dtype=np.float64))
+        # a gap of 0ms or without a distance does not stop the run
+        moving &= (
+            (gaps == 0)
+            | np.isnan(steps)
+            | (steps * 1000 >= min_speed * np.maximum(gaps, 1))
+        )
+
+    pause_index = np.flatnonzero(~moving)
+    pauses = []
+    if len(pause_index):
+        # consecutive paused gaps are one pause
+        breaks = np.flatnonzero(np.diff(pause_index) > 1)
+        starts = pause_index[np.concatenate(([0], breaks + 1))]
+        ends = pause_index[np.concatenate((breaks, [len(pause_index) - 1]))] + 1
+        pauses = [
+            (int(times[s]) / 1000, int(times[e]) / 1000) for s, e in zip(starts, ends)
+        ]
+    return MovingTime(
+        int(gaps[moving].sum()) / 1000,
+        int(times[-1] - times[0]) / 1000,
+        pauses,
+    )
+
+
+def calc_trackpoints_moving_time(
+    trackpoints,
+    seconds_threshold=PAUSE_SECONDS_THRESHOLD,
+    min_speed=PAUSE_MIN_SPEED,
+):
+    """
+    For gpx points (latitude/longitude) and tcx points (distance, or
+    latitude/longitude), a point without time makes the whole list 0.
+    """
+    if any(p.time is None for p in trackpoints):
+        return MovingTime(0, 0, [])
+    distances = None
+    if min_speed and trackpoints:
+        if getattr(trackpoints[0], "distance", None) is not None:
+            distances = [
+                math.nan if p.distance is None else p.distance for p in trackpoints
+            ]
+        elif all(p.latitude is not None for p in trackpoints):
+            distances = cumulative_distances(
+                [p.latitude for p in trackpoints], [p.longitude for p in trackpoints]
+            )
+    return calc_moving_time(
+        epoch_ms([p.time for p in trackpoints]),
+        seconds_threshold,
+        distances,
+        min_speed,
+    )
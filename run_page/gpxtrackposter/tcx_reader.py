@@ -0,0 +1,158 @@
+"""
+Streaming TCX reader for Track.load_tcx.
+
+tcxreader builds an object per trackpoint with every extension parsed, a
+track only needs a few columns. Here the trackpoints are read with lxml
+iterparse straight into columns and freed as soon as they are read.
+
+It reads the points TCXReader().read keeps by default (only_gps: points
+without longitude are left out) and reports the same totals: distance is
+the sum of the laps, hr_avg and ascent come from the kept points.
+"""
+
+import datetime
+from collections import namedtuple
+
+import numpy as np
+from lxml import etree
+
+TCX_NS = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+ACTIVITY = TCX_NS + "Activity"
+LAP = TCX_NS + "Lap"
+TRACK = TCX_NS + "Track"
+TRACKPOINT = TCX_NS + "Trackpoint"
+TIME = TCX_NS + "Time"
+POSITION = TCX_NS + "Position"
+LATITUDE = TCX_NS + "LatitudeDegrees"
+LONGITUDE = TCX_NS + "LongitudeDegrees"
+ALTITUDE = TCX_NS + "AltitudeMeters"
+DISTANCE = TCX_NS + "DistanceMeters"
+HEART_RATE = TCX_NS + "HeartRateBpm"
+CADENCE = TCX_NS + "Cadence"
+
+# the formats tcxreader tries, "Z" times are naive like there
+TIME_FORMATS = (
+    "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y-%m-%dT%H:%M:%S.%f%z",
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%dT%H:%M:%S%z",
+)
+
+# times is a list of datetimes, the other point columns are float arrays
+# with nan for a missing value
+TCXData = namedtuple(
+    "TCXData",
+    "times latitudes longitudes altitudes distances heart_rates cadences "
+    "distance start_time end_time duration hr_avg ascent",
+)
+
+
+def parse_time(text):
+    try:
+        if text.endswith("Z"):
+            return datetime.datetime.fromisoformat(text[:-1])
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, time_format)
+        except ValueError:
+            continue
+    raise ValueError(f"Cannot parse time {text!r}")
+
+
+def _float(text):
+    try:
+        return float(text)
+    except (ValueError, TypeError):
+        return None
+
+
+def _int(text):
+    # hr and cadence are whole numbers in tcxreader
+    value = _float(text)
+    return None if value is None else float(int(value))
+
+
+def _read_trackpoint(trackpoint):
+    time = latitude = longitude = altitude = distance = None
+    heart_rate = cadence = None
+    for child in trackpoint:
+        tag = child.tag
+        if tag == TIME:
+            time = parse_time(child.text)
+        elif tag == POSITION:
+            for position in child:
+                if position.tag == LATITUDE:
+                    latitude = _float(position.text)
+                elif position.tag == LONGITUDE:
+                    longitude = _float(position.text)
+        elif tag == ALTITUDE:
+            altitude = _float(child.text)
+        elif tag == DISTANCE:
+            distance = _float(child.text)
+        elif tag == HEART_RATE:
+            for value in child:
+                heart_rate = _int(value.text)
+        elif tag == CADENCE:
+            cadence = _int(child.text)
+    return time, latitude, longitude, altitude, distance, heart_rate, cadence
+
+
+def _column(values):
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+def read_tcx(file_name):
+    points = []
+    distance = 0.0
+    for _, elem in etree.iterparse(file_name, events=("end",), tag=(TRACKPOINT, LAP)):
+        parent = elem.getparent()
+        if elem.tag == LAP:
+            if parent is not None and parent.tag == ACTIVITY:
+                for child in elem:
+                    if child.tag == DISTANCE:
+                        distance += float(child.text)
+            elem.clear()
+            continue
+        # only the points of laps, not of courses
+        if parent is None or parent.tag != TRACK or parent.getparent().tag != LAP:
+            continue
+        point = _read_trackpoint(elem)
+        if point[2] is not None:
+            points.append(point)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+    columns = list(zip(*points)) or [()] * 7
+    times = list(columns[0])
+    latitudes, longitudes, altitudes, distances, heart_rates, cadences = (
+        _column(c) for c in columns[1:]
+    )
+
+    start_time = end_time = None
+    duration = 0
+    if len(times) > 2:
+        start_time, end_time = times[0], times[-1]
+        duration = abs((start_time - end_time).total_seconds())
+    known_heart_rates = heart_rates[~np.isnan(heart_rates)]
+    hr_avg = float(known_heart_rates.mean()) if len(known_heart_rates) else None
+    altitude_steps = np.diff(altitudes[~np.isnan(altitudes)])
+    ascent = float(altitude_steps[altitude_steps > 0].sum())
+    return TCXData(
+        times,
+        latitudes,
+        longitudes,
+        altitudes,
+        distances,
+        heart_rates,
+        cadences,
+        distance,
+        start_time,
+        end_time,
+        duration,
+        hr_avg,
+        ascent,
+    )
@@ -12,16 +12,28 @@ from collections import namedtuple
 
 import gpxpy as mod_gpxpy
 import lxml
+import numpy as np
 import polyline
 import s2sphere as s2
 from garmin_fit_sdk import Decoder, Stream
 from garmin_fit_sdk.util import FIT_EPOCH_S
 from polyline_processor import filter_out
 from rich import print
-from tcxreader.tcxreader import TCXReader
 
-from .exceptions import TrackLoadError
-from .utils import parse_datetime_to_local, get_normalized_sport_type
+from .exceptions import FitReadError, TrackLoadError
+from .fit_reader import read_fit_file
+from .moving_time import (
+    PAUSE_SECONDS_THRESHOLD,
+    calc_moving_time,
+    calc_trackpoints_moving_time,
+    epoch_ms,
+)
+from .tcx_reader import read_tcx
+from .utils import (
+    get_normalized_sport_type,
+    parse_datetime_to_local,
+    timezone_resolver,
+)
 
 start_point = namedtuple("start_point", "lat lon")
 run_map = namedtuple("polyline", "summary_polyline")
@@ -56,6 +68,18 @@ class Track:
         self.type = "Run"
         self.subtype = None  # for fit file
         self.device = ""
+        # the start point of the local time conversion the loader still owes
+        self.local_times_pending = False
+        self.local_times_point = None
+
+    def set_local_times(self, point):
+        if timezone_resolver.deferred:
+            self.local_times_pending = True
+            self.local_times_point = point
+            return
+        self.start_time_local, self.end_time_local = parse_datetime_to_local(
+            self.start_time, self.end_time, point
+        )
 
     def load_gpx(self, file_name):
         """
@@ -81,10 +105,9 @@ class Track:
             self.file_names = [os.path.basename(file_name)]
             # Handle empty tcx files
             # (for example, treadmill runs pulled via garmin-connect-export)
-            tcx = TCXReader()
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty TCX file")
-            self._load_tcx_data(tcx.read(file_name), file_name=file_name)
+            self._load_tcx_data(read_tcx(file_name), file_name=file_name)
         except Exception as e:
             print(
                 f"Something went wrong when loading TCX. for file {self.file_names[0]}, we just ignore this file and continue"
@@ -98,17 +121,21 @@ class Track:
             # (for example, treadmill runs pulled via garmin-connect-export)
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty FIT file")
-            stream = Stream.from_file(file_name)
-            decoder = Decoder(stream)
-            messages, errors = decoder.read(convert_datetimes_to_dates=False)
-            if errors:
-                print(
-                    f"FIT file read fail: {errors}. The file appears to be corrupted and will be removed."
-                )
-                os.remove(file_name)
-                return
+            try:
+                messages = read_fit_file(file_name)
+            except FitReadError:
+                # the sdk checks the file, a corrupted one is removed
+                stream = Stream.from_file(file_name)
+                decoder = Decoder(stream)
+                messages, errors = decoder.read(convert_datetimes_to_dates=False)
+                if errors:
+                    print(
+                        f"FIT file read fail: {errors}. The file appears to be corrupted and will be removed."
+                    )
+                    os.remove(file_name)
+                    return
             if (
-                messages.get("session_mesgs") is None
+                not messages.get("session_mesgs")
                 or messages.get("session_mesgs")[0].get("total_distance") is None
             ):
                 print(
@@ -161,7 +188,7 @@ class Track:
 
     def _load_tcx_data(self, tcx, file_name):
         self.length = float(tcx.distance)
-        time_values = [i.time for i in tcx.trackpoints]
+        time_values = tcx.times
         if not time_values:
             raise TrackLoadError("Track is empty.")
 
@@ -170,12 +197,12 @@ class Track:
         elapsed_time = tcx.duration or int(
             self.end_time.timestamp() - self.start_time.timestamp()
         )
-        moving_time = self._calc_moving_time(tcx.trackpoints, 10)
+        moving_time = self._calc_columns_moving_time(time_values, tcx.distances)
         moving_time = moving_time or elapsed_time
         self.run_id = self.__make_run_id(self.start_time)
         self.average_heartrate = tcx.hr_avg
         polyline_container = []
-        position_values = [(i.latitude, i.longitude) for i in tcx.trackpoints]
+        position_values = np.column_stack((tcx.latitudes, tcx.longitudes)).tolist()
         if not position_values and int(self.length) == 0:
             raise Exception(
                 f"This {file_name} TCX file do not contain distance and position values we ignore it"
@@ -183,11 +210,9 @@ class Track:
         if position_values:
             line = [s2.LatLng.from_degrees(p[0], p[1]) for p in position_values]
             self.polylines.append(line)
-            polyline_container.extend([[p[0], p[1]] for p in position_values])
+            polyline_container.extend(position_values)
             self.polyline_container = polyline_container
-            self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, polyline_container[0]
-            )
+            self.set_local_times(polyline_container[0])
             # get start point
             try:
                 self.start_latlng = start_point(*polyline_container[0])
@@ -203,19 +228,24 @@ class Track:
             "average_speed": self.length / moving_time if moving_time else 0,
         }
 
-    def _calc_moving_time(self, trackpoints, seconds_threshold=10):
-        moving_time = 0
+    def _calc_moving_time(self, trackpoints, seconds_threshold=PAUSE_SECONDS_THRESHOLD):
         try:
-            start_time = self.start_time
-            for i in range(1, len(trackpoints)):
-                if trackpoints[i].time - trackpoints[i - 1].time <= datetime.timedelta(
-                    seconds=seconds_threshold
-                ):
-                    moving_time += (
-                        trackpoints[i].time.timestamp() - start_time.timestamp()
-                    )
-                start_time = trackpoints[i].time
-            return int(moving_time)
+            return int(
+                calc_trackpoints_moving_time(trackpoints, seconds_threshold).moving_time
+            )
+        except Exception as e:
+            print(f"Error calculating moving time: {e}")
+            return 0
+
+    def _calc_columns_moving_time(
+        self, times, distances, seconds_threshold=PAUSE_SECONDS_THRESHOLD
+    ):
+        try:
+            return int(
+                calc_moving_time(
+                    epoch_ms(times), seconds_threshold, distances
+                ).moving_time
+            )
         except Exception as e:
             print(f"Error calculating moving time: {e}")
             return 0
@@ -231,9 +261,7 @@ class Track:
             if end_time_str:
                 self.end_time = datetime.datetime.fromisoformat(end_time_str)
             if self.start_time and self.end_time:
-                self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                    self.start_time, self.end_time, None
-                )
+                self.set_local_times(None)
         # use timestamp as id
         self.run_id = self.__make_run_id(self.start_time)
         if self.start_time is None:
@@ -244,7 +272,7 @@ class Track:
         moving_time = 0
         for t in gpx.tracks:
             for s in t.segments:
-                moving_time += self._calc_moving_time(s.points, 10)
+                moving_time += self._calc_moving_time(s.points)
         gpx.simplify()
         if self.length == 0:
             self._load_gpx_extensions_data(gpx)
@@ -290,9 +318,7 @@ class Track:
         except Exception as e:
             print(f"Error getting start point: {e}")
             pass
-        self.start_time_local, self.end_time_local = parse_datetime_to_local(
-            self.start_time, self.end_time, polyline_container[0]
-        )
+        self.set_local_times(polyline_container[0])
         self.polyline_str = polyline.encode(polyline_container)
         self.average_heartrate = (
             sum(heart_rate_list) / len(heart_rate_list) if heart_rate_list else None
@@ -363,8 +389,6 @@ class Track:
         )
 
     def _load_fit_data(self, fit: dict):
-        _polylines = []
-        self.polyline_container = []
         message = fit["session_mesgs"][0]
         self.start_time = datetime.datetime.fromtimestamp(
             (message["start_time"] + FIT_EPOCH_S), tz=timezone.utc
@@ -404,23 +428,27 @@ class Track:
             if message["enhanced_avg_speed"]
             else message["avg_speed"]
         )
-        for record in fit["record_mesgs"]:
-            if "position_lat" in record and "position_long" in record:
-                lat = record["position_lat"] / SEMICIRCLE
-                lng = record["position_long"] / SEMICIRCLE
-                _polylines.append(s2.LatLng.from_degrees(lat, lng))
-                self.polyline_container.append([lat, lng])
+        positions = fit.get("record_positions")
+        if positions is None:
+            # decoded by the sdk
+            positions = [
+                (record["position_lat"], record["position_long"])
+                for record in fit.get("record_mesgs", [])
+                if "position_lat" in record and "position_long" in record
+            ]
+        self.polyline_container = (
+            (np.asarray(positions, dtype=np.float64).reshape(-1, 2) / SEMICIRCLE)
+        ).tolist()
+        _polylines = [
+            s2.LatLng.from_degrees(lat, lng) for lat, lng in self.polyline_container
+        ]
         if self.polyline_container:
-            self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, self.polyline_container[0]
-            )
+            self.set_local_times(self.polyline_container[0])
             self.start_latlng = start_point(*self.polyline_container[0])
             self.polylines.append(_polylines)
             self.polyline_str = polyline.encode(self.polyline_container)
         else:
-            self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, None
-            )
+            self.set_local_times(None)
 
         # The FIT file created by Garmin
         if "file_id_mesgs" in fit:
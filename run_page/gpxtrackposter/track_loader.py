@@ -17,6 +17,7 @@ from generator.db import Activity, init_db
 
 from .exceptions import ParameterError, TrackLoadError
 from .track import Track
+from .utils import timezone_resolver
 from .year_range import YearRange
 
 from synced_data_file_logger import load_synced_file_list
@@ -54,6 +55,68 @@ def load_fit_file(file_name, activity_title_dict={}):
     return t
 
 
+def _defer_local_times():
+    # runs in each loader worker, see localize_tracks
+    timezone_resolver.deferred = True
+
+
+def localize_tracks(tracks):
+    """Convert the start/end times the workers left in utc in one batch."""
+    pending = [t for t in tracks if t.local_times_pending]
+    local_times = timezone_resolver.localize_many(
+        [(t.start_time, t.end_time, t.local_times_point) for t in pending]
+    )
+    for t, (start_time_local, end_time_local) in zip(pending, local_times):
+        t.start_time_local, t.end_time_local = start_time_local, end_time_local
+        t.local_times_pending = False
+
+
+LOAD_FUNC_DICT = {
+    "gpx": load_gpx_file,
+    "tcx": load_tcx_file,
+    "fit": load_fit_file,
+}
+
+
+def load_file_by_suffix(file_name, activity_title_dict={}):
+    """Load a gpx, tcx or fit file as a track, the loader is chosen by suffix"""
+    file_suffix = get_file_type(file_name)
+    if file_suffix not in LOAD_FUNC_DICT:
+        raise TrackLoadError(f"Unsupported file type: {file_name}")
+    return LOAD_FUNC_DICT[file_suffix](file_name, activity_title_dict)
+
+
+# the same run saved in several formats keeps the richest file
+FILE_TYPE_PRIORITY = {"gpx": 0, "tcx": 1, "fit": 2}
+
+
+def get_file_type(file_name):
+    return file_name.rsplit(".", 1)[-1].lower()
+
+
+def _file_type_priority(track):
+    return FILE_TYPE_PRIORITY.get(get_file_type(track.file_names[0]), -1)
+
+
+def dedupe_tracks_by_run_id(tracks):
+    """
+    Keep one track per run_id, fit over tcx over gpx. The files of the
+    dropped tracks are added to the kept one, so they are marked synced too.
+    """
+    kept = {}
+    for t in tracks:
+        if t.run_id not in kept:
+            kept[t.run_id] = t
+            continue
+        best, dropped = kept[t.run_id], t
+        if _file_type_priority(t) > _file_type_priority(best):
+            best, dropped = t, best
+            kept[t.run_id] = best
+        log.info(f"{dropped.file_names[0]}: same run as {best.file_names[0]}, skipping")
+        best.file_names.extend(dropped.file_names)
+    return list(kept.values())
+
+
 class TrackLoader:
     """
     Attributes:
@@ -69,31 +132,64 @@ class TrackLoader:
         self.min_length = 100
         self.special_file_names = []
         self.year_range = YearRange()
-        self.load_func_dict = {
-            "gpx": load_gpx_file,
-            "tcx": load_tcx_file,
-            "fit": load_fit_file,
-        }
+        self.load_func_dict = LOAD_FUNC_DICT
 
     def load_tracks(self, data_dir, file_suffix="gpx", activity_title_dict={}):
         """Load tracks data_dir and return as a List of tracks"""
         file_names = [x for x in self._list_data_files(data_dir, file_suffix)]
         print(f"{file_suffix.upper()} files: {len(file_names)}")
+        return self.load_track_files(file_names, file_suffix, activity_title_dict)
 
+    def load_track_files(
+        self,
+        file_names,
+        file_suffix="gpx",
+        activity_title_dict={},
+        activity_metadata_dict={},
+    ):
+        """
+        Load the given files as a List of tracks, data_dir is not listed.
+        With file_suffix None every file is loaded by its own suffix and
+        a run found in several formats is kept once.
+        activity_metadata_dict maps a file id to track attributes to set,
+        e.g. {"1234": {"type": "Ride"}}.
+        """
         tracks = []
 
+        if file_suffix is None:
+            load_func = load_file_by_suffix
+        else:
+            load_func = self.load_func_dict.get(file_suffix, load_gpx_file)
         loaded_tracks = self._load_data_tracks(
-            file_names,
-            self.load_func_dict.get(file_suffix, load_gpx_file),
-            activity_title_dict,
+            file_names, load_func, activity_title_dict
         )
 
+        for file_name, t in loaded_tracks.items():
+            file_id = os.path.basename(file_name).split(".")[0]
+            for key, value in activity_metadata_dict.get(file_id, {}).items():
+                setattr(t, key, value)
         tracks.extend(loaded_tracks.values())
         log.info(f"Conventionally loaded tracks: {len(loaded_tracks)}")
 
         tracks = self._filter_tracks(tracks)
         # filter out tracks with length < min_length
-        return [t for t in tracks if t.length >= self.min_length]
+        tracks = [t for t in tracks if t.length >= self.min_length]
+        if file_suffix is None:
+            tracks = dedupe_tracks_by_run_id(tracks)
+        return tracks
+
+    def load_track_file(self, file_name, file_suffix="gpx", activity_title_dict={}):
+        """Load one file as a track, None when it fails or is filtered out"""
+        load_func = self.load_func_dict.get(file_suffix, load_gpx_file)
+        try:
+            t = load_func(file_name, activity_title_dict)
+        except TrackLoadError as e:
+            log.error(f"Error while loading {file_name}: {e}")
+            return None
+        tracks = self._filter_tracks([t])
+        if not tracks or tracks[0].length < self.min_length:
+            return None
+        return tracks[0]
 
     def load_tracks_from_db(self, sql_file, is_grid=False):
         session = init_db(sql_file)
@@ -138,7 +234,9 @@ class TrackLoader:
         TODO refactor with _load_tcx_tracks
         """
         tracks = {}
-        with concurrent.futures.ProcessPoolExecutor() as executor:
+        with concurrent.futures.ProcessPoolExecutor(
+            initializer=_defer_local_times
+        ) as executor:
             future_to_file_name = {
                 executor.submit(load_func, file_name, activity_title_dict): file_name
                 for file_name in file_names
@@ -151,8 +249,19 @@ class TrackLoader:
                 log.error(f"Error while loading {file_name}: {e}")
             else:
                 tracks[file_name] = t
+        localize_tracks(tracks.values())
         return tracks
 
+    @staticmethod
+    def list_data_dirs_files(data_dirs):
+        """The not yet synced files of {file_suffix: data_dir}, in one list."""
+        file_names = []
+        for file_suffix, data_dir in data_dirs.items():
+            if not os.path.isdir(data_dir):
+                continue
+            file_names.extend(TrackLoader._list_data_files(data_dir, file_suffix))
+        return file_names
+
     @staticmethod
     def _list_data_files(data_dir, file_suffix):
         synced_files = load_synced_file_list()
@@ -7,7 +7,7 @@
 
 import locale
 import math
-from datetime import datetime
+from functools import lru_cache
 from typing import List, Optional, Tuple
 
 import colour
@@ -119,24 +119,70 @@ def format_float(f):
     return locale.format_string("%.1f", f)
 
 
-def parse_datetime_to_local(start_time, end_time, point):
-    if not point:
-        timezone = "Asia/Shanghai"
-    else:
+DEFAULT_TIMEZONE = "Asia/Shanghai"
+
+
+def lookup_timezone(lat, lng):
+    try:
+        return get_tz(lng=lng, lat=lat)
+    except Exception as e:
+        # just a little trick when tzfpy support windows will delete this
+        print(f"tzfpy error: {e} fallback to timezonefinder")
+        return tf.timezone_at(lng=lng, lat=lat)
+
+
+@lru_cache(maxsize=None)
+def get_timezone(timezone_name):
+    return pytz.timezone(timezone_name)
+
+
+def get_utc_offset(time, timezone_name):
+    """The offset of the timezone at that time (naive means utc), not today's."""
+    if time.tzinfo is None:
+        time = pytz.utc.localize(time)
+    return time.astimezone(get_timezone(timezone_name)).utcoffset()
+
+
+class TimezoneResolver:
+    """
+    The timezone of a start point is looked up once per cell of about 1km
+    (lat and lng rounded to `precision` decimals), point in polygon lookups
+    are the slow part of converting a track to local time.
+    """
+
+    def __init__(self, precision=2):
+        self.precision = precision
+        self.timezone_names = {}
+        # set in the loader workers: tracks keep their start point and the
+        # loader converts them in one batch, see Track.set_local_times
+        self.deferred = False
+
+    def get_timezone_name(self, point):
+        if not point:
+            return DEFAULT_TIMEZONE
+        key = (round(point[0], self.precision), round(point[1], self.precision))
+        if key not in self.timezone_names:
+            self.timezone_names[key] = lookup_timezone(*key)
+        return self.timezone_names[key]
+
+    def localize(self, start_time, end_time, point):
         # just parse the start time, because start/end maybe different
         offset = start_time.utcoffset()
-        if offset:
+        if point and offset:
             return start_time + offset, end_time + offset
-        lat, lng = point
-        try:
-            timezone = get_tz(lng=lng, lat=lat)
-        except Exception as e:
-            # just a little trick when tzfpy support windows will delete this
-            print(f"tzfpy error: {e} fallback to timezonefinder")
-            lat, lng = point
-            timezone = tf.timezone_at(lng=lng, lat=lat)
-    tc_offset = datetime.now(pytz.timezone(timezone)).utcoffset()
-    return start_time + tc_offset, end_time + tc_offset
+        offset = get_utc_offset(start_time, self.get_timezone_name(point))
+        return start_time + offset, end_time + offset
+
+    def localize_many(self, items):
+        """[(start_time, end_time, point)] -> [(start_time_local, end_time_local)]"""
+        return [self.localize(*item) for item in items]
+
+
+timezone_resolver = TimezoneResolver()
+
+
+def parse_datetime_to_local(start_time, end_time, point):
+    return timezone_resolver.localize(start_time, end_time, point)
 
 
 def get_normalized_sport_type(sport_type):
@@ -0,0 +1,282 @@
+"""
+Record the HTTP traffic of the sync scripts and replay it offline.
+
+record: requests and httpx (sync and async) responses are saved to
+        <fixture_dir>/fixtures.json while the real APIs are called.
+replay: every request is rewritten to a local stand-in server that serves the
+        recorded responses, with optional latency and injected 429 responses.
+"""
+
+import base64
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import httpx
+import requests
+
+FIXTURE_FILE_NAME = "fixtures.json"
+# body is stored decoded, the length and encoding are set again when served
+SKIP_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+def _request_key(method, url, with_query=True):
+    parts = urlsplit(str(url))
+    query = urlencode(sorted(parse_qsl(parts.query))) if with_query else ""
+    return f"{method.upper()} {parts.scheme}://{parts.netloc}{parts.path}?{query}"
+
+
+class Recorder:
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, method, url, status, headers, content):
+        with self.lock:
+            self.entries.append(
+                {
+                    "method": method.upper(),
+                    "url": str(url),
+                    "status": status,
+                    "headers": {
+                        k: v
+                        for k, v in headers.items()
+                        if k.lower() not in SKIP_HEADERS
+                    },
+                    "body": base64.b64encode(content).decode("ascii"),
+                }
+            )
+
+    def save(self):
+        os.makedirs(self.fixture_dir, exist_ok=True)
+        with open(os.path.join(self.fixture_dir, FIXTURE_FILE_NAME), "w") as f:
+            json.dump(self.entries, f, indent=1)
+        print(f"recorded {len(self.entries)} responses to {self.fixture_dir}")
+
+
+class ReplayStats:
+    def __init__(self):
+        self.requests = 0
+        self.throttled = 0
+        self.missed = 0
+        self.retried = 0
+        self.per_host = Counter()
+        self.lock = threading.Lock()
+
+
+class Fixtures:
+    """Recorded responses by request, the same request is answered in order."""
+
+    def __init__(self, fixture_dir):
+        with open(os.path.join(fixture_dir, FIXTURE_FILE_NAME)) as f:
+            entries = json.load(f)
+        self.exact = defaultdict(list)
+        self.by_path = defaultdict(list)
+        for entry in entries:
+            self.exact[_request_key(entry["method"], entry["url"])].append(entry)
+            self.by_path[_request_key(entry["method"], entry["url"], False)].append(
+                entry
+            )
+        self.served = Counter()
+        self.lock = threading.Lock()
+
+    def find(self, method, url):
+        # signed apps put timestamps in the query, fall back to the path only
+        for key, table in (
+            (_request_key(method, url), self.exact),
+            (_request_key(method, url, False), self.by_path),
+        ):
+            candidates = table.get(key)
+            if candidates:
+                with self.lock:
+                    index = min(self.served[key], len(candidates) - 1)
+                    self.served[key] += 1
+                return candidates[index]
+        return None
+
+
+class StandInServer:
+    """
+    Local server for the rewritten requests, the original url is carried in
+    the path as /<scheme>/<host>/<path>.
+    """
+
+    def __init__(self, fixtures, latency=0.0, throttle_rate=0.0, retry_after=1, seed=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.stats = ReplayStats()
+        self.throttled_keys = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                scheme, _, rest = self.path.lstrip("/").partition("/")
+                url = f"{scheme}://{rest}"
+                stand_in.respond(self, self.command, url)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_HEAD = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, handler, method, url):
+        stats = self.stats
+        key = _request_key(method, url)
+        with stats.lock:
+            stats.requests += 1
+            stats.per_host[urlsplit(url).netloc] += 1
+            if key in self.throttled_keys:
+                stats.retried += 1
+                self.throttled_keys.discard(key)
+            throttle = self.random.random() < self.throttle_rate
+            if throttle:
+                stats.throttled += 1
+                self.throttled_keys.add(key)
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle:
+            self._send(handler, 429, {"Retry-After": str(self.retry_after)}, b"")
+            return
+        entry = self.fixtures.find(method, url)
+        if entry is None:
+            with stats.lock:
+                stats.missed += 1
+            self._send(handler, 404, {}, b"no fixture for " + key.encode())
+            return
+        self._send(
+            handler, entry["status"], entry["headers"], base64.b64decode(entry["body"])
+        )
+
+    @staticmethod
+    def _send(handler, status, headers, body):
+        handler.send_response(status)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if handler.command != "HEAD":
+            handler.wfile.write(body)
+
+
+def _stand_in_url(base_url, url):
+    parts = urlsplit(str(url))
+    query = f"?{parts.query}" if parts.query else ""
+    return f"{base_url}/{parts.scheme}/{parts.netloc}{parts.path}{query}"
+
+
+@contextmanager
+def _patched_clients(on_requests=None, on_httpx=None, rewrite=None):
+    """Wrap the send functions of requests and httpx for record or replay."""
+    requests_send = requests.adapters.HTTPAdapter.send
+    httpx_send = httpx.HTTPTransport.handle_request
+    httpx_async_send = httpx.AsyncHTTPTransport.handle_async_request
+
+    def patched_requests_send(adapter, request, **kwargs):
+        if rewrite:
+            request.url = rewrite(request.url)
+        response = requests_send(adapter, request, **kwargs)
+        if on_requests:
+            on_requests(request, response)
+        return response
+
+    def patched_httpx_send(transport, request):
+        if rewrite:
+            request.url = httpx.URL(rewrite(request.url))
+        response = httpx_send(transport, request)
+        if on_httpx:
+            response.read()
+            on_httpx(request, response)
+        return response
+
+    async def patched_httpx_async_send(transport, request):
+        if rewrite:
+            request.url = httpx.URL(rewrite(request.url))
+        response = await httpx_async_send(transport, request)
+        if on_httpx:
+            await response.aread()
+            on_httpx(request, response)
+        return response
+
+    requests.adapters.HTTPAdapter.send = patched_requests_send
+    httpx.HTTPTransport.handle_request = patched_httpx_send
+    httpx.AsyncHTTPTransport.handle_async_request = patched_httpx_async_send
+    try:
+        yield
+    finally:
+        requests.adapters.HTTPAdapter.send = requests_send
+        httpx.HTTPTransport.handle_request = httpx_send
+        httpx.AsyncHTTPTransport.handle_async_request = httpx_async_send
+
+
+@contextmanager
+def recording(fixture_dir):
+    recorder = Recorder(fixture_dir)
+
+    def on_requests(request, response):
+        recorder.add(
+            request.method,
+            request.url,
+            response.status_code,
+            response.headers,
+            response.content,
+        )
+
+    def on_httpx(request, response):
+        recorder.add(
+            request.method,
+            request.url,
+            response.status_code,
+            response.headers,
+            response.content,
+        )
+
+    try:
+        with _patched_clients(on_requests=on_requests, on_httpx=on_httpx):
+            yield recorder
+    finally:
+        recorder.save()
+
+
+@contextmanager
+def replaying(fixture_dir, latency=0.0, throttle_rate=0.0, retry_after=1, seed=0):
+    """Yield the started StandInServer, its stats are filled while replaying."""
+    server = StandInServer(
+        Fixtures(fixture_dir), latency, throttle_rate, retry_after, seed
+    ).start()
+    try:
+        with _patched_clients(rewrite=lambda url: _stand_in_url(server.base_url, url)):
+            yield server
+    finally:
+        server.stop()
@@ -1,12 +1,20 @@
 import os
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 from config import (
     GPX_FOLDER,
     TCX_FOLDER,
     FIT_FOLDER,
 )
+from file_download import (
+    DOWNLOAD_WORKERS,
+    download_to_file,
+    is_downloaded,
+    make_download_session,
+)
 
 BASE_URL = "https://prod.zh.igpsport.com/service/"
 LOGIN_URL = BASE_URL + "auth/account/login"
@@ -21,6 +29,8 @@ class IGPSPORT:
         self.password = password
         self.token = token
         self.session = requests.Session()
+        # the download urls are signed, they get no Authorization header
+        self.download_session = make_download_session()
         if token:
             self.session.headers.update({"Authorization": "Bearer " + token})
 
@@ -68,10 +78,8 @@ class IGPSPORT:
         ret = rsp.json()
         return ret.get("data", "")
 
-    def download_file(self, url, file_name, ext):
-        if not url or not file_name:
-            raise Exception("url or fileName is empty")
-        print("downloading igpsport", file_name, ext)
+    @staticmethod
+    def get_file_path(file_name, ext):
         folder = TCX_FOLDER
         if ext == "fit":
             folder = FIT_FOLDER
@@ -82,28 +90,44 @@ class IGPSPORT:
         else:
             folder = TCX_FOLDER
         os.makedirs(folder, exist_ok=True)
-        file_path = os.path.join(folder, f"{file_name}.{ext}")
-        rsp = requests.get(url)
-        if not rsp.ok:
-            raise Exception(rsp.reason)
-        with open(file_path, "wb") as f:
-            f.write(rsp.content)
+        return os.path.join(folder, f"{file_name}.{ext}")
+
+    def download_file(self, url, file_name, ext):
+        if not url or not file_name:
+            raise Exception("url or fileName is empty")
+        print("downloading igpsport", file_name, ext)
+        file_path = self.get_file_path(file_name, ext)
+        download_to_file(self.download_session, url, file_path)
+        return file_path
+
+    def download_activity(self, ride_id, ext):
+        url = self.get_activity_download_url(ride_id)
+        return self.download_file(url, str(ride_id), ext)
 
     def download_type(self, ext):
+        """Download the new files of a type, return their paths."""
         if not self.token:
             self.login()
         page = 1
-        while True:
-            rsp = self.get_activity_list(page, ext)
-            rows = rsp.get("data", {}).get("rows", [])
-            for row in rows:
-                ride_id = row.get("rideId")
-                url = self.get_activity_download_url(ride_id)
-                self.download_file(url, str(ride_id), ext)
-            total_page = rsp.get("data", {}).get("totalPage", 1)
-            page += 1
-            if page > total_page:
-                break
+        futures = []
+        # the pages are listed while the files of the previous ones download
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            while True:
+                rsp = self.get_activity_list(page, ext)
+                rows = rsp.get("data", {}).get("rows", [])
+                for row in rows:
+                    ride_id = row.get("rideId")
+                    if is_downloaded(self.get_file_path(str(ride_id), ext)):
+                        continue
+                    futures.append(
+                        executor.submit(self.download_activity, ride_id, ext)
+                    )
+                total_page = rsp.get("data", {}).get("totalPage", 1)
+                page += 1
+                if page > total_page:
+                    break
+        print(f"{len(futures)} new igpsport {ext} files")
+        return [future.result() for future in futures]
 
 
 if __name__ == "__main__":
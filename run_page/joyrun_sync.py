@@ -1,6 +1,7 @@
 # some code from https://github.com/fieryd/PKURunningHelper great thanks
 import argparse
 import ast
+import calendar
 import json
 import os
 import subprocess
@@ -9,13 +10,9 @@ import time
 import warnings
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
-from xml.dom import minidom
 from hashlib import md5
 from typing import List
 from urllib.parse import quote
-import xml.etree.ElementTree as ET
-import gpxpy
-import numpy as np
 import polyline
 import requests
 from config import (
@@ -27,25 +24,20 @@ from config import (
     run_map,
     start_point,
 )
+from dedupe import dedupe_by_start_time
 from generator import Generator
-from utils import adjust_time
-
-# struct body
-FitType = np.dtype(
-    {
-        "names": [
-            "time",
-            "bpm",
-            "lati",
-            "longi",
-            "elevation",
-        ],  # unix timestamp, heart bpm, LatitudeDegrees, LongitudeDegrees, elevation
-        "formats": ["i", "S4", "S32", "S32", "S8"],
-    }
+from response_cache import response_cache
+from sync_journal import FETCHED, PARSED, SKIPPED, WRITTEN, SyncJournal
+from track_writer import (
+    CONNECT_API_AUTHOR,
+    TcxLap,
+    TrackColumns,
+    get_elevation_gain,
+    track_length,
+    write_gpx,
+    write_tcx,
 )
-
-# May be Forerunner 945?
-CONNECT_API_PART_NUMBER = "006-D2449-00"
+from utils import adjust_time
 
 # for tcx type
 TCX_TYPE_DICT = {
@@ -59,37 +51,53 @@ def get_md5_data(data):
     return md5(str(data).encode("utf-8")).hexdigest().upper()
 
 
-def download_joyrun_gpx(gpx_data, joyrun_id):
+def download_joyrun_gpx(gpx_data, joyrun_id, start_time, segment_starts=None):
     try:
         print(f"downloading joyrun_id {str(joyrun_id)} gpx")
         file_path = os.path.join(GPX_FOLDER, str(joyrun_id) + ".gpx")
-        with open(file_path, "w") as fb:
-            fb.write(gpx_data)
+        write_gpx(
+            file_path,
+            gpx_data,
+            name=f"gpx from joyrun {start_time}",
+            segment_starts=segment_starts,
+        )
     except Exception as e:
         print(f"wrong id {joyrun_id}: {e}")
         pass
 
 
-def download_joyrun_tcx(tcx_data, joyrun_id):
+def download_joyrun_tcx(tcx_data, run_data, joyrun_id):
     # write to TCX file
     try:
-        xml_str = minidom.parseString(ET.tostring(tcx_data)).toprettyxml()
-        with open(TCX_FOLDER + "/" + joyrun_id + ".tcx", "w") as f:
-            f.write(str(xml_str))
+        # local time
+        fit_start_time_local = run_data["starttime"]
+        # zulu time
+        fit_start_time = time.strftime(
+            "%Y-%m-%dT%H:%M:%SZ", time.localtime(fit_start_time_local)
+        )
+        lap = TcxLap(
+            fit_start_time,
+            [
+                ("TotalTimeSeconds", run_data["second"]),
+                ("DistanceMeters", run_data["meter"]),
+            ],
+            0,
+            track_length(tcx_data),
+        )
+        write_tcx(
+            TCX_FOLDER + "/" + joyrun_id + ".tcx",
+            tcx_data,
+            TCX_TYPE_DICT.get(run_data["type"]),
+            fit_start_time,  # Joyrun use start_time as ID
+            laps=[lap],
+            creator=[("Name", "Joyrun"), ("ProductID", "3441")],
+            author=CONNECT_API_AUTHOR,
+        )
     except Exception as e:
         print(f"empty database error {str(e)}")
         pass
 
 
-def formated_input(
-    run_data, run_data_label, tcx_label
-):  # load run_data from run_data_label, parse to tcx_label, return xml node
-    fit_data = str(run_data[run_data_label])
-    chile_node = ET.Element(tcx_label)
-    chile_node.text = fit_data
-    return chile_node
-
-
 class JoyrunAuth:
     def __init__(self, uid=0, sid=""):
         self.params = {}
@@ -282,29 +290,6 @@ class Joyrun:
                 warnings.warn(f'Failed to evaluate "data": {e}')
             return []
 
-    @staticmethod
-    def new_track_point(
-        latitude, longitude, elevation, time, heart_rate
-    ) -> gpxpy.gpx.GPXTrackPoint:
-        track_point = gpxpy.gpx.GPXTrackPoint(
-            latitude=latitude,
-            longitude=longitude,
-            elevation=elevation,
-            time=datetime.fromtimestamp(time, tz=timezone.utc),
-        )
-
-        # Extension
-        extension_element = ET.Element("gpxtpx:TrackPointExtension")
-        track_point.extensions.append(extension_element)
-
-        ## Heart rate
-        if heart_rate:
-            heart_rate_element = ET.Element("gpxtpx:hr")
-            heart_rate_element.text = str(heart_rate)
-            extension_element.append(heart_rate_element)
-
-        return track_point
-
     @staticmethod
     def parse_points_to_gpx(
         run_points_data,
@@ -316,7 +301,7 @@ class Joyrun:
         interval=5,
     ):
         """
-        parse run_data content to gpx object
+        parse run_data content to gpx track columns
         TODO for now kind of same as `keep` maybe refactor later
 
         :param run_points_data:        [[latitude, longitude],...]
@@ -324,21 +309,9 @@ class Joyrun:
         :param heart_rate_data_string: heart rate list in string format
         :param altitude_data_string:   altitude list in string format
         :param interval:               time interval between each point, in seconds
+        :return: (TrackColumns, indexes of the points that start a new segment)
         """
 
-        # GPX instance
-        gpx = gpxpy.gpx.GPX()
-        gpx.nsmap["gpxtpx"] = "http://www.garmin.com/xmlschemas/TrackPointExtension/v1"
-
-        # GPX Track
-        track = gpxpy.gpx.GPXTrack()
-        track.name = f"gpx from joyrun {start_time}"
-        gpx.tracks.append(track)
-
-        # GPX Track Segment
-        track_segment = gpxpy.gpx.GPXTrackSegment()
-        track.segments.append(track_segment)
-
         # Initialize Pause
         pause_list = Joyrun.PauseList(pause_list)
         pause = pause_list.next()
@@ -347,18 +320,11 @@ class Joyrun:
         heart_rate_list = Joyrun.DataSeries(heart_rate_data_string)
         altitude_list = Joyrun.DataSeries(altitude_data_string)
 
+        times = []
+        segment_starts = []
         current_time = start_time
-        for index, point in enumerate(run_points_data[:-1]):
-            # New Track Point
-            track_segment.points.append(
-                Joyrun.new_track_point(
-                    point[0],
-                    point[1],
-                    altitude_list.next(),
-                    current_time,
-                    heart_rate_list.next(),
-                )
-            )
+        for index, _ in enumerate(run_points_data[:-1]):
+            times.append(current_time)
 
             # Increment time
             current_time += interval
@@ -366,140 +332,47 @@ class Joyrun:
             # Check pause
             if pause and pause.index - 1 == index:
                 # New Segment
-                track_segment = gpxpy.gpx.GPXTrackSegment()
-                track.segments.append(track_segment)
+                segment_starts.append(index + 1)
                 # Add paused duration
                 current_time += pause.duration
                 # Next pause
                 pause = pause_list.next()
 
         # Last Track Point uses end_time
-        last_point = run_points_data[-1]
-        track_segment.points.append(
-            Joyrun.new_track_point(
-                last_point[0],
-                last_point[1],
-                altitude_list.next(),
-                end_time,
-                heart_rate_list.next(),
-            )
+        times.append(end_time)
+
+        track = TrackColumns(
+            time=times,
+            lat=[p[0] for p in run_points_data],
+            lon=[p[1] for p in run_points_data],
+            elevation=[altitude_list.next() for _ in run_points_data],
+            hr=[heart_rate_list.next() or None for _ in run_points_data],
         )
+        return track, segment_starts
 
-        return gpx
-
-    def parse_points_to_tcx(self, run_data, interval=5) -> ET.Element:
+    def parse_points_to_tcx(self, run_data, interval=5):
         """
-        parse run_data content to tcx object
+        parse run_data content to tcx track columns
         TODO for now kind of same as `keep` maybe refactor later
 
-        :param run_points_data:        [[latitude, longitude],...]
-        :param pause_list:             [[interval_index, pause_seconds],...]
-        :param heart_rate_data_string: heart rate list in string format
-        :param altitude_data_string:   altitude list in string format
+        :param run_data:               joyrun runrecord
         :param interval:               time interval between each point, in seconds
         """
-
-        # local time
         fit_start_time_local = run_data["starttime"]
-        # zulu time
-        fit_start_time = time.strftime(
-            "%Y-%m-%dT%H:%M:%SZ", time.localtime(fit_start_time_local)
-        )
-
-        # Root node
-        training_center_database = ET.Element(
-            "TrainingCenterDatabase",
-            {
-                "xmlns": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",
-                "xmlns:ns5": "http://www.garmin.com/xmlschemas/ActivityGoals/v1",
-                "xmlns:ns3": "http://www.garmin.com/xmlschemas/ActivityExtension/v2",
-                "xmlns:ns2": "http://www.garmin.com/xmlschemas/UserProfile/v2",
-                "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-                "xmlns:ns4": "http://www.garmin.com/xmlschemas/ProfileExtension/v1",
-                "xsi:schemaLocation": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd",
-            },
-        )
-        # xml tree
-        ET.ElementTree(training_center_database)
-        # Activities
-        activities = ET.Element("Activities")
-        training_center_database.append(activities)
-        # sport type
-        sports_type = TCX_TYPE_DICT.get(run_data["type"])
-        # activity
-        activity = ET.Element("Activity", {"Sport": sports_type})
-        activities.append(activity)
-        #   Id
-        activity_id = ET.Element("Id")
-        activity_id.text = fit_start_time  # Joyrun use start_time as ID
-        activity.append(activity_id)
-        #   Creator
-        activity_creator = ET.Element("Creator", {"xsi:type": "Device_t"})
-        activity.append(activity_creator)
-        #       Name
-        activity_creator_name = ET.Element("Name")
-        activity_creator_name.text = "Joyrun"
-        activity_creator.append(activity_creator_name)
-        activity_creator_product = ET.Element("ProductID")
-        activity_creator_product.text = "3441"
-        activity_creator.append(activity_creator_product)
-        #   Lap
-        activity_lap = ET.Element("Lap", {"StartTime": fit_start_time})
-        activity.append(activity_lap)
-        #       TotalTimeSeconds
-        activity_lap.append(formated_input(run_data, "second", "TotalTimeSeconds"))
-        #       DistanceMeters
-        activity_lap.append(formated_input(run_data, "meter", "DistanceMeters"))
 
         # Initialize Pause
         pause_list = Joyrun.PauseList(run_data["pause"])
         pause = pause_list.next()
         # Extension data instances
-        run_points_data = self.parse_content_to_ponits(run_data["content"])
+        run_points_data = self.parse_content_to_ponits(run_data["content"])[:-1]
         heart_rate_list = Joyrun.DataSeries(run_data["heartrate"])
         altitude_list = Joyrun.DataSeries(run_data["altitude"])
 
-        # Track
-        track = ET.Element("Track")
-        activity_lap.append(track)
+        times = []
         current_time = fit_start_time_local
-        for index, point in enumerate(run_points_data[:-1]):
-            tp = ET.Element("Trackpoint")
-            track.append(tp)
-            # Time
-            time_stamp = time.strftime(
-                "%Y-%m-%dT%H:%M:%SZ", time.localtime(current_time)
-            )
-            time_label = ET.Element("Time")
-            time_label.text = time_stamp
-            tp.append(time_label)
-
-            # HeartRateBpm
-            # None was converted to bytes by np.dtype, becoming a string "None" after decode...-_-
-            # as well as LatitudeDegrees and LongitudeDegrees below
-            if "heartrate" in run_data:
-                bpm = ET.Element("HeartRateBpm")
-                bpm_value = ET.Element("Value")
-                bpm.append(bpm_value)
-                bpm_value.text = str(heart_rate_list.next())
-                tp.append(bpm)
-
-            # Position
-            if "content" in run_data:
-                position = ET.Element("Position")
-                tp.append(position)
-                #   LatitudeDegrees
-                lati = ET.Element("LatitudeDegrees")
-                lati.text = str(point[0])
-                position.append(lati)
-                #   LongitudeDegrees
-                longi = ET.Element("LongitudeDegrees")
-                longi.text = str(point[1])
-                position.append(longi)
-                #  AltitudeMeters
-                altitude_meters = ET.Element("AltitudeMeters")
-                altitude_meters.text = str(altitude_list.next())
-                tp.append(altitude_meters)
+        for index, _ in enumerate(run_points_data):
+            # the time label is the local wall clock of current_time
+            times.append(calendar.timegm(time.localtime(current_time)))
 
             # Increment time
             current_time += interval
@@ -511,33 +384,36 @@ class Joyrun:
                 # Next pause
                 pause = pause_list.next()
 
-        # Author
-        author = ET.Element("Author", {"xsi:type": "Application_t"})
-        training_center_database.append(author)
-        author_name = ET.Element("Name")
-        author_name.text = "Connect Api"
-        author.append(author_name)
-        author_lang = ET.Element("LangID")
-        author_lang.text = "en"
-        author.append(author_lang)
-        author_part = ET.Element("PartNumber")
-        author_part.text = CONNECT_API_PART_NUMBER
-        author.append(author_part)
-
-        return training_center_database
+        with_hr = "heartrate" in run_data
+        with_position = "content" in run_data
+        return TrackColumns(
+            time=times,
+            hr=[heart_rate_list.next() for _ in run_points_data] if with_hr else None,
+            lat=[p[0] for p in run_points_data] if with_position else None,
+            lon=[p[1] for p in run_points_data] if with_position else None,
+            elevation=(
+                [altitude_list.next() for _ in run_points_data]
+                if with_position
+                else None
+            ),
+        )
 
     def get_single_run_record(self, fid):
-        payload = {
-            "fid": fid,
-            "wgs": 1,
-        }
-        r = self.session.post(
-            f"{self.base_url}/Run/GetInfo.aspx",
-            data=payload,
-            auth=self.auth.reload(payload),
+        def fetch():
+            payload = {
+                "fid": fid,
+                "wgs": 1,
+            }
+            r = self.session.post(
+                f"{self.base_url}/Run/GetInfo.aspx",
+                data=payload,
+                auth=self.auth.reload(payload),
+            )
+            return r.json()
+
+        return response_cache.get_or_fetch(
+            "joyrun_run_info", fid, fetch, lambda data: "runrecord" in data
         )
-        data = r.json()
-        return data
 
     def parse_raw_data_to_nametuple(
         self, run_data, old_gpx_ids, with_gpx=False, with_tcx=False
@@ -552,7 +428,7 @@ class Joyrun:
         elevation_gain = None
         # pass the track no points
         if run_points_data:
-            gpx_data = self.parse_points_to_gpx(
+            gpx_data, segment_starts = self.parse_points_to_gpx(
                 run_points_data,
                 start_time,
                 end_time,
@@ -560,13 +436,15 @@ class Joyrun:
                 run_data["heartrate"],
                 run_data["altitude"],
             )
-            elevation_gain = gpx_data.get_uphill_downhill().uphill
+            elevation_gain = get_elevation_gain(gpx_data, segment_starts)
             if with_gpx and str(joyrun_id) not in old_gpx_ids:
-                download_joyrun_gpx(gpx_data.to_xml(), str(joyrun_id))
+                download_joyrun_gpx(
+                    gpx_data, str(joyrun_id), start_time, segment_starts
+                )
 
             if with_tcx and str(joyrun_id) not in old_gpx_ids:
                 tcx_data = self.parse_points_to_tcx(run_data)
-                download_joyrun_tcx(tcx_data, str(joyrun_id))
+                download_joyrun_tcx(tcx_data, run_data, str(joyrun_id))
         try:
             heart_rate_list = (
                 eval(run_data["heartrate"]) if run_data["heartrate"] else None
@@ -620,38 +498,61 @@ class Joyrun:
         return namedtuple("x", d.keys())(*d.values())
 
     def get_all_joyrun_tracks(
-        self, old_tracks_ids, with_gpx=False, with_tcx=False, threshold=10
+        self,
+        old_tracks_ids,
+        with_gpx=False,
+        with_tcx=False,
+        threshold=10,
+        journal=None,
     ):
+        """
+        With a journal every record is written to it as it is fetched, so a
+        restart does not fetch it again, and the tracks are committed through
+        it at every checkpoint, otherwise they are returned.
+        """
         run_ids = self.get_runs_records_ids()
         old_tracks_ids = [int(i) for i in old_tracks_ids if i.isdigit()]
 
         old_gpx_ids = os.listdir(GPX_FOLDER)
         old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
         new_run_ids = list(set(run_ids) - set(old_tracks_ids))
+        if journal:
+            journal.list(new_run_ids)
         tracks = []
-        seen_runs = {}  # Dictionary to keep track of unique runs with start time as key
-        for i in new_run_ids:
-            run_data = self.get_single_run_record(i)
-            start_time = datetime.fromtimestamp(run_data["runrecord"]["starttime"])
-            distance = run_data["runrecord"]["meter"]
-
-            is_duplicate = False
-            for seen_start in list(seen_runs.keys()):
-                if abs((start_time - seen_start).total_seconds()) <= threshold:
-                    if distance > seen_runs[seen_start]["distance"]:
-                        seen_runs[seen_start] = {
-                            "run_data": run_data,
-                            "distance": distance,
-                        }
-                    is_duplicate = True
-                    break
-            if not is_duplicate:
-                seen_runs[start_time] = {"run_data": run_data, "distance": distance}
-        for run in seen_runs.values():
+        runs_data = []
+        for n, i in enumerate(new_run_ids, 1):
+            run_data = journal.fetched(i) if journal else None
+            if run_data is None:
+                run_data = self.get_single_run_record(i)
+                if journal:
+                    journal.mark(i, FETCHED, run_data)
+            runs_data.append(run_data)
+            # the fetched records are kept by the journal, before the dedupe
+            # needs all of them
+            if journal and n % journal.checkpoint_every == 0:
+                journal.checkpoint()
+        # the same run uploaded twice, keep the longest one
+        runs_data, duplicated_runs_data = dedupe_by_start_time(
+            runs_data,
+            lambda run_data: run_data["runrecord"]["starttime"],
+            lambda run_data: run_data["runrecord"]["meter"],
+            threshold,
+        )
+        if journal:
+            for run_data in duplicated_runs_data:
+                journal.mark(run_data["runrecord"]["fid"], SKIPPED)
+        for run_data in runs_data:
             track = self.parse_raw_data_to_nametuple(
-                run["run_data"], old_gpx_ids, with_gpx, with_tcx
+                run_data, old_gpx_ids, with_gpx, with_tcx
             )
-            tracks.append(track)
+            if journal:
+                journal.add_track(
+                    run_data["runrecord"]["fid"],
+                    track,
+                    WRITTEN if with_gpx or with_tcx else PARSED,
+                )
+            else:
+                tracks.append(track)
         return tracks
 
 
@@ -784,10 +685,14 @@ if __name__ == "__main__":
 
     generator = Generator(SQL_FILE)
     old_tracks_ids = generator.get_old_tracks_ids()
-    tracks = j.get_all_joyrun_tracks(
-        old_tracks_ids, options.with_gpx, options.with_tcx, options.threshold
-    )
-    generator.sync_from_app(tracks)
+    with SyncJournal("joyrun", generator.sync_from_app) as journal:
+        j.get_all_joyrun_tracks(
+            old_tracks_ids,
+            options.with_gpx,
+            options.with_tcx,
+            options.threshold,
+            journal,
+        )
     activities_list = generator.load()
     with open(JSON_FILE, "w") as f:
         json.dump(activities_list, f)
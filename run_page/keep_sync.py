@@ -7,9 +7,7 @@ import time
 import zlib
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
-from xml.dom import minidom
-import eviltransform
-import gpxpy
+import numpy as np
 import polyline
 import requests
 from config import (
@@ -21,9 +19,20 @@ from config import (
     start_point,
 )
 from Crypto.Cipher import AES
+from coord_transform import gcj2wgs_points
 from generator import Generator
+from response_cache import response_cache
+from sync_journal import FAILED, FETCHED, PARSED, SKIPPED, WRITTEN
+from timeline_align import NO_MATCH, nearest_sample_indexes, step_value_indexes
+from track_writer import (
+    TcxLap,
+    TrackColumns,
+    get_elevation_gain,
+    track_length,
+    write_gpx,
+    write_tcx,
+)
 from utils import adjust_time
-import xml.etree.ElementTree as ET
 
 KEEP_SPORT_TYPES = ["running", "hiking", "cycling"]
 KEEP2STRAVA = {
@@ -95,14 +104,19 @@ def get_to_download_runs_ids(session, headers, sport_type):
 
 
 def get_single_run_data(session, headers, run_id, sport_type):
-    r = session.get(
-        RUN_LOG_API.format(sport_type=sport_type, run_id=run_id), headers=headers
+    def fetch():
+        r = session.get(
+            RUN_LOG_API.format(sport_type=sport_type, run_id=run_id), headers=headers
+        )
+        if r.ok:
+            return r.json()
+        else:
+            print(f"Failed to fetch run {run_id}: {r.status_code}")
+            return None
+
+    return response_cache.get_or_fetch(
+        f"keep_{sport_type}log", run_id, fetch, lambda data: bool(data.get("data"))
     )
-    if r.ok:
-        return r.json()
-    else:
-        print(f"Failed to fetch run {run_id}: {r.status_code}")
-        return None
 
 
 def decode_runmap_data(text, is_geo=False):
@@ -127,31 +141,20 @@ def assign_cadence_to_points(run_points_data, cadence_by_distance):
 
     # 确保按距离升序排列
     cadence_by_distance.sort(key=lambda x: x[0])
-    
+
     # 提取所有公里段距离
     km_distances = [item[0] for item in cadence_by_distance]
     km_cadences = [item[1] for item in cadence_by_distance]
-    
+
     total_points = len(run_points_data)
     total_distance = km_distances[-1]  # 最后一公里的累计距离
 
-    for i, point in enumerate(run_points_data):
-        # 计算当前点的累计距离（线性插值）
-        if total_points > 1:
-            current_dist = (i / (total_points - 1)) * total_distance
-        else:
-            current_dist = 0.0
-
-        # 找到当前距离所属的公里段（二分查找更高效，这里用简单遍历）
-        assigned_cadence = km_cadences[0]  # 默认第一公里
-        for j in range(len(km_distances)):
-            if km_distances[j] <= current_dist:
-                assigned_cadence = km_cadences[j]
-            else:
-                break
-        
-        point["cad"] = assigned_cadence
-    
+    # 计算每个点的累计距离（线性插值），再二分查找所属的公里段
+    point_distances = np.arange(total_points) / (total_points - 1) * total_distance
+    km_indexes = step_value_indexes(km_distances, point_distances)
+    for point, km_index in zip(run_points_data, km_indexes):
+        point["cad"] = km_cadences[km_index]
+
     return run_points_data
 
 
@@ -161,7 +164,7 @@ def parse_raw_data_to_nametuple(
     if not isinstance(run_data, dict) or "data" not in run_data:
         print(f"Invalid response format: {run_data}")
         return None
-    
+
     run_data = run_data["data"]
     if not run_data:
         print("Empty run data")
@@ -187,7 +190,7 @@ def parse_raw_data_to_nametuple(
     if run_data.get("geoPoints"):
         run_points_data = decode_runmap_data(run_data["geoPoints"], True)
         run_points_data_gpx = run_points_data
-        
+
         # 👇 构建步频映射表（使用原始 stepFrequency，不除以2）
         cadence_by_distance = []
         cross_km_points = run_data.get("crossKmPoints", [])
@@ -197,14 +200,15 @@ def parse_raw_data_to_nametuple(
             if step_freq is not None:
                 # ✅ 关键：直接使用原始值（左右脚合计）
                 cadence_by_distance.append((total_dist, int(step_freq / 2)))
-        
-        run_points_data_gpx = assign_cadence_to_points(run_points_data_gpx, cadence_by_distance)
+
+        run_points_data_gpx = assign_cadence_to_points(
+            run_points_data_gpx, cadence_by_distance
+        )
 
         if TRANS_GCJ02_TO_WGS84:
-            run_points_data = [
-                list(eviltransform.gcj2wgs(p["latitude"], p["longitude"]))
-                for p in run_points_data
-            ]
+            run_points_data = gcj2wgs_points(
+                [[p["latitude"], p["longitude"]] for p in run_points_data]
+            )
             for i, p in enumerate(run_points_data_gpx):
                 p["latitude"] = run_points_data[i][0]
                 p["longitude"] = run_points_data[i][1]
@@ -212,27 +216,25 @@ def parse_raw_data_to_nametuple(
         for p in run_points_data_gpx:
             if "timestamp" not in p:
                 p["timestamp"] = p.get("unixTimestamp", 0)
-            p_hr = find_nearest_hr(decoded_hr_data, int(p["timestamp"]), start_time)
-            if p_hr:
-                p["hr"] = p_hr
+        assign_nearest_hr_to_points(run_points_data_gpx, decoded_hr_data, start_time)
 
         if (
             run_data["dataType"].startswith("outdoor")
             or run_data["dataType"] == "mountaineering"
         ):
             if with_gpx:
-                gpx_data = parse_points_to_gpx(
-                    run_points_data_gpx, start_time, KEEP2STRAVA[run_data["dataType"]]
-                )
-                elevation_gain = gpx_data.get_uphill_downhill().uphill
+                gpx_data = parse_points_to_gpx(run_points_data_gpx, start_time)
+                elevation_gain = get_elevation_gain(gpx_data)
                 if str(keep_id) not in old_gpx_ids:
-                    download_keep_gpx(gpx_data.to_xml(), str(keep_id))
+                    download_keep_gpx(
+                        gpx_data, str(keep_id), KEEP2STRAVA[run_data["dataType"]]
+                    )
             if with_tcx:
-                tcx_data = parse_points_to_tcx(
-                    run_data, run_points_data_gpx, KEEP2TCX[run_data["dataType"]]
-                )
                 if str(keep_id) not in old_tcx_ids:
-                    download_keep_tcx(tcx_data.toprettyxml(), str(keep_id))
+                    tcx_data = parse_points_to_tcx(run_data, run_points_data_gpx)
+                    download_keep_tcx(
+                        tcx_data, run_data, str(keep_id), KEEP2TCX[run_data["dataType"]]
+                    )
     else:
         print(f"ID {keep_id} no gps data")
         return None
@@ -244,7 +246,7 @@ def parse_raw_data_to_nametuple(
     start_date_local = adjust_time(start_date, tz_name)
     end = datetime.fromtimestamp(run_data["endTime"] // 1000, tz=timezone.utc)
     end_local = adjust_time(end, tz_name)
-    
+
     if not run_data.get("duration"):
         print(f"ID {keep_id} has no total time")
         return None
@@ -282,7 +284,13 @@ def get_all_keep_tracks(
     keep_sports_data_api,
     with_gpx=False,
     with_tcx=False,
+    journal=None,
 ):
+    """
+    With a journal the tracks are committed through it at every checkpoint,
+    and the runs it has fetched already are not fetched again, otherwise
+    they are returned.
+    """
     if with_gpx and not os.path.exists(GPX_FOLDER):
         os.mkdir(GPX_FOLDER)
     if with_tcx and not os.path.exists(TCX_FOLDER):
@@ -294,6 +302,8 @@ def get_all_keep_tracks(
         runs = get_to_download_runs_ids(s, headers, api)
         runs = [run for run in runs if run.split("_")[1] not in old_tracks_ids]
         print(f"{len(runs)} new keep {api} data to generate")
+        if journal:
+            journal.list(runs)
         old_gpx_ids = []
         if with_gpx:
             old_gpx_ids = os.listdir(GPX_FOLDER)
@@ -308,193 +318,132 @@ def get_all_keep_tracks(
             ]
         for run in runs:
             print(f"parsing keep id {run}")
+            run_data = None
             try:
-                run_data = get_single_run_data(s, headers, run, api)
+                run_data = journal.fetched(run) if journal else None
                 if run_data is None:
-                    continue
+                    run_data = get_single_run_data(s, headers, run, api)
+                    if run_data is None:
+                        continue
+                    if journal:
+                        journal.mark(run, FETCHED, run_data)
                 track = parse_raw_data_to_nametuple(
                     run_data, old_gpx_ids, old_tcx_ids, with_gpx, with_tcx
                 )
-                if track:
+                if not track:
+                    if journal:
+                        journal.mark(run, SKIPPED)
+                elif journal:
+                    journal.add_track(
+                        run, track, WRITTEN if with_gpx or with_tcx else PARSED
+                    )
+                else:
                     tracks.append(track)
             except Exception as e:
                 print(f"Something wrong parsing keep id {run}: {str(e)}")
+                # a fetch error is retried by the next run, a parse error is not
+                if journal and run_data is not None:
+                    journal.mark(run, FAILED)
     return tracks
 
 
-def parse_points_to_gpx(run_points_data, start_time, sport_type):
-    points_dict_list = []
+def parse_points_to_gpx(run_points_data, start_time):
     if (
         run_points_data
         and run_points_data[0]["timestamp"] > TIMESTAMP_THRESHOLD_IN_DECISECOND
     ):
         start_time = 0
 
-    for point in run_points_data:
-        points_dict = {
-            "latitude": point["latitude"],
-            "longitude": point["longitude"],
-            "time": datetime.fromtimestamp(
-                (start_time // 1000 + point["timestamp"] // 10),
-                tz=timezone.utc,
-            ),
-            "elevation": point.get("altitude"),
-            "hr": point.get("hr"),
-            "cad": point.get("cad"),  # 步频（原始值）
-        }
-        points_dict_list.append(points_dict)
-    gpx = gpxpy.gpx.GPX()
-    gpx.nsmap["gpxtpx"] = "http://www.garmin.com/xmlschemas/TrackPointExtension/v1"
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx_track.name = "gpx from keep"
-    gpx_track.type = sport_type
-    gpx.tracks.append(gpx_track)
-
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
-    for p in points_dict_list:
-        point = gpxpy.gpx.GPXTrackPoint(
-            latitude=p["latitude"],
-            longitude=p["longitude"],
-            time=p["time"],
-            elevation=p.get("elevation"),
-        )
-        if p.get("hr") is not None or p.get("cad") is not None:
-            ext_content = ""
-            if p.get("hr") is not None:
-                ext_content += f"<gpxtpx:hr>{p['hr']}</gpxtpx:hr>"
-            if p.get("cad") is not None:
-                ext_content += f"<gpxtpx:cad>{p['cad']}</gpxtpx:cad>"
-            
-            gpx_extension = ET.fromstring(
-                f"""<gpxtpx:TrackPointExtension xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">
-                        {ext_content}
-                    </gpxtpx:TrackPointExtension>"""
-            )
-            point.extensions.append(gpx_extension)
-        gpx_segment.points.append(point)
-    return gpx
-
-
-def parse_points_to_tcx(run_data, run_points_data, sport_type):
-    fit_start_time = datetime.fromtimestamp(
-        run_data.get("startTime") // 1000, tz=timezone.utc
-    ).strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    training_center_database = ET.Element(
-        "TrainingCenterDatabase",
-        {
-            "xmlns": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",
-            "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-            "xsi:schemaLocation": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd",
-        },
+    return TrackColumns(
+        time=[start_time // 1000 + p["timestamp"] // 10 for p in run_points_data],
+        lat=[p["latitude"] for p in run_points_data],
+        lon=[p["longitude"] for p in run_points_data],
+        elevation=[p.get("altitude") for p in run_points_data],
+        hr=[p.get("hr") for p in run_points_data],
+        cad=[p.get("cad") for p in run_points_data],  # 步频（原始值）
     )
-    activities = ET.Element("Activities")
-    training_center_database.append(activities)
-    activity = ET.Element("Activity", {"Sport": sport_type})
-    activities.append(activity)
-    activity_id = ET.Element("Id")
-    activity_id.text = fit_start_time
-    activity.append(activity_id)
-    activity_lap = ET.Element("Lap", {"StartTime": fit_start_time})
-    activity.append(activity_lap)
-    activity_total_time = ET.Element("TotalTimeSeconds")
-    activity_total_time.text = str(run_data.get("duration", 0))
-    activity_lap.append(activity_total_time)
-    activity_distance = ET.Element("DistanceMeters")
-    activity_distance.text = str(run_data.get("distance", 0))
-    activity_lap.append(activity_distance)
-    activity_calories = ET.Element("Calories")
-    activity_calories.text = str(run_data.get("calorie", 0))
-    activity_lap.append(activity_calories)
-
-    track = ET.Element("Track")
-    activity_lap.append(track)
-    for point in run_points_data:
-        tp = ET.Element("Trackpoint")
-        track.append(tp)
-        time_stamp = datetime.fromtimestamp(
-            (run_data.get("startTime") // 1000 + point.get("timestamp") // 10),
-            tz=timezone.utc,
-        ).strftime("%Y-%m-%dT%H:%M:%SZ")
-        time_label = ET.Element("Time")
-        time_label.text = time_stamp
-        tp.append(time_label)
-        try:
-            position = ET.Element("Position")
-            tp.append(position)
-            lati = ET.Element("LatitudeDegrees")
-            lati.text = str(point["latitude"])
-            position.append(lati)
-            longi = ET.Element("LongitudeDegrees")
-            longi.text = str(point["longitude"])
-            position.append(longi)
-            altitude_meters = ET.Element("AltitudeMeters")
-            altitude_meters.text = str(point.get("altitude", 0))
-            tp.append(altitude_meters)
-        except KeyError:
-            pass
-        if point.get("hr") is not None:
-            bpm = ET.Element("HeartRateBpm")
-            bpm_value = ET.Element("Value")
-            bpm_value.text = str(point["hr"])
-            bpm.append(bpm_value)
-            tp.append(bpm)
-    xml_str = minidom.parseString(ET.tostring(training_center_database))
-    return xml_str
-
-
-def find_nearest_hr(
-    hr_data_list, target_time, start_time, threshold=HR_FRAME_THRESHOLD_IN_DECISECOND
+
+
+def parse_points_to_tcx(run_data, run_points_data):
+    start_time = run_data.get("startTime")
+    return TrackColumns(
+        time=[start_time // 1000 + p.get("timestamp") // 10 for p in run_points_data],
+        lat=[p.get("latitude") for p in run_points_data],
+        lon=[p.get("longitude") for p in run_points_data],
+        elevation=[
+            p.get("altitude", 0) if "latitude" in p else None for p in run_points_data
+        ],
+        hr=[p.get("hr") for p in run_points_data],
+    )
+
+
+def assign_nearest_hr_to_points(
+    run_points_data,
+    hr_data_list,
+    start_time,
+    threshold=HR_FRAME_THRESHOLD_IN_DECISECOND,
 ):
-    closest_element = None
-    min_difference = float("inf")
-    if target_time > TIMESTAMP_THRESHOLD_IN_DECISECOND:
-        target_time = target_time - start_time // 100
-
-    for item in hr_data_list:
-        timestamp = item.get("timestamp")
-        if not timestamp:
-            continue
-        difference = abs(timestamp - target_time)
-        if difference <= threshold and difference < min_difference:
-            closest_element = item
-            min_difference = difference
+    """
+    Set `hr` on every point from the nearest heart rate frame within threshold.
+    Points and frames are matched in one sorted merge instead of a scan per point.
+    """
+    if not run_points_data or not hr_data_list:
+        return run_points_data
 
-    if closest_element:
-        hr = closest_element.get("beatsPerMinute")
+    target_times = []
+    for p in run_points_data:
+        target_time = int(p["timestamp"])
+        if target_time > TIMESTAMP_THRESHOLD_IN_DECISECOND:
+            target_time = target_time - start_time // 100
+        target_times.append(target_time)
+    hr_times = [item.get("timestamp") or None for item in hr_data_list]
+
+    hr_indexes = nearest_sample_indexes(hr_times, target_times, threshold)
+    for p, hr_index in zip(run_points_data, hr_indexes):
+        if hr_index == NO_MATCH:
+            continue
+        hr = hr_data_list[hr_index].get("beatsPerMinute")
         if hr and hr > 0:
-            return hr
-    return None
+            p["hr"] = hr
+    return run_points_data
 
 
-def download_keep_gpx(gpx_data, keep_id):
+def download_keep_gpx(gpx_data, keep_id, sport_type):
     try:
         print(f"downloading keep_id {str(keep_id)} gpx")
         file_path = os.path.join(GPX_FOLDER, str(keep_id) + ".gpx")
-        with open(file_path, "w") as fb:
-            fb.write(gpx_data)
+        write_gpx(file_path, gpx_data, name="gpx from keep", sport_type=sport_type)
         return file_path
     except Exception as e:
         print(f"Something wrong to download keep gpx {str(e)}")
         print(f"wrong id {keep_id}")
 
 
-def download_keep_tcx(tcx_data, keep_id):
+def download_keep_tcx(tcx_data, run_data, keep_id, sport_type):
     try:
         print(f"downloading keep_id {str(keep_id)} tcx")
         file_path = os.path.join(TCX_FOLDER, str(keep_id) + ".tcx")
-        with open(file_path, "w") as fb:
-            fb.write(tcx_data)
+        fit_start_time = datetime.fromtimestamp(
+            run_data.get("startTime") // 1000, tz=timezone.utc
+        ).strftime("%Y-%m-%dT%H:%M:%SZ")
+        lap = TcxLap(
+            fit_start_time,
+            [
+                ("TotalTimeSeconds", run_data.get("duration", 0)),
+                ("DistanceMeters", run_data.get("distance", 0)),
+                ("Calories", run_data.get("calorie", 0)),
+            ],
+            0,
+            track_length(tcx_data),
+        )
+        write_tcx(file_path, tcx_data, sport_type, fit_start_time, laps=[lap])
         return file_path
     except Exception as e:
         print(f"Something wrong to download keep tcx {str(e)}")
         print(f"wrong id {keep_id}")
 
 
-def run_keep_sync(
-    email, password, keep_sports_data_api, with_download_gpx=False
-):
+def run_keep_sync(email, password, keep_sports_data_api, with_download_gpx=False):
     if not os.path.exists(KEEP2STRAVA_BK_PATH):
         file = open(KEEP2STRAVA_BK_PATH, "w")
         file.close()
@@ -507,14 +456,17 @@ def run_keep_sync(
                 print(f"Error reading JSON file {KEEP2STRAVA_BK_PATH}: {e}")
                 content = []
     old_tracks_ids = [str(a["run_id"]) for a in content]
-    
+
     # 👇 启用 GPX 生成
     _new_tracks = get_all_keep_tracks(
-        email, password, old_tracks_ids, keep_sports_data_api,
-        with_gpx=True,   # 必须为 True
-        with_tcx=False
+        email,
+        password,
+        old_tracks_ids,
+        keep_sports_data_api,
+        with_gpx=True,  # 必须为 True
+        with_tcx=False,
     )
-    
+
     new_tracks = []
     for track in _new_tracks:
         if track.start_latlng is not None:
@@ -526,4 +478,4 @@ def run_keep_sync(
         track = namedtuple("y", track._fields + file_path._fields)(*(track + file_path))
         new_tracks.append(track)
 
-    return new_tracks
\ No newline at end of file
+    return new_tracks
@@ -0,0 +1,13 @@
+"""
+If you do not want bind any account
+The gpx, tcx and fit files in GPX_OUT, TCX_OUT and FIT_OUT sync in one pass,
+a run saved in several formats is imported once from its fit, tcx or gpx
+"""
+
+from config import FOLDER_DICT, JSON_FILE, SQL_FILE
+
+from utils import make_all_activities_file
+
+if __name__ == "__main__":
+    print("sync gpx, tcx and fit files in GPX_OUT, TCX_OUT and FIT_OUT")
+    make_all_activities_file(SQL_FILE, FOLDER_DICT, JSON_FILE)
@@ -1,30 +1,35 @@
 import argparse
 import json
 import logging
+import multiprocessing
 import os.path
 import time
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from xml.etree import ElementTree
 
-import gpxpy.gpx
 import httpx
 from config import (
     BASE_TIMEZONE,
     GPX_FOLDER,
     JSON_FILE,
+    NIKE_CONVERTED_FILE,
     OUTPUT_DIR,
     SQL_FILE,
     run_map,
 )
 from generator import Generator
-from utils import adjust_time, make_activities_file
+from response_cache import response_cache
+from sync_journal import FAILED, FETCHED, SKIPPED, WRITTEN, SyncJournal
+from track_writer import columns_from_dicts, write_gpx
+from utils import add_unsynced_files, adjust_time, import_activity_files
 
 # logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("nike_sync")
 
 BASE_URL = "https://api.nike.com/plus/v3"
 TOKEN_REFRESH_URL = "https://api.nike.com/idn/shim/oauth/2.0/token"
+NIKE_FETCH_WORKERS = 5
 
 
 class Nike:
@@ -48,6 +53,11 @@ class Nike:
             )
 
     def get_activity(self, activity_id):
+        return response_cache.get_or_fetch(
+            "nike_activity", activity_id, lambda: self._get_activity(activity_id)
+        )
+
+    def _get_activity(self, activity_id):
         try:
             return self.request(f"activity/{activity_id}?metrics=ALL")
         except Exception:
@@ -63,7 +73,11 @@ class Nike:
         return response.json()
 
 
-def run(refresh_token, is_continue_sync=False):
+def run(refresh_token, is_continue_sync=False, journal=None, on_saved=None):
+    """
+    on_saved(path) is called for every activity json as soon as it is saved,
+    the activities the journal has saved already are not fetched again.
+    """
     nike = Nike(refresh_token)
     if is_continue_sync:
         last_id_local = get_last_before_id()
@@ -71,37 +85,56 @@ def run(refresh_token, is_continue_sync=False):
     else:
         last_id_local = None
     before_id = None
-    while True:
-        data = nike.get_activities_before_id(before_id)
-        activities = data["activities"]
-        activities_ids = [i["id"] for i in activities]
-        is_sync_done = False
-        if last_id_local in activities_ids:
-            index = activities_ids.index(last_id_local)
-            activities = activities[:index]
-            is_sync_done = True
-
-        before_id = data["paging"].get("before_id")
-
-        logger.info(f"Found {len(activities)} new activities")
-
-        for activity in activities:
-            # ignore NTC record
-            app_id = activity["app_id"]
-            activity_id = activity["id"]
-            if (
-                app_id == "com.nike.ntc.brand.ios"
-                or app_id == "com.nike.ntc.brand.droid"
+    with ThreadPoolExecutor(max_workers=NIKE_FETCH_WORKERS) as executor:
+        while True:
+            data = nike.get_activities_before_id(before_id)
+            activities = data["activities"]
+            activities_ids = [i["id"] for i in activities]
+            is_sync_done = False
+            if last_id_local in activities_ids:
+                index = activities_ids.index(last_id_local)
+                activities = activities[:index]
+                is_sync_done = True
+
+            before_id = data["paging"].get("before_id")
+
+            logger.info(f"Found {len(activities)} new activities")
+            if journal:
+                journal.list(i["id"] for i in activities)
+
+            to_fetch_ids = []
+            for activity in activities:
+                # ignore NTC record
+                app_id = activity["app_id"]
+                activity_id = activity["id"]
+                if (
+                    app_id == "com.nike.ntc.brand.ios"
+                    or app_id == "com.nike.ntc.brand.droid"
+                ):
+                    logger.info(f"Ignore NTC record {activity_id}")
+                    if journal:
+                        journal.mark(activity_id, SKIPPED)
+                    continue
+                saved_path = journal.fetched(activity_id) if journal else None
+                if saved_path and os.path.exists(saved_path):
+                    if on_saved:
+                        on_saved(saved_path)
+                    continue
+                to_fetch_ids.append(activity_id)
+
+            # details download concurrently, they are saved here in page order
+            for activity_id, full_activity in zip(
+                to_fetch_ids, executor.map(nike.get_activity, to_fetch_ids)
             ):
-                logger.info(f"Ignore NTC record {activity_id}")
-                continue
-
-            full_activity = nike.get_activity(activity_id)
-            save_activity(full_activity)
-
-        if is_sync_done or before_id is None or not activities:
-            logger.info("Found no new activities, finishing")
-            return
+                path = save_activity(full_activity)
+                if journal:
+                    journal.mark(activity_id, FETCHED, path)
+                if on_saved:
+                    on_saved(path)
+
+            if is_sync_done or before_id is None or not activities:
+                logger.info("Found no new activities, finishing")
+                return
 
 
 def save_activity(activity):
@@ -110,12 +143,17 @@ def save_activity(activity):
     print(activity_time)
     logger.info(f"Saving activity {activity_id}")
     path = os.path.join(OUTPUT_DIR, f"{activity_time}.json")
+    # a dot file is ignored when OUTPUT_DIR is listed, the json appears complete
+    tmp_path = os.path.join(OUTPUT_DIR, f".{activity_time}.json.tmp")
     try:
-        with open(path, "w") as f:
+        with open(tmp_path, "w") as f:
             json.dump(activity, f, indent=4)
+        os.replace(tmp_path, path)
     except Exception:
-        os.unlink(path)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
         raise
+    return path
 
 
 def get_last_before_id():
@@ -134,7 +172,43 @@ def get_last_before_id():
         return None
 
 
+def load_converted_files():
+    """Names of the converted activity json files, None before the first run."""
+    if not os.path.exists(NIKE_CONVERTED_FILE):
+        return None
+    with open(NIKE_CONVERTED_FILE) as f:
+        return set(json.load(f))
+
+
+def save_converted_files(file_names):
+    converted = load_converted_files() or set()
+    converted.update(file_names)
+    tmp_path = f"{NIKE_CONVERTED_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(sorted(converted), f, indent=0)
+    os.replace(tmp_path, NIKE_CONVERTED_FILE)
+
+
 def get_to_generate_files():
+    converted = load_converted_files()
+    if converted is not None:
+        return [
+            os.path.join(OUTPUT_DIR, i)
+            for i in sorted(os.listdir(OUTPUT_DIR))
+            if not i.startswith(".") and i not in converted
+        ]
+    # no record yet, the files older than the newest gpx were converted before
+    to_generate_files = get_files_after_last_gpx()
+    to_generate_names = {os.path.basename(i) for i in to_generate_files}
+    save_converted_files(
+        i
+        for i in os.listdir(OUTPUT_DIR)
+        if not i.startswith(".") and i not in to_generate_names
+    )
+    return to_generate_files
+
+
+def get_files_after_last_gpx():
     file_names = os.listdir(GPX_FOLDER)
     try:
         # error when mixed keep & nike gpx files
@@ -175,19 +249,9 @@ def generate_gpx(title, latitude_data, longitude_data, elevation_data, heart_rat
         longitude_data: A list of dictionaries containing longitude data
         elevation_data: A list of dictionaries containing elevation data
     Returns:
-        gpx: The GPX XML document
+        (title, track): the GPX title and the TrackColumns of the points
     """
 
-    gpx = gpxpy.gpx.GPX()
-    gpx.nsmap["gpxtpx"] = "http://www.garmin.com/xmlschemas/TrackPointExtension/v1"
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx_track.name = title
-    gpx.tracks.append(gpx_track)
-
-    # Create first segment in our GPX track:
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
-
     points_dict_list = []
 
     def update_points(points, update_data, update_name):
@@ -226,35 +290,18 @@ def generate_gpx(title, latitude_data, longitude_data, elevation_data, heart_rat
     if elevation_data:
         update_points(points_dict_list, elevation_data, "elevation")
     if heart_rate_data:
-        update_points(points_dict_list, heart_rate_data, "heart_rate")
-
-    for p in points_dict_list:
-        # delete useless attr
-        del p["start_time"]
-        if p.get("heart_rate") is None:
-            point = gpxpy.gpx.GPXTrackPoint(**p)
-        else:
-            heart_rate_num = p.pop("heart_rate")
-            point = gpxpy.gpx.GPXTrackPoint(**p)
-            gpx_extension_hr = ElementTree.fromstring(
-                f"""<gpxtpx:TrackPointExtension xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">
-                <gpxtpx:hr>{heart_rate_num}</gpxtpx:hr>
-                </gpxtpx:TrackPointExtension>
-            """
-            )
-            point.extensions.append(gpx_extension_hr)
-        gpx_segment.points.append(point)
+        update_points(points_dict_list, heart_rate_data, "hr")
 
-    return gpx.to_xml()
+    return title, columns_from_dicts(points_dict_list)
 
 
 def parse_activity_data(activity):
     """
-    Parses a NRC activity and returns GPX XML
+    Parses a NRC activity and returns GPX data
     Args:
         activity: a json document for a NRC activity
     Returns:
-        gpx: the GPX XML doc for the input activity
+        gpx: (title, track) for the input activity, see generate_gpx
     """
 
     lat_index = None
@@ -295,9 +342,9 @@ def parse_activity_data(activity):
 
 
 def save_gpx(gpx_data, activity_id):
+    title, track = gpx_data
     file_path = os.path.join(GPX_FOLDER, activity_id + ".gpx")
-    with open(file_path, "w") as f:
-        f.write(gpx_data)
+    write_gpx(file_path, track, name=title)
 
 
 def parse_no_gpx_data(activity):
@@ -351,43 +398,112 @@ def parse_no_gpx_data(activity):
     return namedtuple("x", d.keys())(*d.values())
 
 
-def make_new_gpxs(files):
-    # TODO refactor maybe we do not need to upload
-    if not files:
-        print("no files")
-        return
-    if not os.path.exists(GPX_FOLDER):
-        os.mkdir(GPX_FOLDER)
+def convert_activity_file(file):
+    """
+    Write the gpx of a saved activity, run in a worker process.
+    Return (activity id, gpx path), the path is None without gps data.
+    """
+    with open(file, "r") as f:
+        json_data = json.load(f)
+    # ALL save name using utc if you want local please offset
+    activity_name = str(json_data["end_epoch_ms"])
+    parsed_data = parse_activity_data(json_data)
+    if not parsed_data:
+        return json_data["id"], None
+    save_gpx(parsed_data, activity_name)
+    return json_data["id"], os.path.join(GPX_FOLDER, activity_name + ".gpx")
+
+
+def collect_converted_files(futures, journal=None):
+    """
+    futures maps the futures of convert_activity_file to their json files.
+    Tracks without gpx are committed through the journal when there is one,
+    otherwise all at the end, then the files are recorded as converted.
+    """
     gpx_files = []
     tracks_list = []
-    for file in files:
-        with open(file, "r") as f:
-            try:
-                json_data = json.loads(f.read())
-            except Exception as e:
-                print(f"Error reading JSON file {file}: {e}")
-                return
-        # ALL save name using utc if you want local please offset
-        activity_name = str(json_data["end_epoch_ms"])
-        parsed_data = parse_activity_data(json_data)
-        if parsed_data:
-            gpx_files.append(os.path.join(GPX_FOLDER, str(activity_name) + ".gpx"))
-            save_gpx(parsed_data, activity_name)
+    converted_files = []
+    for future, file in futures.items():
+        try:
+            activity_id, gpx_file = future.result()
+        except Exception as e:
+            print(f"Error converting {file}: {e}")
+            continue
+        if gpx_file:
+            gpx_files.append(gpx_file)
+            if journal:
+                # committed when the gpx files are imported
+                journal.mark(activity_id, WRITTEN)
         else:
             try:
-                track = parse_no_gpx_data(json_data)
-                if track:
-                    tracks_list.append(track)
+                with open(file, "r") as f:
+                    track = parse_no_gpx_data(json.load(f))
             # just ignore some unexpected run
             except Exception as e:
                 print(str(e))
+                if journal:
+                    journal.mark(activity_id, FAILED)
                 continue
+            if not track:
+                if journal:
+                    journal.mark(activity_id, SKIPPED)
+            elif journal:
+                journal.add_track(activity_id, track)
+            else:
+                tracks_list.append(track)
+        converted_files.append(os.path.basename(file))
+    if journal:
+        journal.checkpoint()
     if tracks_list:
         generator = Generator(SQL_FILE)
         generator.sync_from_app(tracks_list)
+    save_converted_files(converted_files)
     return gpx_files
 
 
+def make_new_gpxs(files, journal=None):
+    # TODO refactor maybe we do not need to upload
+    if not files:
+        print("no files")
+        return
+    if not os.path.exists(GPX_FOLDER):
+        os.mkdir(GPX_FOLDER)
+    with ProcessPoolExecutor() as executor:
+        futures = {executor.submit(convert_activity_file, f): f for f in files}
+        return collect_converted_files(futures, journal)
+
+
+def sync_nike(refresh_token, is_continue_sync=False, journal=None):
+    """
+    Fetch the new activities while the saved json files are converted in
+    worker processes, each one as soon as it is saved.
+    """
+    if not os.path.exists(GPX_FOLDER):
+        os.mkdir(GPX_FOLDER)
+    futures = {}
+    submitted = set()
+    # workers start while the fetch threads run, forking then can deadlock
+    with ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+
+        def convert(file):
+            if file not in submitted:
+                submitted.add(file)
+                futures[executor.submit(convert_activity_file, file)] = file
+
+        for file in get_to_generate_files():
+            convert(file)
+        converted = load_converted_files()
+
+        def on_saved(file):
+            if os.path.basename(file) not in converted:
+                convert(file)
+
+        run(refresh_token, is_continue_sync, journal, on_saved)
+        return collect_converted_files(futures, journal)
+
+
 if __name__ == "__main__":
     if not os.path.exists(OUTPUT_DIR):
         os.mkdir(OUTPUT_DIR)
@@ -400,11 +516,11 @@ if __name__ == "__main__":
         help="Continue syncing from the last activity",
     )
     options = parser.parse_args()
-    run(options.refresh_token, options.continue_sync)
-
-    time.sleep(2)
-    files = get_to_generate_files()
-    make_new_gpxs(files)
-    # waiting for gpx
-    time.sleep(2)
-    make_activities_file(SQL_FILE, GPX_FOLDER, JSON_FILE)
+    generator = Generator(SQL_FILE)
+    with SyncJournal("nike", generator.sync_from_app) as journal:
+        gpx_files = sync_nike(options.refresh_token, options.continue_sync, journal)
+        # with the gpx files of a run that stopped before importing them
+        import_activity_files(
+            SQL_FILE, add_unsynced_files(gpx_files, {"gpx": GPX_FOLDER}), JSON_FILE
+        )
+        journal.clear(WRITTEN)
@@ -8,8 +8,16 @@ import uuid
 import hashlib
 import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 from config import FIT_FOLDER
+from file_download import (
+    DOWNLOAD_WORKERS,
+    download_to_file,
+    is_downloaded,
+    make_download_session,
+)
 
 SIGNIN_URL = "https://www.onelap.cn/api/login"
 ACTIVITY_URL = "https://u.onelap.cn/analysis/list"
@@ -74,21 +82,36 @@ class Onelap:
 
         return activities
 
+    @staticmethod
+    def download_activity(session, download_url, file_key):
+        try:
+            file_path = os.path.join(FIT_FOLDER, file_key)
+            download_to_file(session, download_url, file_path)
+            print(f"download {file_key}")
+            return file_path
+        except requests.RequestException as e:
+            print(f"Failed to download {file_key}: {e}")
+
     def download_onelap_data(self):
+        """Download the new fit files, return the paths of the ones that made it."""
         activities = self.get_activities()
         os.makedirs(FIT_FOLDER, exist_ok=True)
-        for activity in activities:
-            file_key = activity.get("fileKey")
-            download_url = activity.get("durl")
-            if file_key and download_url:
-                response = requests.get(download_url)
-                if response.status_code == 200:
-                    file_path = os.path.join(FIT_FOLDER, file_key)
-                    with open(file_path, "wb") as file:
-                        file.write(response.content)
-                    print(f"download {file_key}")
-                else:
-                    print(f"Failed to download {file_key}: {response.status_code}")
+        session = make_download_session()
+        futures = []
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            for activity in activities:
+                file_key = activity.get("fileKey")
+                download_url = activity.get("durl")
+                if not file_key or not download_url:
+                    continue
+                if is_downloaded(os.path.join(FIT_FOLDER, file_key)):
+                    continue
+                futures.append(
+                    executor.submit(
+                        self.download_activity, session, download_url, file_key
+                    )
+                )
+        return [path for path in (f.result() for f in futures) if path]
 
 
 if __name__ == "__main__":
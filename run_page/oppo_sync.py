@@ -3,12 +3,9 @@ import hashlib
 import json
 import os
 import time
-import xml.etree.ElementTree as ET
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
-from xml.dom import minidom
 
-import gpxpy
 import polyline
 import requests
 from tzlocal import get_localzone
@@ -23,6 +20,16 @@ from config import (
     UTC_TIMEZONE,
 )
 from generator import Generator
+from timeline_align import NO_MATCH, nearest_sample_indexes
+from track_writer import (
+    CONNECT_API_AUTHOR,
+    TcxLap,
+    TrackColumns,
+    columns_from_dicts,
+    get_elevation_gain,
+    write_gpx,
+    write_tcx,
+)
 from utils import adjust_time
 
 TOKEN_REFRESH_URL = "https://sport.health.heytapmobi.com/open/v1/oauth/token"
@@ -74,9 +81,6 @@ DETAILED_SPORT_DATA_API = "https://sport.health.heytapmobi.com/open/v2/data/spor
 # If your points need trans from gcj02 to wgs84 coordinate which use by Mapbox
 TRANS_GCJ02_TO_WGS84 = True
 
-# May be Forerunner 945?
-CONNECT_API_PART_NUMBER = "006-D2449-00"
-
 AVAILABLE_OUTDOOR_SPORT_MODE = [
     1,  # WALK
     2,  # RUN
@@ -200,10 +204,10 @@ def parse_raw_data_to_name_tuple(sport_data, with_gpx, with_tcx):
 
         point_dict = prepare_track_points(sport_data, with_gpx)
 
-        gpx_data = parse_points_to_gpx(sport_data, point_dict)
-        elevation_gain = gpx_data.get_uphill_downhill().uphill
+        gpx_data = parse_points_to_gpx(point_dict)
+        elevation_gain = get_elevation_gain(gpx_data)
         if with_gpx is True:
-            download_keep_gpx(gpx_data.to_xml(), str(oppo_id))
+            download_keep_gpx(gpx_data, sport_data, str(oppo_id))
         if with_tcx is True:
             parse_points_to_tcx(sport_data, point_dict)
 
@@ -335,49 +339,20 @@ def map_oppo_fit_type_to_strava_activity_type(oppo_type):
             return "Ride"
 
 
-def parse_points_to_gpx(sport_data, points_dict_list):
-    gpx = gpxpy.gpx.GPX()
-    gpx.nsmap["gpxtpx"] = "http://www.garmin.com/xmlschemas/TrackPointExtension/v1"
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx_track.name = f"""gpx from {sport_data["deviceName"]}"""
-    gpx_track.type = map_oppo_fit_type_to_gpx_type(sport_data["sportMode"])
-    gpx.tracks.append(gpx_track)
-
-    # Create first segment in our GPX track:
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
-    for p in points_dict_list:
-        point = gpxpy.gpx.GPXTrackPoint(
-            latitude=p["latitude"],
-            longitude=p["longitude"],
-            time=p["time"],
-            elevation=p.get("elevation"),
-        )
-        hr = p.get("hr")
-        cad = p.get("cad")
-        if hr is not None or cad is not None:
-            hr_str = f"""<gpxtpx:hr>{hr}</gpxtpx:hr>""" if hr is not None else ""
-            cad_str = (
-                f"""<gpxtpx:cad>{p["cad"]}</gpxtpx:cad>""" if cad is not None else ""
-            )
-            gpx_extension = ET.fromstring(
-                f"""<gpxtpx:TrackPointExtension xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">
-                    {hr_str}
-                    {cad_str}
-                    </gpxtpx:TrackPointExtension>
-                    """
-            )
-            point.extensions.append(gpx_extension)
-        gpx_segment.points.append(point)
-    return gpx
+def parse_points_to_gpx(points_dict_list):
+    return columns_from_dicts(points_dict_list)
 
 
-def download_keep_gpx(gpx_data, keep_id):
+def download_keep_gpx(gpx_data, sport_data, keep_id):
     try:
         print(f"downloading keep_id {str(keep_id)} gpx")
         file_path = os.path.join(GPX_FOLDER, str(keep_id) + ".gpx")
-        with open(file_path, "w") as fb:
-            fb.write(gpx_data)
+        write_gpx(
+            file_path,
+            gpx_data,
+            name=f"""gpx from {sport_data["deviceName"]}""",
+            sport_type=map_oppo_fit_type_to_gpx_type(sport_data["sportMode"]),
+        )
     except Exception as e:
         print(f"wrong id {keep_id}: {str(e)}")
         pass
@@ -399,19 +374,23 @@ def prepare_track_points(sport_data, with_gpx):
     points_dict_list = []
 
     if other_data.get("gpsPoint"):
-        timestamp_list = [item["timestamp"] for item in decoded_hr_data]
-        other_data = sport_data["otherSportData"]
-        value_size = len(other_data.get("gpsPoint", None))
+        gps_points = other_data["gpsPoint"]
+        # every gps point shares its timestamp with one heart rate sample
+        hr_indexes = nearest_sample_indexes(
+            [item["timestamp"] for item in decoded_hr_data],
+            [point["timestamp"] for point in gps_points],
+        )
 
-        for i in range(value_size):
-            temp_timestamp = other_data.get("gpsPoint")[i]["timestamp"]
-            j = timestamp_list.index(temp_timestamp)
+        for point, j in zip(gps_points, hr_indexes):
+            temp_timestamp = point["timestamp"]
+            if j == NO_MATCH:
+                raise ValueError(f"no heart rate sample at {temp_timestamp}")
 
             points_dict = {
-                "latitude": other_data.get("gpsPoint")[i]["latitude"],
-                "longitude": other_data.get("gpsPoint")[i]["longitude"],
+                "latitude": point["latitude"],
+                "longitude": point["longitude"],
                 "time": datetime.fromtimestamp(temp_timestamp / 1000, tz=timezone.utc),
-                "hr": other_data.get("heartRate")[j]["value"],
+                "hr": decoded_hr_data[j]["value"],
             }
             points_dict_list.append(get_value(j, points_dict, other_data))
     elif with_gpx is False:
@@ -451,50 +430,13 @@ def parse_points_to_tcx(sport_data, points_dict_list):
     fit_start_time = datetime.strftime(
         adjust_time(start_date, UTC_TIMEZONE), "%Y-%m-%dT%H:%M:%SZ"
     )
-
-    # Root node
-    training_center_database = ET.Element(
-        "TrainingCenterDatabase",
-        {
-            "xmlns": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",
-            "xmlns:ns5": "http://www.garmin.com/xmlschemas/ActivityGoals/v1",
-            "xmlns:ns3": "http://www.garmin.com/xmlschemas/ActivityExtension/v2",
-            "xmlns:ns2": "http://www.garmin.com/xmlschemas/UserProfile/v2",
-            "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-            "xmlns:ns4": "http://www.garmin.com/xmlschemas/ProfileExtension/v1",
-            "xsi:schemaLocation": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd",
-        },
-    )
-    # xml tree
-    ET.ElementTree(training_center_database)
-    # Activities
-    activities = ET.Element("Activities")
-    training_center_database.append(activities)
     # sport type
     sports_type = map_oppo_fit_type_to_gpx_type(sport_data["sportMode"])
-    # activity
-    activity = ET.Element("Activity", {"Sport": sports_type})
-    activities.append(activity)
-    #   Id
-    activity_id = ET.Element("Id")
-    activity_id.text = fit_start_time
-    activity.append(activity_id)
-    #   Creator
-    activity_creator = ET.Element("Creator", {"xsi:type": "Device_t"})
-    activity.append(activity_creator)
-    #       Name
-    activity_creator_name = ET.Element("Name")
-    activity_creator_name.text = sport_data["deviceName"]
-    activity_creator.append(activity_creator_name)
-    activity_creator_product = ET.Element("ProductID")
-    activity_creator_product.text = "3441"
-    activity_creator.append(activity_creator_product)
 
     """
     first, find distance split index
     """
     lap_split_indexes = [0]
-    points_dict_list_chunks = []
 
     for idx, item in enumerate(points_dict_list):
         size = len(lap_split_indexes)
@@ -514,153 +456,70 @@ def parse_points_to_tcx(sport_data, points_dict_list):
                 lap_split_indexes.append(idx)
 
     if len(lap_split_indexes) == 1:
-        points_dict_list_chunks = [points_dict_list]
+        lap_bounds = [(0, len(points_dict_list))]
     else:
-        for idx, item in enumerate(lap_split_indexes):
-            if idx + 1 == len(lap_split_indexes):
-                points_dict_list_chunks.append(
-                    points_dict_list[item : len(points_dict_list) - 1]
-                )
-            else:
-                points_dict_list_chunks.append(
-                    points_dict_list[item : lap_split_indexes[idx + 1]]
-                )
+        lap_bounds = list(
+            zip(lap_split_indexes, lap_split_indexes[1:] + [len(points_dict_list) - 1])
+        )
 
+    laps = []
     current_distance = 0
     current_time = start_date
 
-    for item in points_dict_list_chunks:
-        #   Lap
+    for begin, end in lap_bounds:
+        item = points_dict_list[begin:end]
         lap_start_time = datetime.strftime(
             adjust_time(item[0]["time"], UTC_TIMEZONE), "%Y-%m-%dT%H:%M:%SZ"
         )
-        activity_lap = ET.Element("Lap", {"StartTime": lap_start_time})
-        activity.append(activity_lap)
-
-        #       DistanceMeters
-        total_distance_node = ET.Element("DistanceMeters")
-        total_distance_node.text = str(item[-1]["distance"] - current_distance)
+        summary = [
+            (
+                "TotalTimeSeconds",
+                (item[-1]["time"] - current_time).total_seconds(),
+            ),
+            ("DistanceMeters", item[-1]["distance"] - current_distance),
+            ("MaximumSpeed", max(node["speed"] for node in item)),
+        ]
         current_distance = item[-1]["distance"]
-        activity_lap.append(total_distance_node)
-        #       TotalTimeSeconds
-        chile_node = ET.Element("TotalTimeSeconds")
-        chile_node.text = str((item[-1]["time"] - current_time).total_seconds())
         current_time = item[-1]["time"]
-        activity_lap.append(chile_node)
-        #       MaximumSpeed
-        chile_node = ET.Element("MaximumSpeed")
-        chile_node.text = str(max(node["speed"] for node in item))
-        activity_lap.append(chile_node)
-        # #       Calories
-        # chile_node = ET.Element("Calories")
-        # chile_node.text = str(int(other_data["totalCalories"] / 1000))
-        # activity_lap.append(chile_node)
-        #       AverageHeartRateBpm
-        # bpm = ET.Element("AverageHeartRateBpm")
-        # bpm_value = ET.Element("Value")
-        # bpm.append(bpm_value)
-        # bpm_value.text = str(other_data["avgHeartRate"])
-        # heartrate_list = [item["value"] for item in other_data["heartRate"]]
-        # bpm_value.text = str(round(statistics.mean(heartrate_list)))
-        # activity_lap.append(bpm)
-        # #       MaximumHeartRateBpm
-        # bpm = ET.Element("MaximumHeartRateBpm")
-        # bpm_value = ET.Element("Value")
-        # bpm.append(bpm_value)
-        # bpm_value.text = str(max(node["hr"] for node in item))
-        # activity_lap.append(bpm)
-
-        # Track
-        track = ET.Element("Track")
-        activity_lap.append(track)
-
-        for p in item:
-            tp = ET.Element("Trackpoint")
-            track.append(tp)
-            # Time
-            time_stamp = datetime.strftime(
-                adjust_time(p["time"], UTC_TIMEZONE), "%Y-%m-%dT%H:%M:%SZ"
-            )
-            time_label = ET.Element("Time")
-            time_label.text = time_stamp
-
-            tp.append(time_label)
-            if sports_type == "Biking" and p.get("cad"):
-                cadence_label = ET.Element("Cadence")
-                cadence_label.text = str(p["cad"])
-                tp.append(cadence_label)
-            if p.get("distance"):
-                distance_label = ET.Element("DistanceMeters")
-                distance_label.text = str(p["distance"])
-                tp.append(distance_label)
-            # HeartRateBpm
-            # None was converted to bytes by np.dtype, becoming a string "None" after decode...-_-
-            # as well as LatitudeDegrees and LongitudeDegrees below
-            if p.get("hr"):
-                bpm = ET.Element("HeartRateBpm")
-                bpm_value = ET.Element("Value")
-                bpm.append(bpm_value)
-                bpm_value.text = str(p["hr"])
-                tp.append(bpm)
-            #  AltitudeMeters
-            if p.get("elevation"):
-                altitude_meters = ET.Element("AltitudeMeters")
-                altitude_meters.text = str(p["elevation"] / 10)
-                tp.append(altitude_meters)
-            if p.get("latitude"):
-                position = ET.Element("Position")
-                tp.append(position)
-                #   LatitudeDegrees
-                lati = ET.Element("LatitudeDegrees")
-                lati.text = str(p["latitude"])
-                position.append(lati)
-                #   LongitudeDegrees
-                longi = ET.Element("LongitudeDegrees")
-                longi.text = str(p["longitude"])
-                position.append(longi)
-            # Extensions
-            if p.get("speed") is not None or (
-                p.get("cad") is not None and sports_type == "Running"
-            ):
-                extensions = ET.Element("Extensions")
-                tp.append(extensions)
-                tpx = ET.Element("ns3:TPX")
-                extensions.append(tpx)
-                #   LatitudeDegrees
-                #   LatitudeDegrees
-                if p.get("speed") is not None:
-                    speed = ET.Element("ns3:Speed")
-                    speed.text = str(p["speed"])
-                    tpx.append(speed)
-                if p.get("cad") is not None and sports_type == "Running":
-                    cad = ET.Element("ns3:RunCadence")
-                    cad.text = str(round(p["cad"] / 2))
-                    tpx.append(cad)
-    # Author
-    author = ET.Element("Author", {"xsi:type": "Application_t"})
-    training_center_database.append(author)
-    author_name = ET.Element("Name")
-    author_name.text = "Connect Api"
-    author.append(author_name)
-    author_lang = ET.Element("LangID")
-    author_lang.text = "en"
-    author.append(author_lang)
-    author_part = ET.Element("PartNumber")
-    author_part.text = CONNECT_API_PART_NUMBER
-    author.append(author_part)
+        laps.append(TcxLap(lap_start_time, summary, begin, end))
+
+    # cadence is written as <Cadence> for biking and as RunCadence for running
+    cadence = None
+    if sports_type == "Biking":
+        cadence = [p.get("cad") or None for p in points_dict_list]
+    elif sports_type == "Running":
+        cadence = [
+            round(p["cad"] / 2) if p.get("cad") is not None else None
+            for p in points_dict_list
+        ]
+    track = TrackColumns(
+        time=[
+            adjust_time(p["time"], UTC_TIMEZONE).timestamp() for p in points_dict_list
+        ],
+        lat=[p.get("latitude") or None for p in points_dict_list],
+        lon=[
+            p.get("longitude") if p.get("latitude") else None for p in points_dict_list
+        ],
+        elevation=[
+            p["elevation"] / 10 if p.get("elevation") else None
+            for p in points_dict_list
+        ],
+        hr=[p.get("hr") or None for p in points_dict_list],
+        cad=cadence,
+        distance=[p.get("distance") or None for p in points_dict_list],
+        speed=[p.get("speed") for p in points_dict_list],
+    )
     # write to TCX file
-    xml_str = minidom.parseString(ET.tostring(training_center_database)).toprettyxml()
-    with open(TCX_FOLDER + "/" + fit_id + ".tcx", "w") as f:
-        f.write(str(xml_str))
-
-
-def formated_input(
-    run_data, run_data_label, tcx_label
-):  # load run_data from run_data_label, parse to tcx_label, return xml node
-    fit_data = str(run_data[run_data_label])
-    chile_node = ET.Element(tcx_label)
-    chile_node.text = fit_data
-    return chile_node
+    write_tcx(
+        TCX_FOLDER + "/" + fit_id + ".tcx",
+        track,
+        sports_type,
+        fit_start_time,
+        laps=laps,
+        creator=[("Name", sport_data["deviceName"]), ("ProductID", "3441")],
+        author=CONNECT_API_AUTHOR,
+        run_cadence=sports_type == "Running",
+    )
 
 
 def run_oppo_sync(
@@ -0,0 +1,99 @@
+"""
+On-disk cache for the JSON of activity detail endpoints.
+
+The detail of a finished activity never changes, so a sync that failed midway
+or a repeated backfill reads it from here instead of the network. Entries are
+gzip files named by the hash of (endpoint, id), the least recently used ones
+are removed once the cache grows over max_bytes.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+from config import RESPONSE_CACHE_DIR
+
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_MB", 512)) * 1024 * 1024
+
+
+class ResponseCache:
+    def __init__(
+        self, cache_dir=RESPONSE_CACHE_DIR, max_bytes=RESPONSE_CACHE_MAX_BYTES
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+
+    def _path(self, endpoint, key):
+        digest = hashlib.sha256(f"{endpoint}:{key}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.json.gz")
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json.gz"):
+                    path = os.path.join(root, name)
+                    try:
+                        yield path, os.stat(path)
+                    except FileNotFoundError:
+                        continue
+
+    def get(self, endpoint, key):
+        path = self._path(endpoint, key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # mtime is the last use, eviction removes the oldest first
+        os.utime(path)
+        return data
+
+    def put(self, endpoint, key, data):
+        path = self._path(endpoint, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(stat.st_size for _, stat in self._entries())
+            else:
+                self.total_bytes += os.path.getsize(path)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        total = sum(stat.st_size for _, stat in entries)
+        # leave some room so not every put evicts again
+        target = self.max_bytes * 0.9
+        for path, stat in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+        self.total_bytes = total
+
+    def get_or_fetch(self, endpoint, key, fetch, is_complete=lambda data: True):
+        """
+        Return the cached data or call fetch() and cache its result,
+        results that are None or not is_complete are returned but not cached.
+        """
+        data = self.get(endpoint, key)
+        if data is not None:
+            return data
+        data = fetch()
+        if data is not None and is_complete(data):
+            self.put(endpoint, key, data)
+        return data
+
+
+response_cache = ResponseCache()
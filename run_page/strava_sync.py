@@ -12,9 +12,12 @@ def run_strava_sync(
     refresh_token,
     sync_types: list = [],
     only_run=False,
+    lookback_days=None,
 ):
     generator = Generator(SQL_FILE)
     generator.set_strava_config(client_id, client_secret, refresh_token)
+    if lookback_days is not None:
+        generator.sync_lookback_days = lookback_days
     # judge sync types is only running or not
     if not only_run and len(sync_types) == 1 and sync_types[0] == "running":
         only_run = True
@@ -48,10 +51,18 @@ if __name__ == "__main__":
         action="store_true",
         help="if is only for running",
     )
+    parser.add_argument(
+        "--lookback-days",
+        dest="lookback_days",
+        type=int,
+        default=None,
+        help="days before the last synced activity to list again, default 7",
+    )
     options = parser.parse_args()
     run_strava_sync(
         options.client_id,
         options.client_secret,
         options.refresh_token,
         only_run=options.only_run,
+        lookback_days=options.lookback_days,
     )
@@ -1,5 +1,6 @@
 import argparse
 import asyncio
+from collections import deque
 from datetime import datetime
 
 from garmin_sync import Garmin
@@ -7,6 +8,18 @@ from strava_sync import run_strava_sync
 from stravaweblib import DataFormat, WebClient
 from utils import make_strava_client
 
+# strava exports downloading while one file uploads to garmin
+STRAVA_EXPORT_WORKERS = 3
+
+
+def download_strava_export(strava_web_client, activity_id, format):
+    try:
+        data = strava_web_client.get_activity_data(activity_id, fmt=format)
+        return data.filename, b"".join(data.content)
+    except Exception as ex:
+        print("get strava data error: ", ex)
+        return None
+
 
 async def upload_to_activities(
     garmin_client, strava_client, strava_web_client, format, use_fake_garmin_device
@@ -22,23 +35,44 @@ async def upload_to_activities(
         print("garmin last activity date: ", after_datetime)
         filters = {"after": after_datetime}
     strava_activities = list(strava_client.get_activities(**filters))
-    files_list = []
+    file_names = []
     print("strava activities size: ", len(strava_activities))
     if not strava_activities:
         print("no strava activity")
-        return files_list
+        return file_names
 
-    # strava rate limit
-    for i in sorted(strava_activities, key=lambda i: int(i.id)):
-        try:
-            data = strava_web_client.get_activity_data(i.id, fmt=format)
-            files_list.append(data)
-        except Exception as ex:
-            print("get strava data error: ", ex)
-    await garmin_client.upload_activities_original_from_strava(
-        files_list, use_fake_garmin_device
+    print(
+        "start upload activities to garmin!, use_fake_garmin_device:",
+        use_fake_garmin_device,
     )
-    return files_list
+
+    async def upload(download):
+        export = await download
+        if export is None:
+            return
+        file_name, content = export
+        await garmin_client.upload_activity_original_from_strava(
+            file_name, content, use_fake_garmin_device
+        )
+        file_names.append(file_name)
+
+    # uploads stay in the order of the ids, the oldest first, and only the
+    # files of the download window are held in memory
+    downloads = deque()
+    for i in sorted(strava_activities, key=lambda i: int(i.id)):
+        downloads.append(
+            asyncio.create_task(
+                asyncio.to_thread(
+                    download_strava_export, strava_web_client, i.id, format
+                )
+            )
+        )
+        if len(downloads) >= STRAVA_EXPORT_WORKERS:
+            await upload(downloads.popleft())
+    while downloads:
+        await upload(downloads.popleft())
+    await garmin_client.req.aclose()
+    return file_names
 
 
 if __name__ == "__main__":
@@ -0,0 +1,233 @@
+"""
+Upload activity files to strava through a persisted queue.
+
+Files are submitted while the request budget allows, the upload ids that are
+still processing are polled concurrently with a growing interval, and the queue
+state is saved after every step so an interrupted run resumes where it stopped.
+Failed uploads stay in the state file and are queued again when added again.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from config import STRAVA_UPLOAD_QUEUE_FILE
+from stravalib.client import ActivityUploader
+from stravalib.exc import ActivityUploadFailed, RateLimitExceeded, RateLimitTimeout
+
+# strava default limits are 100 requests every 15 minutes and 1000 daily,
+# keep some of them for the sync that usually runs after the upload
+STRAVA_REQUESTS_PER_WINDOW = 90
+STRAVA_WINDOW_SECONDS = 15 * 60
+MAX_PROCESSING_UPLOADS = 10
+# strava takes seconds to minutes to process an upload, the wait before the
+# next poll of an upload doubles from the first interval up to the max one
+POLL_INTERVAL_SECONDS = 5
+MAX_POLL_INTERVAL_SECONDS = 60
+# a poll that fails is retried, after this many failures in a row the upload fails
+MAX_POLL_ERRORS = 5
+POLL_WORKERS = 5
+
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+# errors of a single request (stravalib's Fault is a requests HTTPError), they
+# fail or delay one entry, not the whole run
+REQUEST_ERRORS = (requests.RequestException, RateLimitExceeded)
+
+
+class RequestBudget:
+    """Sliding window request counter shared by the upload and poll threads."""
+
+    def __init__(self, max_requests, window_seconds):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.sent = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.sent and now - self.sent[0] >= self.window_seconds:
+                    self.sent.popleft()
+                if len(self.sent) < self.max_requests:
+                    self.sent.append(now)
+                    return
+                wait = self.window_seconds - (now - self.sent[0])
+            print(f"Strava request budget used up, wait {int(wait) + 1} seconds")
+            time.sleep(wait)
+
+
+def call_with_rate_limit(func, *args, **kwargs):
+    """func is called again after the wait, so it must not reuse consumed input."""
+    try:
+        return func(*args, **kwargs)
+    except (RateLimitExceeded, RateLimitTimeout) as e:
+        timeout = e.timeout or STRAVA_WINDOW_SECONDS
+        print(f"Strava API Rate Limit Exceeded. Retry after {timeout} seconds")
+        time.sleep(timeout)
+        return func(*args, **kwargs)
+
+
+class StravaUploadQueue:
+    def __init__(
+        self,
+        client,
+        state_file=STRAVA_UPLOAD_QUEUE_FILE,
+        max_requests=STRAVA_REQUESTS_PER_WINDOW,
+        window_seconds=STRAVA_WINDOW_SECONDS,
+        max_processing=MAX_PROCESSING_UPLOADS,
+        poll_interval=POLL_INTERVAL_SECONDS,
+        max_poll_interval=MAX_POLL_INTERVAL_SECONDS,
+    ):
+        self.client = client
+        self.state_file = state_file
+        self.budget = RequestBudget(max_requests, window_seconds)
+        self.max_processing = max_processing
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.entries = self._load()
+
+    def _load(self):
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as f:
+                try:
+                    return json.load(f)
+                except Exception as e:
+                    print(f"json load {self.state_file} \nerror {e}")
+        return []
+
+    def _save(self):
+        with open(self.state_file, "w") as f:
+            json.dump(self.entries, f, indent=2)
+
+    def _with_status(self, status):
+        return [e for e in self.entries if e["status"] == status]
+
+    def add(self, file_path, data_type, force_to_run=True):
+        """Queue a file, files already in the queue are not added twice."""
+        for entry in self.entries:
+            if entry["file_path"] == file_path:
+                if entry["status"] == FAILED:
+                    entry.update(
+                        status=QUEUED, upload_id=None, error=None, poll_errors=0
+                    )
+                    self._save()
+                return
+        self.entries.append(
+            {
+                "file_path": file_path,
+                "data_type": data_type,
+                "force_to_run": force_to_run,
+                "status": QUEUED,
+                "upload_id": None,
+                "activity_id": None,
+                "error": None,
+            }
+        )
+        self._save()
+
+    def _submit(self, entry):
+        activity_type = "run" if entry["force_to_run"] else None
+
+        def upload():
+            # opened on every attempt, a retry must not send a consumed file
+            with open(entry["file_path"], "rb") as f:
+                return self.client.upload_activity(
+                    activity_file=f,
+                    data_type=entry["data_type"],
+                    activity_type=activity_type,
+                )
+
+        self.budget.acquire()
+        try:
+            uploader = call_with_rate_limit(upload)
+        except (ActivityUploadFailed, OSError, *REQUEST_ERRORS) as e:
+            entry.update(status=FAILED, error=str(e))
+            print(f"Upload failed {entry['file_path']} error {str(e)}")
+            return
+        entry.update(status=PROCESSING, upload_id=uploader.upload_id, polls=0)
+        self._schedule_poll(entry)
+        print(
+            f"Uploading {entry['data_type']} file: {entry['file_path']} "
+            f"to strava, upload_id: {uploader.upload_id}."
+        )
+        self._update(entry, uploader)
+
+    def _poll(self, entry):
+        self.budget.acquire()
+        uploader = ActivityUploader(
+            self.client, {"id": entry["upload_id"]}, raise_exc=False
+        )
+        entry["polls"] = entry.get("polls", 0) + 1
+        try:
+            call_with_rate_limit(uploader.poll)
+        except ActivityUploadFailed as e:
+            entry.update(status=FAILED, error=str(e))
+            print(f"Upload failed {entry['file_path']} error {str(e)}")
+            return
+        except REQUEST_ERRORS as e:
+            entry["poll_errors"] = entry.get("poll_errors", 0) + 1
+            if entry["poll_errors"] >= MAX_POLL_ERRORS:
+                entry.update(status=FAILED, error=str(e))
+                print(f"Upload failed {entry['file_path']} error {str(e)}")
+            else:
+                print(f"Poll failed {entry['file_path']} error {str(e)}, retry later")
+                self._schedule_poll(entry)
+            return
+        entry["poll_errors"] = 0
+        self._schedule_poll(entry)
+        self._update(entry, uploader)
+
+    def _schedule_poll(self, entry):
+        interval = min(
+            self.poll_interval * 2 ** entry.get("polls", 0), self.max_poll_interval
+        )
+        entry["next_poll"] = time.time() + interval
+
+    @staticmethod
+    def _update(entry, uploader):
+        if uploader.is_complete:
+            entry.update(status=DONE, activity_id=uploader.activity_id)
+            print(f"{entry['file_path']} -> strava activity {uploader.activity_id}")
+
+    def run(self):
+        """
+        Upload every queued file and wait for strava to process them.
+        return {file_path: activity_id} of the uploaded files, the finished
+        entries are removed from the saved queue state, the failed ones kept.
+        """
+        with ThreadPoolExecutor(max_workers=POLL_WORKERS) as executor:
+            while True:
+                queued = self._with_status(QUEUED)
+                processing = self._with_status(PROCESSING)
+                if not queued and not processing:
+                    break
+                for entry in queued[: max(self.max_processing - len(processing), 0)]:
+                    self._submit(entry)
+                    self._save()
+                processing = self._with_status(PROCESSING)
+                if processing:
+                    # only the uploads whose poll is due, the others wait
+                    next_poll = min(e.get("next_poll", 0) for e in processing)
+                    time.sleep(max(next_poll - time.time(), 0))
+                    now = time.time()
+                    due = [e for e in processing if e.get("next_poll", 0) <= now]
+                    list(executor.map(self._poll, due))
+                    self._save()
+
+        results = {e["file_path"]: e["activity_id"] for e in self._with_status(DONE)}
+        failed = self._with_status(FAILED)
+        print(f"{len(results)} files uploaded to strava, {len(failed)} failed")
+        for entry in failed:
+            print(f"Failed {entry['file_path']} error {entry['error']}")
+        self.entries = failed
+        self._save()
+        return results
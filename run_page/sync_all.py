@@ -0,0 +1,295 @@
+"""
+Run several sync sources in one process.
+
+The sources download concurrently on asyncio, blocking clients run in worker
+threads. Everything they produce goes through one queue to a single db writer,
+which upserts batch by batch, and activities.json is exported once at the end.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import traceback
+from collections import namedtuple
+
+import coros_sync
+import garmin_sync
+from config import FOLDER_DICT, JSON_FILE, SQL_FILE
+from generator import Generator
+from generator.db import get_sync_cursor, save_sync_cursor
+from gpxtrackposter.track_loader import TrackLoader
+from keep_sync import KEEP_SPORT_TYPES, get_all_keep_tracks
+from sync_journal import SyncJournal
+
+STRAVA_BATCH_SIZE = 100
+
+# kind: "strava" stravalib activities, "tracks" tracks parsed from data_dir,
+# "app" activity namedtuples (same as Generator.sync_from_app)
+# tracks of mixed files come with file_paths instead of data_dir
+SyncBatch = namedtuple(
+    "SyncBatch",
+    "kind items data_dir file_suffix file_paths",
+    defaults=(None, None, None),
+)
+
+
+def make_dirs(*folders):
+    for folder in folders:
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+
+
+async def strava_source(generator, queue, filters):
+    await asyncio.to_thread(generator.check_access)
+    activities = await asyncio.to_thread(
+        lambda: list(generator.iter_strava_activities(filters))
+    )
+    print(f"strava: {len(activities)} activities")
+    for i in range(0, len(activities), STRAVA_BATCH_SIZE):
+        await queue.put(SyncBatch("strava", activities[i : i + STRAVA_BATCH_SIZE]))
+
+
+async def local_source(queue):
+    """The new files of GPX_OUT, TCX_OUT and FIT_OUT in one batch."""
+    file_paths = await asyncio.to_thread(TrackLoader.list_data_dirs_files, FOLDER_DICT)
+    tracks = await asyncio.to_thread(Generator.load_file_tracks, file_paths, None)
+    await queue.put(SyncBatch("tracks", tracks, file_paths=file_paths))
+
+
+async def garmin_source(queue, secret_string, auth_domain, only_run, file_type):
+    folder = FOLDER_DICT[file_type]
+    make_dirs(folder, FOLDER_DICT["gpx"])
+    downloaded_ids = garmin_sync.get_downloaded_ids(folder)
+    if file_type == "fit":
+        downloaded_ids = list(
+            set(downloaded_ids + garmin_sync.get_downloaded_ids(FOLDER_DICT["gpx"]))
+        )
+    new_ids, id2title = await garmin_sync.download_new_activities(
+        secret_string, auth_domain, downloaded_ids, only_run, folder, file_type
+    )
+    file_paths = garmin_sync.get_activity_file_paths(new_ids, file_type)
+    tracks = await asyncio.to_thread(
+        Generator.load_file_tracks, file_paths, None, id2title
+    )
+    await queue.put(SyncBatch("tracks", tracks, file_paths=file_paths))
+
+
+async def coros_source(
+    queue, account, password, only_run, file_type, last_label_id, cursors
+):
+    make_dirs(FOLDER_DICT[file_type])
+    encrypted_pwd = hashlib.md5(password.encode()).hexdigest()
+    file_paths, newest_label_id = await coros_sync.download_new_activities(
+        account, encrypted_pwd, only_run, file_type, last_label_id
+    )
+    tracks = await asyncio.to_thread(Generator.load_file_tracks, file_paths, file_type)
+    await queue.put(SyncBatch("tracks", tracks, FOLDER_DICT[file_type], file_type))
+    if newest_label_id:
+        cursors[coros_sync.get_coros_sync_source(file_type, only_run)] = newest_label_id
+
+
+async def keep_source(queue, phone_number, password, sport_types, old_tracks_ids):
+    loop = asyncio.get_running_loop()
+
+    def commit(tracks):
+        # blocks the keep thread until the writer has the batch
+        asyncio.run_coroutine_threadsafe(
+            queue.put(SyncBatch("app", tracks)), loop
+        ).result()
+
+    def sync_keep():
+        with SyncJournal("keep", commit) as journal:
+            get_all_keep_tracks(
+                phone_number,
+                password,
+                old_tracks_ids,
+                sport_types,
+                with_gpx=True,
+                journal=journal,
+            )
+
+    await asyncio.to_thread(sync_keep)
+
+
+async def db_writer(generator, queue):
+    """The only task that writes to the db, one commit per batch."""
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            return
+        try:
+            if batch.kind == "strava":
+                await asyncio.to_thread(generator.write_strava_activities, batch.items)
+            elif batch.kind == "tracks":
+                await asyncio.to_thread(
+                    generator.write_tracks,
+                    batch.items,
+                    batch.data_dir,
+                    batch.file_suffix,
+                    batch.file_paths,
+                )
+            else:
+                await asyncio.to_thread(generator.sync_from_app, batch.items)
+        except Exception:
+            generator.session.rollback()
+            print(f"write {batch.kind} batch failed")
+            traceback.print_exc()
+
+
+async def run_source(name, source):
+    try:
+        await source
+    except Exception:
+        print(f"{name} sync failed")
+        traceback.print_exc()
+
+
+async def run_sync_all(options):
+    generator = Generator(SQL_FILE)
+    generator.only_run = options.only_run
+    queue = asyncio.Queue()
+    sources = []
+    # listing cursors the sources moved, saved once everything is written
+    cursors = {}
+
+    # read what the sources need from the db before the writer starts
+    if options.strava:
+        generator.set_strava_config(*options.strava)
+        filters = generator.get_strava_filters(False)
+        sources.append(("strava", strava_source(generator, queue, filters)))
+    if options.garmin:
+        auth_domain = "CN" if options.garmin_cn else "COM"
+        sources.append(
+            (
+                "garmin",
+                garmin_source(
+                    queue,
+                    options.garmin,
+                    auth_domain,
+                    options.only_run,
+                    options.garmin_file_type,
+                ),
+            )
+        )
+    if options.coros:
+        last_label_id = get_sync_cursor(
+            generator.session,
+            coros_sync.get_coros_sync_source(options.coros_file_type, options.only_run),
+        )
+        sources.append(
+            (
+                "coros",
+                coros_source(
+                    queue,
+                    *options.coros,
+                    options.only_run,
+                    options.coros_file_type,
+                    last_label_id,
+                    cursors,
+                ),
+            )
+        )
+    if options.keep:
+        sources.append(
+            (
+                "keep",
+                keep_source(
+                    queue,
+                    *options.keep,
+                    options.keep_sport_types,
+                    generator.get_old_tracks_ids(),
+                ),
+            )
+        )
+    if options.local:
+        sources.append(("local", local_source(queue)))
+    if not sources:
+        print("no source configured")
+        return
+
+    writer = asyncio.create_task(db_writer(generator, queue))
+    await asyncio.gather(*(run_source(name, source) for name, source in sources))
+    await queue.put(None)
+    await writer
+    for source, value in cursors.items():
+        save_sync_cursor(generator.session, source, value)
+    generator.session.commit()
+
+    activities_list = generator.load(options.dedupe_seconds)
+    with open(JSON_FILE, "w") as f:
+        json.dump(activities_list, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--strava",
+        nargs=3,
+        metavar=("CLIENT_ID", "CLIENT_SECRET", "REFRESH_TOKEN"),
+        help="sync from strava",
+    )
+    parser.add_argument(
+        "--garmin",
+        metavar="SECRET_STRING",
+        help="sync from garmin, secret_string from get_garmin_secret.py",
+    )
+    parser.add_argument(
+        "--garmin-cn",
+        dest="garmin_cn",
+        action="store_true",
+        help="if garmin account is cn",
+    )
+    parser.add_argument(
+        "--garmin-file-type",
+        dest="garmin_file_type",
+        choices=["gpx", "tcx", "fit"],
+        default="gpx",
+    )
+    parser.add_argument(
+        "--coros",
+        nargs=2,
+        metavar=("ACCOUNT", "PASSWORD"),
+        help="sync from coros",
+    )
+    parser.add_argument(
+        "--coros-file-type",
+        dest="coros_file_type",
+        choices=["gpx", "tcx", "fit"],
+        default="fit",
+    )
+    parser.add_argument(
+        "--keep",
+        nargs=2,
+        metavar=("PHONE_NUMBER", "PASSWORD"),
+        help="sync from keep",
+    )
+    parser.add_argument(
+        "--keep-sport-types",
+        dest="keep_sport_types",
+        nargs="+",
+        choices=KEEP_SPORT_TYPES,
+        default=["running"],
+    )
+    parser.add_argument(
+        "--only-run",
+        dest="only_run",
+        action="store_true",
+        help="if is only for running",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="sync the new files of GPX_OUT, TCX_OUT and FIT_OUT",
+    )
+    parser.add_argument(
+        "--dedupe-seconds",
+        dest="dedupe_seconds",
+        type=int,
+        default=0,
+        help="export one activity of those starting within this many seconds, "
+        "e.g. the same run from garmin and strava",
+    )
+    options = parser.parse_args()
+    asyncio.run(run_sync_all(options))
@@ -0,0 +1,138 @@
+"""
+Measure a sync script offline against recorded API responses.
+
+    # once, with network, record what the script fetches
+    python run_page/sync_benchmark.py record fixtures/garmin -- garmin_sync.py <args>
+    # then as often as needed, without network
+    python run_page/sync_benchmark.py replay fixtures/garmin --latency 0.05 \\
+        --throttle-rate 0.1 -- garmin_sync.py <args>
+
+Both modes run the script in a temporary output folder, so the real data.db,
+activities.json and GPX_OUT/TCX_OUT/FIT_OUT are never touched.
+"""
+
+import argparse
+import os
+import runpy
+import sqlite3
+import sys
+import tempfile
+import time
+
+import config
+from http_replay import recording, replaying
+
+RUN_PAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def sandbox_config(root):
+    """Point every output path of config to root before the script imports it."""
+    folders = {
+        "OUTPUT_DIR": "activities",
+        "GPX_FOLDER": "GPX_OUT",
+        "TCX_FOLDER": "TCX_OUT",
+        "FIT_FOLDER": "FIT_OUT",
+        "PNG_FOLDER": "PNG_OUT",
+    }
+    for name, folder in folders.items():
+        path = os.path.join(root, folder)
+        os.makedirs(path, exist_ok=True)
+        setattr(config, name, path)
+    config.FOLDER_DICT = {
+        "gpx": config.GPX_FOLDER,
+        "tcx": config.TCX_FOLDER,
+        "fit": config.FIT_FOLDER,
+    }
+    config.SQL_FILE = os.path.join(root, "data.db")
+    config.JSON_FILE = os.path.join(root, "activities.json")
+    config.SYNCED_FILE = os.path.join(root, "imported.json")
+    config.STRAVA_UPLOAD_QUEUE_FILE = os.path.join(root, "strava_upload_queue.json")
+    config.RESPONSE_CACHE_DIR = os.path.join(root, "response_cache")
+    config.SYNC_JOURNAL_DIR = os.path.join(root, "sync_journal")
+    config.NIKE_CONVERTED_FILE = os.path.join(root, "nike_converted.json")
+
+
+def count_activities(sql_file):
+    if not os.path.exists(sql_file):
+        return 0
+    with sqlite3.connect(sql_file) as conn:
+        try:
+            return conn.execute("SELECT COUNT(*) FROM activities").fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+
+
+def run_script(script, script_args):
+    script_path = os.path.join(RUN_PAGE_DIR, script)
+    argv = sys.argv
+    sys.argv = [script_path] + script_args
+    start = time.perf_counter()
+    try:
+        runpy.run_path(script_path, run_name="__main__")
+    except SystemExit as e:
+        if e.code:
+            print(f"{script} exited with {e.code}")
+    finally:
+        sys.argv = argv
+    return time.perf_counter() - start
+
+
+def report(script, elapsed, activities, stats=None):
+    print()
+    print(f"script:          {script}")
+    print(f"elapsed:         {elapsed:.2f} s")
+    print(f"activities:      {activities}")
+    print(f"activities/s:    {activities / elapsed if elapsed else 0:.2f}")
+    if stats:
+        print(f"requests:        {stats.requests}")
+        print(f"429 injected:    {stats.throttled}")
+        print(f"retried after 429: {stats.retried}")
+        print(f"no fixture:      {stats.missed}")
+        for host, count in stats.per_host.most_common():
+            print(f"  {host}: {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("fixture_dir", help="folder of the recorded responses")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every response"
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        dest="throttle_rate",
+        type=float,
+        default=0.0,
+        help="share of requests answered with 429",
+    )
+    parser.add_argument(
+        "--retry-after",
+        dest="retry_after",
+        type=int,
+        default=1,
+        help="Retry-After seconds of the injected 429",
+    )
+    parser.add_argument("script", help="sync script in run_page, e.g. garmin_sync.py")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+    options = parser.parse_args()
+    script_args = options.script_args
+    if script_args[:1] == ["--"]:
+        script_args = script_args[1:]
+
+    sandbox = tempfile.mkdtemp(prefix="running_page_bench_")
+    sandbox_config(sandbox)
+    print(f"output folder: {sandbox}")
+    if options.mode == "record":
+        with recording(options.fixture_dir):
+            elapsed = run_script(options.script, script_args)
+        report(options.script, elapsed, count_activities(config.SQL_FILE))
+    else:
+        with replaying(
+            options.fixture_dir,
+            latency=options.latency,
+            throttle_rate=options.throttle_rate,
+            retry_after=options.retry_after,
+        ) as server:
+            elapsed = run_script(options.script, script_args)
+        report(options.script, elapsed, count_activities(config.SQL_FILE), server.stats)
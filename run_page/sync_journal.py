@@ -0,0 +1,162 @@
+"""
+Write-ahead journal of the activities an app sync works on.
+
+Every activity goes listed -> fetched -> parsed (or written, when its gpx/tcx
+file is saved) -> committed, each step is appended to
+<SYNC_JOURNAL_DIR>/<source>.jsonl before the sync goes on. A fetched entry
+holds what was fetched (the raw record, or the path it was saved to), so a
+restarted sync takes it from the journal instead of the network, and parsed
+tracks are committed every checkpoint_every activities.
+Committed, skipped and failed activities are cleared from the journal, the
+file is removed once nothing is left in it.
+"""
+
+import json
+import os
+from collections import Counter
+
+from config import SYNC_JOURNAL_DIR
+
+SYNC_CHECKPOINT_EVERY = int(os.getenv("SYNC_CHECKPOINT_EVERY", 20))
+
+LISTED = "listed"
+FETCHED = "fetched"
+PARSED = "parsed"
+WRITTEN = "written"
+COMMITTED = "committed"
+# no track for it, e.g. a duplicate or an activity without data
+SKIPPED = "skipped"
+# fetched but could not be parsed, fetching it again would not help
+FAILED = "failed"
+
+DONE_STATES = (COMMITTED, SKIPPED, FAILED)
+
+
+class SyncJournal:
+    def __init__(
+        self,
+        source,
+        commit,
+        checkpoint_every=SYNC_CHECKPOINT_EVERY,
+        journal_dir=SYNC_JOURNAL_DIR,
+    ):
+        """commit(tracks) writes a list of tracks, like Generator.sync_from_app."""
+        self.source = source
+        self.commit = commit
+        self.checkpoint_every = checkpoint_every
+        self.journal_file = os.path.join(journal_dir, f"{source}.jsonl")
+        # {activity id: {"state": state, "data": fetched data or None}}
+        self.entries = self._load()
+        self.pending = []
+        if self.entries:
+            counts = Counter(e["state"] for e in self.entries.values())
+            summary = ", ".join(f"{n} {state}" for state, n in counts.items())
+            print(f"resume {source} sync after an interrupted run: {summary}")
+        os.makedirs(journal_dir, exist_ok=True)
+        self._compact()
+        self.file = open(self.journal_file, "a")
+
+    def _load(self):
+        entries = {}
+        if not os.path.exists(self.journal_file):
+            return entries
+        with open(self.journal_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a killed sync may be cut off
+                    continue
+                self._apply(entries, entry)
+        return entries
+
+    @staticmethod
+    def _apply(entries, entry):
+        activity_id, state = entry["id"], entry["state"]
+        if state in DONE_STATES:
+            entries.pop(activity_id, None)
+            return
+        # the later states keep the data of the fetch
+        data = entry.get("data")
+        if data is None and activity_id in entries:
+            data = entries[activity_id]["data"]
+        entries[activity_id] = {"state": state, "data": data}
+
+    def _compact(self):
+        """Rewrite the journal with only the unfinished entries."""
+        if not self.entries:
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            return
+        tmp_path = f"{self.journal_file}.tmp"
+        with open(tmp_path, "w") as f:
+            for activity_id, entry in self.entries.items():
+                f.write(json.dumps({"id": activity_id, **entry}))
+                f.write("\n")
+        os.replace(tmp_path, self.journal_file)
+
+    def _append(self, entries):
+        for activity_id, state, data in entries:
+            entry = {"id": str(activity_id), "state": state}
+            if data is not None:
+                entry["data"] = data
+            self._apply(self.entries, entry)
+            self.file.write(json.dumps(entry))
+            self.file.write("\n")
+        self.file.flush()
+
+    def state(self, activity_id):
+        entry = self.entries.get(str(activity_id))
+        return entry["state"] if entry else None
+
+    def fetched(self, activity_id):
+        """What an interrupted run fetched for the activity, or None."""
+        entry = self.entries.get(str(activity_id))
+        return entry["data"] if entry else None
+
+    def mark(self, activity_id, state, data=None):
+        self._append([(activity_id, state, data)])
+
+    def list(self, activity_ids):
+        self._append(
+            [(i, LISTED, None) for i in activity_ids if str(i) not in self.entries]
+        )
+
+    def clear(self, state):
+        """Mark the entries in state committed, e.g. written files once imported."""
+        self._append(
+            [
+                (i, COMMITTED, None)
+                for i, e in self.entries.items()
+                if e["state"] == state
+            ]
+        )
+
+    def add_track(self, activity_id, track, state=PARSED):
+        self.mark(activity_id, state)
+        self.pending.append((activity_id, track))
+        if len(self.pending) >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if self.pending:
+            self.commit([track for _, track in self.pending])
+            self._append(
+                [(activity_id, COMMITTED, None) for activity_id, _ in self.pending]
+            )
+            self.pending = []
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        try:
+            self.checkpoint()
+        finally:
+            self.file.close()
+        self._compact()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # the tracks parsed before a failure are still committed
+        self.close()
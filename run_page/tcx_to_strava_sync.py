@@ -1,35 +1,30 @@
 import argparse
 import os
-import time
 
-from config import TCX_FOLDER
+from activity_file_index import get_files_to_upload, index_activity_files, mark_uploaded
+from config import SQL_FILE, TCX_FOLDER
+from generator.db import init_db
 from strava_sync import run_strava_sync
-from stravalib.exc import RateLimitTimeout, ActivityUploadFailed
+from strava_upload_queue import StravaUploadQueue
 from tcxreader.tcxreader import TCXReader
 
-from utils import make_strava_client, get_strava_last_time, upload_file_to_strava
+from utils import make_strava_client, get_strava_last_time
 
 
-def get_to_generate_files(last_time):
+def read_tcx_start_time(file_path):
+    tcx = TCXReader().read(file_path)
+    if len(tcx.trackpoints) == 0:
+        return None
+    return int(tcx.trackpoints[0].time.timestamp())
+
+
+def get_to_generate_files(session, last_time, include_uploaded=False):
     """
     return to values one dict for upload
     and one sorted list for next time upload
     """
-    file_names = os.listdir(TCX_FOLDER)
-    tcx = TCXReader()
-    tcx_files = [
-        (tcx.read(os.path.join(TCX_FOLDER, i)), os.path.join(TCX_FOLDER, i))
-        for i in file_names
-        if i.endswith(".tcx")
-    ]
-    tcx_files_dict = {
-        int(i[0].trackpoints[0].time.timestamp()): i[1]
-        for i in tcx_files
-        if len(i[0].trackpoints) > 0
-        and int(i[0].trackpoints[0].time.timestamp()) > last_time
-    }
-
-    return sorted(list(tcx_files_dict.keys())), tcx_files_dict
+    index_activity_files(session, TCX_FOLDER, "tcx", read_tcx_start_time)
+    return get_files_to_upload(session, "tcx", last_time, include_uploaded)
 
 
 if __name__ == "__main__":
@@ -47,33 +42,24 @@ if __name__ == "__main__":
     )
     options = parser.parse_args()
     # upload new tcx to strava
-    print("Need to load all tcx files maybe take some time")
+    # only new or changed files are parsed to read their start time
+    session = init_db(SQL_FILE)
     client = make_strava_client(
         options.client_id, options.client_secret, options.strava_refresh_token
     )
     last_time = 0
     if not options.all:
         last_time = get_strava_last_time(client, is_milliseconds=False)
-    to_upload_time_list, to_upload_dict = get_to_generate_files(last_time)
-    index = 1
+    to_upload_time_list, to_upload_dict = get_to_generate_files(
+        session, last_time, include_uploaded=options.all
+    )
+    upload_queue = StravaUploadQueue(client)
     for i in to_upload_time_list:
-        tcx_file = to_upload_dict.get(i)
-        try:
-            upload_file_to_strava(client, tcx_file, "tcx")
-        except RateLimitTimeout as e:
-            timeout = e.timeout
-            print(f"Strava API Rate Limit Timeout. Retry in {timeout} seconds")
-            print()
-            time.sleep(timeout)
-            # try previous again
-            upload_file_to_strava(client, tcx_file, "tcx")
-
-        except ActivityUploadFailed as e:
-            print(f"Upload failed error {str(e)}")
-        # spider rule
-        time.sleep(1)
+        upload_queue.add(to_upload_dict.get(i), "tcx")
+    print(f"{len(upload_queue.entries)} tcx files is going to upload")
+    for tcx_file in upload_queue.run():
+        mark_uploaded(session, tcx_file)
 
-    time.sleep(10)
     run_strava_sync(
         options.client_id, options.client_secret, options.strava_refresh_token
     )
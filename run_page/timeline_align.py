@@ -0,0 +1,76 @@
+"""
+Align per-point streams (heart rate, cadence, ...) onto gps track points.
+
+The app converters (keep, oppo, codoon) get the track points and the sensor
+samples as separate lists, so every point needs a lookup into another stream.
+Both inputs are sorted once and joined with `searchsorted`, which keeps the
+whole alignment at O((n + m) log m) instead of scanning the sample list per point.
+"""
+
+import numpy as np
+
+NO_MATCH = -1
+
+
+def nearest_sample_indexes(sample_times, target_times, threshold=0):
+    """
+    For every target time return the index (into `sample_times`) of the
+    nearest sample whose distance is <= threshold, or NO_MATCH.
+
+    Samples with a `None` time are ignored. When two samples are equally close
+    the earlier one wins, and for duplicated times the first one in the input
+    list wins, same as a linear scan with a strict `<` comparison.
+    """
+    result = np.full(len(target_times), NO_MATCH, dtype=np.int64)
+    valid = [i for i, t in enumerate(sample_times) if t is not None]
+    if not valid or not len(target_times):
+        return result
+
+    valid = np.asarray(valid, dtype=np.int64)
+    times = np.asarray([sample_times[i] for i in valid], dtype=np.float64)
+    # np.unique keeps the index of the first occurrence of every time
+    unique_times, first_index = np.unique(times, return_index=True)
+    origin_index = valid[first_index]
+
+    targets = np.asarray(target_times, dtype=np.float64)
+    right = np.searchsorted(unique_times, targets, side="left")
+    left = right - 1
+    right_clipped = np.minimum(right, len(unique_times) - 1)
+    left_clipped = np.maximum(left, 0)
+
+    right_diff = np.where(
+        right < len(unique_times),
+        np.abs(unique_times[right_clipped] - targets),
+        np.inf,
+    )
+    left_diff = np.where(
+        left >= 0, np.abs(targets - unique_times[left_clipped]), np.inf
+    )
+    use_left = left_diff <= right_diff
+    best = np.where(use_left, left_clipped, right_clipped)
+    best_diff = np.where(use_left, left_diff, right_diff)
+
+    matched = best_diff <= threshold
+    result[matched] = origin_index[best[matched]]
+    return result
+
+
+def step_value_indexes(breakpoints, positions):
+    """
+    For every position return the index of the last breakpoint <= position.
+    Positions before the first breakpoint get index 0.
+
+    `breakpoints` must be sorted ascending, e.g. the cumulative distance of
+    every km split.
+    """
+    if not len(breakpoints):
+        return np.full(len(positions), NO_MATCH, dtype=np.int64)
+    indexes = (
+        np.searchsorted(
+            np.asarray(breakpoints, dtype=np.float64),
+            np.asarray(positions, dtype=np.float64),
+            side="right",
+        )
+        - 1
+    )
+    return np.maximum(indexes, 0)
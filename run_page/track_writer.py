@@ -0,0 +1,336 @@
+"""
+Stream GPX 1.1 and TCX v2 documents from columnar track data.
+
+All the app adapters (keep, codoon, oppo, joyrun, nike, gpx_to_tcx) used to
+build a gpxpy object or an ElementTree per file and then pretty print it,
+sometimes through a second minidom round trip. Here the document is written
+as text chunks directly from the point columns, so no DOM is ever built.
+"""
+
+import io
+import itertools
+import math
+import os
+from collections import namedtuple
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+from gpxpy.geo import calculate_uphill_downhill
+
+GPX_NS = "http://www.topografix.com/GPX/1/1"
+GPX_TPX_NS = "http://www.garmin.com/xmlschemas/TrackPointExtension/v1"
+TCX_NS = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
+TCX_ACTIVITY_EXT_NS = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+
+GPX_CREATOR = "running_page"
+# May be Forerunner 945?
+CONNECT_API_PART_NUMBER = "006-D2449-00"
+CONNECT_API_AUTHOR = (
+    ("Name", "Connect Api"),
+    ("LangID", "en"),
+    ("PartNumber", CONNECT_API_PART_NUMBER),
+)
+
+# Every column is a sequence (list or numpy array) with one value per point,
+# or None when the source has no such data. Missing single values are None or nan.
+# time is unix epoch seconds (UTC), or strings that are already ISO 8601 formatted.
+TrackColumns = namedtuple(
+    "TrackColumns",
+    "time lat lon elevation hr cad distance speed",
+    defaults=(None,) * 8,
+)
+
+# summary is a list of (tag, value) pairs written in order before <Track>,
+# [begin, end) is the slice of points that belongs to the lap.
+TcxLap = namedtuple("TcxLap", "start_time summary begin end")
+
+
+def columns_from_dicts(points):
+    """
+    Build TrackColumns from the list of point dicts most adapters produce
+    ({"latitude", "longitude", "time" (datetime), "elevation", "hr", "cad", ...}).
+    """
+
+    def column(key):
+        values = [p.get(key) for p in points]
+        return values if any(v is not None for v in values) else None
+
+    times = [p["time"].timestamp() if p.get("time") else None for p in points]
+    return TrackColumns(
+        time=times if any(t is not None for t in times) else None,
+        lat=column("latitude"),
+        lon=column("longitude"),
+        elevation=column("elevation"),
+        hr=column("hr"),
+        cad=column("cad"),
+        distance=column("distance"),
+        speed=column("speed"),
+    )
+
+
+def track_length(track):
+    for column in track:
+        if column is not None:
+            return len(column)
+    return 0
+
+
+def get_elevation_gain(track, segment_starts=None):
+    """Uphill of the track, same smoothing as gpxpy's get_uphill_downhill."""
+    if track.elevation is None:
+        return 0.0
+    elevations = _as_list(track.elevation)
+    uphill = 0.0
+    for begin, end in _segment_bounds(len(elevations), segment_starts):
+        segment = [e for e in elevations[begin:end] if not _missing(e)]
+        uphill += calculate_uphill_downhill(segment)[0]
+    return uphill
+
+
+def format_times(times):
+    """Epoch seconds -> ISO 8601 UTC strings, vectorized. Missing values -> None."""
+    if times is None:
+        return None
+    if any(isinstance(t, str) for t in times):
+        return list(times)
+    values = np.asarray(
+        [np.nan if t is None else t for t in _as_list(times)], dtype=np.float64
+    )
+    missing = np.isnan(values)
+    filled = np.where(missing, 0, values)
+    if np.all(filled == np.floor(filled)):
+        stamps = filled.astype("datetime64[s]")
+    else:
+        stamps = np.round(filled * 1000).astype("datetime64[ms]")
+    strings = [f"{s}Z" for s in np.datetime_as_string(stamps)]
+    return [None if m else s for s, m in zip(strings, missing.tolist())]
+
+
+def write_gpx(target, track, name=None, sport_type=None, segment_starts=None):
+    """
+    Write a GPX 1.1 document to a file path or a binary/text file object.
+    segment_starts: point indexes where a new <trkseg> begins (besides 0).
+    """
+    _write(target, _iter_gpx(track, name, sport_type, segment_starts))
+
+
+def gpx_bytes(track, name=None, sport_type=None, segment_starts=None):
+    buffer = io.BytesIO()
+    write_gpx(buffer, track, name, sport_type, segment_starts)
+    return buffer.getvalue()
+
+
+def write_tcx(
+    target,
+    track,
+    sport,
+    activity_id,
+    laps=None,
+    creator=None,
+    author=None,
+    run_cadence=False,
+):
+    """
+    Write a TCX v2 document to a file path or a binary/text file object.
+
+    laps: list of TcxLap, defaults to one lap without summary for all points.
+    creator/author: lists of (tag, value) pairs for <Creator> and <Author>.
+    run_cadence: write cadence as ns3:RunCadence extension instead of <Cadence>.
+    """
+    _write(
+        target,
+        _iter_tcx(track, sport, activity_id, laps, creator, author, run_cadence),
+    )
+
+
+def tcx_bytes(
+    track, sport, activity_id, laps=None, creator=None, author=None, run_cadence=False
+):
+    buffer = io.BytesIO()
+    write_tcx(buffer, track, sport, activity_id, laps, creator, author, run_cadence)
+    return buffer.getvalue()
+
+
+def _write(target, chunks):
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, "w", encoding="utf-8") as f:
+            f.writelines(chunks)
+    elif isinstance(target, io.TextIOBase):
+        target.writelines(chunks)
+    else:
+        # binary file object, flush in chunks so big tracks do not pile up
+        pending = []
+        for chunk in chunks:
+            pending.append(chunk)
+            if len(pending) >= 1024:
+                target.write("".join(pending).encode("utf-8"))
+                pending = []
+        if pending:
+            target.write("".join(pending).encode("utf-8"))
+
+
+def _as_list(values):
+    if isinstance(values, np.ndarray):
+        return values.tolist()
+    return list(values)
+
+
+def _columns(track):
+    size = track_length(track)
+    columns = {}
+    for field, values in zip(track._fields, track):
+        if field == "time":
+            continue
+        if values is None:
+            columns[field] = [None] * size
+        else:
+            columns[field] = [None if _missing(v) else v for v in _as_list(values)]
+    times = format_times(track.time)
+    columns["time"] = times if times is not None else [None] * size
+    return size, columns
+
+
+def _missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _text(value):
+    return escape(str(value))
+
+
+def _segment_bounds(size, segment_starts):
+    starts = sorted({s for s in (segment_starts or []) if 0 < s < size})
+    bounds = [0] + starts + [size]
+    return list(itertools.pairwise(bounds))
+
+
+def _iter_gpx(track, name, sport_type, segment_starts):
+    size, c = _columns(track)
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield (
+        f'<gpx xmlns="{GPX_NS}" xmlns:gpxtpx="{GPX_TPX_NS}" xmlns:xsi="{XSI_NS}" '
+        f'xsi:schemaLocation="{GPX_NS} {GPX_NS}/gpx.xsd" version="1.1" '
+        f'creator="{GPX_CREATOR}">\n'
+    )
+    yield "  <trk>\n"
+    if name:
+        yield f"    <name>{_text(name)}</name>\n"
+    if sport_type:
+        yield f"    <type>{_text(sport_type)}</type>\n"
+    lat, lon, ele, times, hr, cad = (
+        c["lat"],
+        c["lon"],
+        c["elevation"],
+        c["time"],
+        c["hr"],
+        c["cad"],
+    )
+    for begin, end in _segment_bounds(size, segment_starts):
+        yield "    <trkseg>\n"
+        for i in range(begin, end):
+            # a trkpt must have a position
+            if lat[i] is None or lon[i] is None:
+                continue
+            parts = [f'      <trkpt lat="{lat[i]}" lon="{lon[i]}">\n']
+            if ele[i] is not None:
+                parts.append(f"        <ele>{ele[i]}</ele>\n")
+            if times[i] is not None:
+                parts.append(f"        <time>{times[i]}</time>\n")
+            if hr[i] is not None or cad[i] is not None:
+                parts.append(
+                    "        <extensions>\n" "          <gpxtpx:TrackPointExtension>\n"
+                )
+                if hr[i] is not None:
+                    parts.append(f"            <gpxtpx:hr>{hr[i]}</gpxtpx:hr>\n")
+                if cad[i] is not None:
+                    parts.append(f"            <gpxtpx:cad>{cad[i]}</gpxtpx:cad>\n")
+                parts.append(
+                    "          </gpxtpx:TrackPointExtension>\n"
+                    "        </extensions>\n"
+                )
+            parts.append("      </trkpt>\n")
+            yield "".join(parts)
+        yield "    </trkseg>\n"
+    yield "  </trk>\n</gpx>\n"
+
+
+def _iter_fields(fields, indent):
+    for tag, value in fields:
+        if not _missing(value):
+            yield f"{indent}<{tag}>{_text(value)}</{tag}>\n"
+
+
+def _iter_tcx(track, sport, activity_id, laps, creator, author, run_cadence):
+    size, c = _columns(track)
+    if laps is None:
+        laps = [TcxLap(activity_id, [], 0, size)]
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield (
+        f'<TrainingCenterDatabase xmlns="{TCX_NS}" xmlns:ns3="{TCX_ACTIVITY_EXT_NS}" '
+        f'xmlns:xsi="{XSI_NS}" xsi:schemaLocation="{TCX_NS} '
+        'http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd">\n'
+    )
+    yield "  <Activities>\n"
+    yield f"    <Activity Sport={quoteattr(str(sport))}>\n"
+    yield f"      <Id>{_text(activity_id)}</Id>\n"
+    for lap in laps:
+        yield f"      <Lap StartTime={quoteattr(str(lap.start_time))}>\n"
+        yield from _iter_fields(lap.summary, "        ")
+        yield "        <Track>\n"
+        for i in range(lap.begin, lap.end):
+            yield _tcx_trackpoint(c, i, run_cadence)
+        yield "        </Track>\n"
+        yield "      </Lap>\n"
+    if creator:
+        yield '      <Creator xsi:type="Device_t">\n'
+        yield from _iter_fields(creator, "        ")
+        yield "      </Creator>\n"
+    yield "    </Activity>\n"
+    yield "  </Activities>\n"
+    if author:
+        yield '  <Author xsi:type="Application_t">\n'
+        yield from _iter_fields(author, "    ")
+        yield "  </Author>\n"
+    yield "</TrainingCenterDatabase>\n"
+
+
+def _tcx_trackpoint(c, i, run_cadence):
+    # children in the order of the TCX v2 schema
+    parts = ["          <Trackpoint>\n"]
+    if c["time"][i] is not None:
+        parts.append(f"            <Time>{c['time'][i]}</Time>\n")
+    if c["lat"][i] is not None and c["lon"][i] is not None:
+        parts.append(
+            "            <Position>\n"
+            f"              <LatitudeDegrees>{c['lat'][i]}</LatitudeDegrees>\n"
+            f"              <LongitudeDegrees>{c['lon'][i]}</LongitudeDegrees>\n"
+            "            </Position>\n"
+        )
+    if c["elevation"][i] is not None:
+        parts.append(
+            f"            <AltitudeMeters>{c['elevation'][i]}</AltitudeMeters>\n"
+        )
+    if c["distance"][i] is not None:
+        parts.append(
+            f"            <DistanceMeters>{c['distance'][i]}</DistanceMeters>\n"
+        )
+    if c["hr"][i] is not None:
+        parts.append(
+            "            <HeartRateBpm>\n"
+            f"              <Value>{c['hr'][i]}</Value>\n"
+            "            </HeartRateBpm>\n"
+        )
+    cad = c["cad"][i]
+    if cad is not None and not run_cadence:
+        parts.append(f"            <Cadence>{cad}</Cadence>\n")
+    speed = c["speed"][i]
+    if speed is not None or (cad is not None and run_cadence):
+        parts.append("            <Extensions>\n              <ns3:TPX>\n")
+        if speed is not None:
+            parts.append(f"                <ns3:Speed>{speed}</ns3:Speed>\n")
+        if cad is not None and run_cadence:
+            parts.append(f"                <ns3:RunCadence>{cad}</ns3:RunCadence>\n")
+        parts.append("              </ns3:TPX>\n            </Extensions>\n")
+    parts.append("          </Trackpoint>\n")
+    return "".join(parts)
@@ -1,4 +1,5 @@
 import json
+import os
 import time
 from datetime import datetime
 
@@ -9,18 +10,25 @@ try:
 except Exception:
     pass
 from generator import Generator
+from gpxtrackposter.track_loader import TrackLoader
+from gpxtrackposter.utils import get_timezone, get_utc_offset
 from stravalib.client import Client
 from stravalib.exc import RateLimitExceeded
 
 
 def adjust_time(time, tz_name):
-    tc_offset = datetime.now(pytz.timezone(tz_name)).utcoffset()
-    return time + tc_offset
+    # the offset at that time, a summer run keeps its DST offset in winter
+    return time + get_utc_offset(time, tz_name)
+
+
+def get_local_utc_offset(local_time, tz_name):
+    if local_time.tzinfo is not None:
+        return local_time.utcoffset()
+    return get_timezone(tz_name).localize(local_time).utcoffset()
 
 
 def adjust_time_to_utc(time, tz_name):
-    tc_offset = datetime.now(pytz.timezone(tz_name)).utcoffset()
-    return time - tc_offset
+    return time - get_local_utc_offset(time, tz_name)
 
 
 def adjust_timestamp_to_utc(timestamp, tz_name):
@@ -57,6 +65,35 @@ def make_activities_file(
         json.dump(activities_list, f)
 
 
+def make_all_activities_file(sql_file, data_dirs, json_file, activity_title_dict={}):
+    """Like make_activities_file for the gpx, tcx and fit folders in one pass."""
+    generator = Generator(sql_file)
+    generator.sync_from_data_dirs(data_dirs, activity_title_dict)
+    activities_list = generator.load()
+    with open(json_file, "w") as f:
+        json.dump(activities_list, f)
+
+
+def import_activity_files(
+    sql_file, file_paths, json_file, activity_title_dict={}, activity_metadata_dict={}
+):
+    """Like make_activities_file for exactly the given files, no folder scan."""
+    generator = Generator(sql_file)
+    generator.sync_from_files(file_paths, activity_title_dict, activity_metadata_dict)
+    activities_list = generator.load()
+    with open(json_file, "w") as f:
+        json.dump(activities_list, f)
+
+
+def add_unsynced_files(file_paths, data_dirs):
+    """
+    file_paths and the not yet synced files of {file_suffix: data_dir}, which
+    an earlier run downloaded but stopped before importing.
+    """
+    file_paths = [os.path.abspath(p) for p in file_paths]
+    return list(dict.fromkeys(file_paths + TrackLoader.list_data_dirs_files(data_dirs)))
+
+
 def make_strava_client(client_id, client_secret, refresh_token):
     client = Client()
 